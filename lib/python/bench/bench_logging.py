@@ -0,0 +1,88 @@
+"""
+Microbenchmark of the per-call cost of the logging helpers.
+
+Compares the previous implementation (inspect.getouterframes() plus eager
+str.format() of the payload on every call) against the current helpers,
+for a record which is dropped by level and for one which is emitted.
+
+Run from the root of the repo with 'invoke bench.logging' or
+'python -m lib.python.bench.bench_logging'.
+"""
+import inspect, logging, timeit
+
+from plumbum import colors
+
+from lib.python import utils
+from lib.python.utils import log, log_debug, log_info
+
+
+# a describe_instances-sized payload, which callers used to format eagerly
+PAYLOAD = {'Reservations': [{'Instances': [{'InstanceId': 'i-{:017x}'.format(i),
+                                            'Tags': [{'Key': 'Name', 'Value': 'node{}'.format(i)}] * 8,
+                                            'State': {'Name': 'running'}}]} for i in range(20)]}
+
+
+#
+def legacy_parent_frame_metadata(frame):
+    parent_frame = inspect.getouterframes(frame, 2)
+
+    return {
+        'caller_filename': parent_frame[1].filename,
+        'caller_lineno': parent_frame[1].lineno,
+        'caller_funcName': parent_frame[1].function + "()"
+    }
+
+
+#
+def legacy_log_debug(msg):
+    log.debug(colors.fg.lightblue & colors.dim | msg,
+              extra=legacy_parent_frame_metadata(inspect.currentframe()))
+
+
+#
+def legacy_log_info(msg):
+    log.info(colors.fg.white | msg,
+             extra=legacy_parent_frame_metadata(inspect.currentframe()))
+
+
+#
+def measure(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+
+
+#
+def main(number=2000):
+    handlers = log.handlers[:]
+    level = log.level
+    caller_metadata = utils.log_caller_metadata
+
+    # measure the helpers, not the terminal
+    log.handlers = [logging.NullHandler()]
+    utils.log_caller_metadata = True
+
+    try:
+        cases = []
+
+        log.setLevel(logging.INFO)
+        cases.append(('debug record, dropped',
+                      measure(lambda: legacy_log_debug("rez: {}".format(PAYLOAD)), number),
+                      measure(lambda: log_debug("rez: {}", PAYLOAD), number)))
+
+        cases.append(('info record, emitted',
+                      measure(lambda: legacy_log_info("Node '{}' is running.".format('node0')), number),
+                      measure(lambda: log_info("Node '{}' is running.", 'node0'), number)))
+
+    finally:
+        log.handlers = handlers
+        log.setLevel(level)
+        utils.log_caller_metadata = caller_metadata
+
+    print("{:<28} {:>14} {:>14} {:>9}".format('case', 'before (us)', 'after (us)', 'speedup'))
+    for name, before, after in cases:
+        print("{:<28} {:>14.2f} {:>14.2f} {:>8.1f}x".format(name, before, after, before / after))
+
+    return cases
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,410 @@
+"""
+Offline end-to-end benchmark of Rancher Server and Agent provisioning.
+
+Runs the real RancherServer and RancherAgents code against a moto EC2/IAM/STS
+backend, an in-process fake of the pooled SSH transport and a stub Rancher
+HTTP API. For each agent count it reports, per phase, wall time, AWS API
+calls, SSH sessions and commands, and HTTP requests.
+
+SSH is counted, not timed: nothing connects to an sshd, so paramiko,
+SSHConnectionPool and transport reuse are outside of what is measured.
+
+Requires the packages in lib/python/requirements-bench.txt. Run from the root
+of the repo with 'invoke bench.provisioning' or
+'python -m lib.python.bench.bench_provisioning 1 5 20 100'.
+"""
+import os, sys, json, time, shutil, tempfile, threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, urlunparse
+
+import boto3
+from requests.adapters import HTTPAdapter
+
+# moto only knows about its own catalogue of AMIs; add the ones os_to_settings points at
+BENCH_AMIS = ['ami-a9d276c9', 'ami-01f05461', 'ami-d2c924b2', 'ami-9fa343e7',
+              'ami-5dd3743d', 'ami-6f68cf0f', 'ami-57cb6d2f', 'ami-06af7f66']
+
+try:
+    from moto import mock_aws
+
+    #
+    def aws_mock():
+        return mock_aws()
+
+except ImportError:
+    from moto import mock_ec2, mock_iam, mock_sts
+
+    #
+    class aws_mock(object):
+
+        def __enter__(self):
+            self.mocks = [mock_ec2(), mock_iam(), mock_sts()]
+            for mock in self.mocks:
+                mock.start()
+
+        def __exit__(self, *args):
+            for mock in reversed(self.mocks):
+                mock.stop()
+
+from lib.python import utils
+from lib.python.utils import SSH as ssh_module
+from lib.python.utils import Readiness as readiness_module
+from lib.python.utils.SSH import SSHResult
+from lib.python.utils.RancherServer import RancherServer
+from lib.python.utils.RancherAgents import RancherAgents
+
+
+DEFAULT_COUNTS = [1, 5, 20, 100]
+REG_COMMAND = 'sudo docker run --rm --privileged rancher/agent:bench http://rancher/v1/scripts/bench'
+
+
+#
+class Counters(object):
+
+    #
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    #
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    #
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.counts)
+
+
+#
+class FakeSSHPool(object):
+    """Stands in for SSHConnectionPool; records sessions and commands instead of connecting."""
+
+    #
+    def __init__(self, counters, api):
+        self.counters = counters
+        self.api = api
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.markers = set()
+
+    #
+    def session(self, addr, user, key, timeout=10):
+        with self.lock:
+            if (addr, user, key) not in self.sessions:
+                self.sessions.add((addr, user, key))
+                self.counters.incr('ssh_sessions')
+
+    #
+    def discard(self, addr, user, key):
+        with self.lock:
+            self.sessions.discard((addr, user, key))
+
+    #
+    def close_all(self):
+        with self.lock:
+            self.sessions.clear()
+
+    #
+    def run(self, addr, user, key, cmd, timeout=10, tag=None):
+        self.session(addr, user, key, timeout)
+        self.counters.incr('ssh_commands')
+
+        stdout = ''
+        if cmd.startswith('test -f '):
+            marker = cmd.split()[2]
+            stdout = 'bundle-present' if (addr, marker) in self.markers else 'bundle-missing'
+        elif 'touch ' in cmd:
+            with self.lock:
+                self.markers.add((addr, cmd.split('touch ')[-1].strip()))
+        elif REG_COMMAND == cmd:
+            self.api.register_host(key)
+
+        return SSHResult(0, stdout)
+
+    #
+    def put(self, addr, user, key, src, dst, timeout=10):
+        self.session(addr, user, key, timeout)
+        self.counters.incr('ssh_uploads')
+        return SSHResult(0, '')
+
+
+#
+class StubRancherAPI(object):
+    """Minimal v2-beta API answering the calls made by RancherServer and RancherAgents."""
+
+    #
+    def __init__(self, counters):
+        self.counters = counters
+        self.lock = threading.Lock()
+        self.hosts = []
+        self.server = HTTPServer(('127.0.0.1', 0), self.handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, name='stub-rancher-api')
+        self.thread.daemon = True
+
+    #
+    def register_host(self, hostname):
+        with self.lock:
+            self.hosts.append({'id': '1h{}'.format(len(self.hosts) + 1), 'hostname': hostname, 'state': 'active'})
+
+    #
+    def respond(self, method, path):
+        path = urlparse(path).path.rstrip('/')
+
+        if path.endswith('/registrationtokens'):
+            if 'POST' == method:
+                return 201, {'id': '1c1', 'state': 'active'}
+            return 200, {'data': [{'command': REG_COMMAND}]}
+
+        if path.endswith('/hosts'):
+            with self.lock:
+                return 200, {'data': list(self.hosts)}
+
+        if path.endswith('/projects'):
+            return 200, {'data': [{'id': '1a5'}]}
+
+        if '/settings/' in path:
+            return 200, {'name': path.rsplit('/', 1)[-1], 'value': ''}
+
+        if path in ['/v2-beta', '/v3']:
+            return 200, {}
+
+        return 404, {}
+
+    #
+    def handler(self):
+        api = self
+
+        #
+        class Handler(BaseHTTPRequestHandler):
+
+            #
+            def log_message(self, *args):
+                pass
+
+            #
+            def reply(self):
+                api.counters.incr('http_requests')
+                length = int(self.headers.get('Content-Length') or 0)
+                if 0 < length:
+                    self.rfile.read(length)
+
+                status, body = api.respond(self.command, self.path)
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = reply
+            do_PUT = reply
+            do_POST = reply
+            do_DELETE = reply
+
+        return Handler
+
+    #
+    def start(self):
+        self.thread.start()
+
+    #
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+#
+class StubAPIAdapter(HTTPAdapter):
+    """Sends every request to the stub API regardless of the Rancher Server address."""
+
+    #
+    def __init__(self, address):
+        self.address = address
+        super(StubAPIAdapter, self).__init__()
+
+    #
+    def send(self, request, **kwargs):
+        parsed = urlparse(request.url)
+        request.url = urlunparse(parsed._replace(netloc='{}:{}'.format(*self.address)))
+        return super(StubAPIAdapter, self).send(request, **kwargs)
+
+
+#
+def bench_environment(workspace, agent_count):
+    env = {
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_DEFAULT_REGION': 'us-west-2',
+        'AWS_TAGS': 'is_ci,true',
+        'AWS_PREFIX': 'bench',
+        'AWS_ZONE': 'a',
+        'AWS_INSTANCE_PROFILE': 'bench-profile',
+        'RANCHER_VERSION': 'v1.6.14',
+        'RANCHER_ORCHESTRATION': 'cattle',
+        'RANCHER_DOCKER_VERSION': '17.03',
+        'RANCHER_SERVER_OPERATINGSYSTEM': 'ubuntu-1604',
+        'RANCHER_AGENT_OPERATINGSYSTEM': 'ubuntu-1604',
+        'RANCHER_SERVER_AWS_INSTANCE_TYPE': 'm4.large',
+        'RANCHER_AGENT_AWS_INSTANCE_TYPE': 'm4.large',
+        'RANCHER_AGENTS_COUNT': str(agent_count),
+        'RANCHER_API_WAIT_TIMEOUT': '60',
+        'WORKSPACE_DIR': workspace,
+        'BUILD_NUMBER': 'bench'
+    }
+
+    # let callers benchmark other settings, e.g. RANCHER_AGENTS_PARALLELISM
+    for key, value in env.items():
+        os.environ.setdefault(key, value)
+    for key in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_DEFAULT_REGION', 'RANCHER_AGENTS_COUNT',
+                'WORKSPACE_DIR', 'BUILD_NUMBER']:
+        os.environ[key] = env[key]
+
+
+#
+def bench_network():
+    ec2 = boto3.client('ec2', region_name='us-west-2')
+    vpc = ec2.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']['VpcId']
+    subnet = ec2.create_subnet(VpcId=vpc, CidrBlock='10.0.0.0/24', AvailabilityZone='us-west-2a')['Subnet']['SubnetId']
+    sg = ec2.create_security_group(GroupName='bench', Description='bench', VpcId=vpc)['GroupId']
+    boto3.client('iam', region_name='us-west-2').create_instance_profile(InstanceProfileName=os.environ['AWS_INSTANCE_PROFILE'])
+
+    os.environ['AWS_VPC_ID'] = vpc
+    os.environ['AWS_SUBNET_ID'] = subnet
+    os.environ['AWS_SECURITY_GROUP_ID'] = sg
+
+
+#
+def run_phase(name, fn, counters, phases):
+    before = counters.snapshot()
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    delta = counters.snapshot()
+    delta.subtract(before)
+    phases.append((name, elapsed, delta))
+
+
+#
+def bench_agent_count(agent_count, root):
+    workspace = tempfile.mkdtemp(prefix='bench-{}-'.format(agent_count))
+    os.symlink(os.path.join(root, 'lib'), os.path.join(workspace, 'lib'))
+    cwd = os.getcwd()
+    os.chdir(workspace)
+
+    counters = Counters()
+    api = StubRancherAPI(counters)
+    fake_pool = FakeSSHPool(counters, api)
+    phases = []
+
+    saved = {
+        'ssh_pool': ssh_module.ssh_pool,
+        'ssh_pooled_transport': ssh_module.ssh_pooled_transport,
+        'http_session': utils.http_session,
+        'readiness_http_session': readiness_module.http_session,
+        'tcp_connect': readiness_module.tcp_connect
+    }
+
+    #
+    def count_aws_call(model, **kwargs):
+        counters.incr('aws_calls')
+        counters.incr('aws:{}'.format(model.name))
+
+    #
+    def stub_http_session(url):
+        parsed = urlparse(url)
+        session = saved['http_session'](url)
+        session.mount('{}://{}'.format(parsed.scheme, parsed.netloc), StubAPIAdapter(api.server.server_address))
+        return session
+
+    try:
+        api.start()
+        with aws_mock():
+            bench_environment(workspace, agent_count)
+            bench_network()
+
+            utils.aws_cache_reset()
+            utils.ec2_baked_ami_invalidate()
+            utils.ec2_inventory_invalidate()
+            utils.http_sessions_reset()
+            utils.aws_session().events.register('before-call', count_aws_call)
+
+            ssh_module.ssh_pool = fake_pool
+            ssh_module.ssh_pooled_transport = lambda: True
+            utils.http_session = stub_http_session
+            readiness_module.http_session = stub_http_session
+            readiness_module.tcp_connect = lambda host, port, timeout: True
+
+            run_phase('rancher_server.provision', RancherServer().provision, counters, phases)
+            run_phase('rancher_server.configure', RancherServer().configure, counters, phases)
+            run_phase('rancher_agents.provision', RancherAgents().provision, counters, phases)
+            run_phase('rancher_agents.deprovision', RancherAgents().deprovision, counters, phases)
+            run_phase('rancher_server.deprovision', RancherServer().deprovision, counters, phases)
+
+    finally:
+        ssh_module.ssh_pool = saved['ssh_pool']
+        ssh_module.ssh_pooled_transport = saved['ssh_pooled_transport']
+        utils.http_session = saved['http_session']
+        readiness_module.http_session = saved['readiness_http_session']
+        readiness_module.tcp_connect = saved['tcp_connect']
+        utils.aws_cache_reset()
+        utils.ec2_baked_ami_invalidate()
+        utils.ec2_inventory_invalidate()
+        utils.http_sessions_reset()
+        api.stop()
+        os.chdir(cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    return phases
+
+
+#
+def report(agent_count, phases):
+    print("\nagents: {}".format(agent_count))
+    print("{:<28} {:>9} {:>10} {:>13} {:>13} {:>10}".format(
+        'phase', 'wall (s)', 'aws calls', 'ssh sessions', 'ssh commands', 'http reqs'))
+
+    for name, elapsed, delta in phases:
+        print("{:<28} {:>9.2f} {:>10} {:>13} {:>13} {:>10}".format(
+            name, elapsed, delta['aws_calls'], delta['ssh_sessions'],
+            delta['ssh_commands'] + delta['ssh_uploads'], delta['http_requests']))
+
+    for name, elapsed, delta in phases:
+        calls = sorted((key[4:], value) for key, value in delta.items() if key.startswith('aws:') and 0 < value)
+        print("  {:<26} {}".format(name, ', '.join('{}={}'.format(op, count) for op, count in calls)))
+
+
+#
+def main(counts=None, output=None):
+    if None is counts:
+        counts = DEFAULT_COUNTS
+
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+
+    amis_path = os.path.join(tempfile.mkdtemp(prefix='bench-amis-'), 'amis.json')
+    with open(amis_path, 'w') as f:
+        json.dump([{'ami_id': ami, 'name': ami, 'description': 'bench', 'owner_id': '099720109477',
+                    'public': True, 'virtualization_type': 'hvm', 'architecture': 'x86_64', 'state': 'available',
+                    'platform': None, 'root_device_type': 'ebs', 'root_device_name': '/dev/sda1',
+                    'sriov': 'simple', 'hypervisor': 'xen'} for ami in BENCH_AMIS], f)
+    os.environ['MOTO_AMIS_PATH'] = amis_path
+
+    print("note: SSH runs against an in-process fake; paramiko and SSHConnectionPool are not measured.")
+
+    results = {}
+    for agent_count in counts:
+        phases = bench_agent_count(int(agent_count), root)
+        report(agent_count, phases)
+        results[str(agent_count)] = [{'phase': name, 'wall': elapsed, 'counts': dict(delta)} for name, elapsed, delta in phases]
+
+    if None is not output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    return results
+
+
+if '__main__' == __name__:
+    main([int(count) for count in sys.argv[1:]] or None)
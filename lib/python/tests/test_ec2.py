@@ -0,0 +1,114 @@
+"""
+Tests of the fleet-wide EC2 helpers against moto, using the stubs of the provisioning bench.
+
+Requires the packages in lib/python/requirements-bench.txt.
+"""
+import os, logging, unittest
+
+from lib.python import utils
+from lib.python.utils import env_overlay, ec2_wait_for_states, ec2_wait_for_state, ec2_teardown, EC2WaitTimeout
+from lib.python.bench.bench_provisioning import aws_mock
+
+
+#
+def setUpModule():
+    utils.log.setLevel(logging.CRITICAL)
+
+
+#
+class EC2FleetTest(unittest.TestCase):
+
+    #
+    def setUp(self):
+        self.overlay = env_overlay({'AWS_DEFAULT_REGION': 'us-west-2', 'AWS_PREFIX': 'test'})
+        self.overlay.__enter__()
+        self.credentials = dict([(key, os.environ.get(key)) for key in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']])
+        os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
+        os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
+
+        self.mock = aws_mock()
+        self.mock.__enter__()
+        utils.aws_cache_reset()
+        utils.ec2_inventory_invalidate()
+        self.ec2 = utils.aws_client('ec2', region='us-west-2')
+        self.image = self.ec2.describe_images()['Images'][0]['ImageId']
+
+    #
+    def tearDown(self):
+        self.mock.__exit__(None, None, None)
+        utils.aws_cache_reset()
+        utils.ec2_inventory_invalidate()
+        for key, value in self.credentials.items():
+            if None is value:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        self.overlay.__exit__(None, None, None)
+
+    #
+    def launch(self, names, tags=[]):
+        ids = []
+        for name in names:
+            reservation = self.ec2.run_instances(ImageId=self.image, MinCount=1, MaxCount=1, TagSpecifications=[
+                {'ResourceType': 'instance', 'Tags': [{'Key': 'Name', 'Value': name}] + tags}])
+            ids.append(reservation['Instances'][0]['InstanceId'])
+        return ids
+
+    #
+    def running(self):
+        node_filter = [{'Name': 'instance-state-name', 'Values': ['pending', 'running']}]
+        names = []
+        for reservation in self.ec2.describe_instances(Filters=node_filter)['Reservations']:
+            for instance in reservation['Instances']:
+                names += [tag['Value'] for tag in instance.get('Tags', []) if 'Name' == tag['Key']]
+        return sorted(names)
+
+    #
+    def test_waiter_covers_fleets_larger_than_one_filter(self):
+        reservation = self.ec2.run_instances(ImageId=self.image, MinCount=250, MaxCount=250)
+        ids = [instance['InstanceId'] for instance in reservation['Instances']]
+
+        ready = {}
+        result = ec2_wait_for_states(ids, 'running', region='us-west-2', on_ready=lambda i, t: ready.update({i: t}))
+
+        self.assertEqual(sorted(ids), sorted(result.keys()))
+        self.assertEqual(result, ready)
+
+    #
+    def test_waiter_timeout_names_the_stragglers(self):
+        ids = self.launch(['test-server0'])
+
+        with self.assertRaises(EC2WaitTimeout) as raised:
+            ec2_wait_for_states(ids, 'stopped', timeout=0, region='us-west-2')
+        self.assertIn(ids[0], raised.exception.message)
+
+        with self.assertRaises(EC2WaitTimeout):
+            ec2_wait_for_state(ids[0], 'stopped', timeout=0)
+
+    #
+    def test_teardown_removes_the_run_prefix_only(self):
+        self.launch(['test-server0', 'test-agent0', 'test-agent1', 'other-server0'])
+        self.launch(['test-pool-i-1'], tags=[{'Key': 'rancher.pool.state', 'Value': 'idle'}])
+
+        removed = ec2_teardown(volumes=False, keypairs=False)
+
+        self.assertEqual(3, len(removed['instances']))
+        self.assertEqual(['other-server0', 'test-pool-i-1'], self.running())
+
+
+#
+class EC2TeardownGuardTest(unittest.TestCase):
+
+    #
+    def test_teardown_refuses_without_a_prefix(self):
+        prefix = os.environ.pop('AWS_PREFIX', None)
+        try:
+            with self.assertRaises(RuntimeError):
+                ec2_teardown(region='us-west-2')
+        finally:
+            if None is not prefix:
+                os.environ['AWS_PREFIX'] = prefix
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,117 @@
+"""
+Tests of the env() overlays matrix cells run under, and of backoff_delays().
+"""
+import os, logging, threading, unittest
+
+from lib.python import utils
+from lib.python.utils import env, env_overlay, env_bound, backoff_delays, EnvThreadPoolExecutor
+
+
+#
+def setUpModule():
+    utils.log.setLevel(logging.CRITICAL)
+
+
+#
+class EnvOverlayTest(unittest.TestCase):
+
+    #
+    def test_without_overlay_env_is_os_environ(self):
+        self.assertIs(os.environ, env())
+
+    #
+    def test_overlay_shadows_and_falls_through(self):
+        os.environ['RANCHER_TEST_FALLTHROUGH'] = 'os'
+        try:
+            with env_overlay({'RANCHER_TEST_OVERLAY': 'cell'}):
+                self.assertEqual('cell', env()['RANCHER_TEST_OVERLAY'])
+                self.assertEqual('os', env()['RANCHER_TEST_FALLTHROUGH'])
+            self.assertNotIn('RANCHER_TEST_OVERLAY', env())
+        finally:
+            del os.environ['RANCHER_TEST_FALLTHROUGH']
+
+    #
+    def test_nested_overlays_restore_the_outer_one(self):
+        with env_overlay({'RANCHER_TEST_OVERLAY': 'outer'}):
+            with env_overlay({'RANCHER_TEST_OVERLAY': 'inner'}):
+                self.assertEqual('inner', env()['RANCHER_TEST_OVERLAY'])
+            self.assertEqual('outer', env()['RANCHER_TEST_OVERLAY'])
+        self.assertIs(os.environ, env())
+
+    #
+    def test_writes_stay_in_the_overlay(self):
+        with env_overlay({}):
+            env()['RANCHER_TEST_OVERLAY'] = 'cell'
+        self.assertNotIn('RANCHER_TEST_OVERLAY', os.environ)
+
+    #
+    def test_overlay_is_per_thread(self):
+        seen = {}
+        inside = threading.Event()
+        checked = threading.Event()
+
+        #
+        def cell():
+            with env_overlay({'RANCHER_TEST_OVERLAY': 'cell'}):
+                inside.set()
+                checked.wait(5)
+
+        thread = threading.Thread(target=cell)
+        thread.start()
+        inside.wait(5)
+        seen['main'] = env().get('RANCHER_TEST_OVERLAY')
+        checked.set()
+        thread.join()
+
+        self.assertIsNone(seen['main'])
+
+    #
+    def test_env_bound_carries_the_overlay_to_another_thread(self):
+        seen = []
+        with env_overlay({'RANCHER_TEST_OVERLAY': 'cell'}):
+            fn = env_bound(lambda: seen.append(env().get('RANCHER_TEST_OVERLAY')))
+        thread = threading.Thread(target=fn)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(['cell'], seen)
+
+    #
+    def test_pool_workers_see_the_submitters_overlay(self):
+        with EnvThreadPoolExecutor(max_workers=2) as pool:
+            with env_overlay({'RANCHER_TEST_OVERLAY': 'a'}):
+                a = pool.submit(lambda: env().get('RANCHER_TEST_OVERLAY'))
+            with env_overlay({'RANCHER_TEST_OVERLAY': 'b'}):
+                b = pool.submit(lambda: env().get('RANCHER_TEST_OVERLAY'))
+            none = pool.submit(lambda: env().get('RANCHER_TEST_OVERLAY'))
+
+        self.assertEqual(['a', 'b', None], [a.result(), b.result(), none.result()])
+
+
+#
+class BackoffDelaysTest(unittest.TestCase):
+
+    #
+    def test_delays_grow_with_jitter_up_to_the_cap(self):
+        delays = backoff_delays(initial=1, maximum=8, factor=2)
+        bounds = [1, 2, 4, 8, 8, 8]
+
+        for bound in bounds:
+            delay = next(delays)
+            self.assertGreaterEqual(delay, bound / 2.0)
+            self.assertLessEqual(delay, bound)
+
+    #
+    def test_initial_above_maximum_is_not_capped_on_the_first_delay(self):
+        delays = backoff_delays(initial=10, maximum=5)
+        self.assertLessEqual(next(delays), 10)
+        self.assertLessEqual(next(delays), 5)
+
+    #
+    def test_delays_never_end(self):
+        delays = backoff_delays(initial=0.5, maximum=1)
+        self.assertEqual(100, len([next(delays) for i in range(100)]))
+
+
+if '__main__' == __name__:
+    unittest.main()
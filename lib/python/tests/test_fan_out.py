@@ -0,0 +1,109 @@
+"""
+Tests of fan_out() concurrency, fail-fast cancellation and fan_out_check() messages.
+"""
+import time, logging, threading, unittest
+
+from lib.python import utils
+from lib.python.utils.SSH import SSHError, FanOutResult, fan_out, fan_out_check
+
+
+#
+def setUpModule():
+    utils.log.setLevel(logging.CRITICAL)
+
+
+#
+def nodes(count):
+    return [('node{}'.format(i), '10.0.0.{}'.format(i), 'ubuntu') for i in range(count)]
+
+
+#
+class FanOutTest(unittest.TestCase):
+
+    #
+    def test_results_come_back_in_node_order(self):
+        results = fan_out(nodes(5), lambda name, addr, user: 0 if 'node3' != name else 2, parallelism=5, fail_fast=False)
+
+        self.assertEqual(['node{}'.format(i) for i in range(5)], [result.name for result in results])
+        self.assertEqual([True, True, True, False, True], [result.ok for result in results])
+        self.assertEqual(2, results[3].return_code)
+
+    #
+    def test_parallelism_bounds_concurrent_actions(self):
+        lock = threading.Lock()
+        running = {'now': 0, 'peak': 0}
+
+        #
+        def action(name, addr, user):
+            with lock:
+                running['now'] += 1
+                running['peak'] = max(running['peak'], running['now'])
+            time.sleep(0.05)
+            with lock:
+                running['now'] -= 1
+            return 0
+
+        fan_out(nodes(8), action, parallelism=3, fail_fast=False)
+        self.assertEqual(3, running['peak'])
+
+    #
+    def test_fail_fast_cancels_nodes_which_have_not_started(self):
+        started = []
+
+        #
+        def action(name, addr, user):
+            started.append(name)
+            if 'node0' == name:
+                raise SSHError('connection refused')
+            time.sleep(0.05)
+            return 0
+
+        results = fan_out(nodes(10), action, parallelism=1, fail_fast=True)
+
+        self.assertLess(len(started), 10)
+        self.assertEqual(len(started), len(results))
+        self.assertFalse(results[0].ok)
+        self.assertEqual('connection refused', results[0].error)
+
+    #
+    def test_any_runtime_error_fails_only_its_node(self):
+        #
+        def action(name, addr, user):
+            if 'node1' == name:
+                raise RuntimeError('no such instance')
+            return 0
+
+        results = fan_out(nodes(3), action, parallelism=3, fail_fast=False)
+        self.assertEqual([True, False, True], [result.ok for result in results])
+        self.assertEqual('no such instance', results[1].error)
+
+    #
+    def test_no_nodes_is_no_results(self):
+        self.assertEqual([], fan_out([], lambda name, addr, user: 0))
+
+
+#
+class FanOutCheckTest(unittest.TestCase):
+
+    #
+    def test_all_ok_returns_the_results(self):
+        results = [FanOutResult(name, addr, 0, 0.1) for name, addr, user in nodes(2)]
+        self.assertIs(results, fan_out_check(results, nodes(2), 'testing'))
+
+    #
+    def test_message_names_failed_and_skipped_nodes(self):
+        results = [FanOutResult('node0', '10.0.0.0', 1, 0.1)]
+
+        with self.assertRaises(SSHError) as raised:
+            fan_out_check(results, nodes(2), 'testing')
+        self.assertEqual("Failed while testing: failed on node(s) 'node0' and skipped node(s) 'node1'!", raised.exception.message)
+
+    #
+    def test_message_with_only_skipped_nodes(self):
+        with self.assertRaises(SSHError) as raised:
+            fan_out_check([], nodes(2), 'testing')
+        self.assertEqual("Failed while testing: skipped node(s) 'node0, node1'!", raised.exception.message)
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,131 @@
+"""
+Tests of the RunManifest: locked read-modify-write, atomic replace and inventory state.
+"""
+import os, json, shutil, logging, tempfile, unittest, multiprocessing
+
+from lib.python import utils
+from lib.python.utils import env_overlay
+from lib.python.utils.Manifest import RunManifest, manifest_path
+
+
+#
+def setUpModule():
+    utils.log.setLevel(logging.CRITICAL)
+
+
+#
+def increment(path, times):
+    manifest = RunManifest(path)
+    for i in range(times):
+        manifest.update(lambda data: data['values'].update(count=data['values'].get('count', 0) + 1))
+
+
+#
+class RunManifestTest(unittest.TestCase):
+
+    #
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp(prefix='manifest-test-')
+        self.path = os.path.join(self.workspace, 'run_manifest.test.json')
+        self.overlay = env_overlay({'RANCHER_MANIFEST': 'true'})
+        self.overlay.__enter__()
+
+    #
+    def tearDown(self):
+        self.overlay.__exit__(None, None, None)
+        shutil.rmtree(self.workspace, ignore_errors=True)
+
+    #
+    def test_values_round_trip_through_the_file(self):
+        RunManifest(self.path).set(project_id='1a5', reg_command='docker run')
+
+        manifest = RunManifest(self.path)
+        self.assertEqual('1a5', manifest.get('project_id'))
+        self.assertEqual('fallback', manifest.get('missing', 'fallback'))
+        with open(self.path, 'r') as f:
+            self.assertEqual('docker run', json.load(f)['values']['reg_command'])
+
+    #
+    def test_writes_leave_no_temporary_files(self):
+        manifest = RunManifest(self.path)
+        for i in range(5):
+            manifest.set(index=i)
+
+        leftovers = [name for name in os.listdir(self.workspace) if name.endswith('.tmp')]
+        self.assertEqual([], leftovers)
+
+    #
+    def test_a_failed_update_keeps_the_previous_file(self):
+        manifest = RunManifest(self.path)
+        manifest.set(project_id='1a5')
+
+        #
+        def broken(data):
+            data['values']['project_id'] = 'half-written'
+            raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            manifest.update(broken)
+        self.assertEqual('1a5', RunManifest(self.path).get('project_id'))
+
+    #
+    def test_unreadable_manifest_reads_as_empty(self):
+        with open(self.path, 'w') as f:
+            f.write('{not json')
+        self.assertIsNone(RunManifest(self.path).get('project_id'))
+
+    #
+    def test_updates_from_concurrent_processes_are_not_lost(self):
+        processes = [multiprocessing.Process(target=increment, args=(self.path, 25)) for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        self.assertEqual(100, RunManifest(self.path).get('count'))
+
+    #
+    def test_record_inventory_copies_the_callers_nodes(self):
+        nodes = {'server0': {'instance_id': 'i-1', 'public_ip': '1.2.3.4'}}
+        manifest = RunManifest(self.path)
+        manifest.record_inventory('us-west-2', 'bench-*', nodes)
+
+        self.assertNotIn('key_path', nodes['server0'])
+        self.assertIn('key_path', manifest.inventory('us-west-2', 'bench-*')['nodes']['server0'])
+        self.assertIsNone(manifest.inventory('us-west-2', 'other-*'))
+
+    #
+    def test_invalidate_inventory_keeps_the_nodes(self):
+        manifest = RunManifest(self.path)
+        manifest.record_inventory('us-west-2', 'bench-*', {'server0': {'instance_id': 'i-1'}})
+
+        self.assertTrue(manifest.invalidate_inventory())
+        self.assertFalse(manifest.invalidate_inventory())
+        entry = manifest.inventory('us-west-2', 'bench-*')
+        self.assertEqual(0, entry['validated'])
+        self.assertEqual(['server0'], list(entry['nodes'].keys()))
+
+    #
+    def test_disabled_manifest_neither_reads_nor_writes(self):
+        with env_overlay({'RANCHER_MANIFEST': 'false'}):
+            manifest = RunManifest(self.path)
+            self.assertIsNone(manifest.set(project_id='1a5'))
+            self.assertIsNone(manifest.get('project_id'))
+        self.assertFalse(os.path.exists(self.path))
+
+
+#
+class ManifestPathTest(unittest.TestCase):
+
+    #
+    def test_path_is_keyed_on_build_then_prefix(self):
+        with env_overlay({'WORKSPACE_DIR': '/ws', 'BUILD_NUMBER': '42', 'AWS_PREFIX': 'qa'}):
+            self.assertEqual('/ws/run_manifest.42.json', manifest_path())
+        with env_overlay({'WORKSPACE_DIR': '/ws', 'BUILD_NUMBER': '', 'AWS_PREFIX': 'qa'}):
+            self.assertEqual('/ws/run_manifest.qa.json', manifest_path())
+        with env_overlay({'WORKSPACE_DIR': '/ws', 'BUILD_NUMBER': '', 'AWS_PREFIX': ''}):
+            self.assertEqual('/ws/run_manifest.json', manifest_path())
+
+
+if '__main__' == __name__:
+    unittest.main()
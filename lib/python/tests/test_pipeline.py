@@ -0,0 +1,104 @@
+"""
+Tests of Pipeline ordering, skipping after failures and the critical path.
+"""
+import time, logging, threading, unittest
+
+from lib.python import utils
+from lib.python.utils.Pipeline import Pipeline, PipelineError
+
+
+#
+def setUpModule():
+    utils.log.setLevel(logging.CRITICAL)
+
+
+#
+class PipelineTest(unittest.TestCase):
+
+    #
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.order = []
+
+    #
+    def step(self, name, seconds=0.0, error=None):
+        #
+        def fn():
+            time.sleep(seconds)
+            with self.lock:
+                self.order.append(name)
+            if None is not error:
+                raise error
+        return fn
+
+    #
+    def test_add_rejects_duplicate_and_unknown_steps(self):
+        dag = Pipeline('test')
+        dag.add('a', self.step('a'))
+
+        with self.assertRaises(PipelineError):
+            dag.add('a', self.step('a'))
+        with self.assertRaises(PipelineError):
+            dag.add('b', self.step('b'), ['missing'])
+
+    #
+    def test_steps_run_after_their_dependencies(self):
+        dag = Pipeline('test')
+        dag.add('provision', self.step('provision', 0.05))
+        dag.add('launch', self.step('launch'))
+        dag.add('configure', self.step('configure'), ['provision'])
+        dag.add('register', self.step('register'), ['configure', 'launch'])
+
+        self.assertTrue(dag.run())
+        self.assertLess(self.order.index('provision'), self.order.index('configure'))
+        self.assertLess(self.order.index('configure'), self.order.index('register'))
+        self.assertLess(self.order.index('launch'), self.order.index('register'))
+        self.assertEqual(['done'] * 4, [step.state for step in dag.steps()])
+
+    #
+    def test_independent_steps_overlap(self):
+        dag = Pipeline('test')
+        dag.add('a', self.step('a', 0.2))
+        dag.add('b', self.step('b', 0.2))
+
+        start = time.time()
+        dag.run()
+        self.assertLess(time.time() - start, 0.35)
+
+    #
+    def test_failure_skips_dependents_transitively_but_not_unrelated_steps(self):
+        dag = Pipeline('test')
+        dag.add('provision', self.step('provision', error=RuntimeError('no capacity')))
+        dag.add('configure', self.step('configure'), ['provision'])
+        dag.add('register', self.step('register'), ['configure'])
+        dag.add('launch', self.step('launch', 0.05))
+
+        with self.assertRaises(PipelineError) as raised:
+            dag.run()
+
+        states = dict([(step.name, step.state) for step in dag.steps()])
+        self.assertEqual({'provision': 'failed', 'configure': 'skipped', 'register': 'skipped', 'launch': 'done'}, states)
+        self.assertEqual(['launch', 'provision'], sorted(self.order))
+        self.assertIn('no capacity', raised.exception.message)
+        self.assertIn('register', raised.exception.message)
+
+    #
+    def test_critical_path_follows_the_dependency_which_finished_last(self):
+        dag = Pipeline('test')
+        dag.add('provision', self.step('provision', 0.1))
+        dag.add('launch', self.step('launch'))
+        dag.add('configure', self.step('configure'), ['provision'])
+        dag.add('register', self.step('register'), ['configure', 'launch'])
+        dag.run()
+
+        self.assertEqual(['provision', 'configure', 'register'], [step.name for step in dag.critical_path()])
+
+    #
+    def test_critical_path_of_a_pipeline_which_never_ran_is_empty(self):
+        dag = Pipeline('test')
+        dag.add('a', self.step('a'))
+        self.assertEqual([], dag.critical_path())
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,168 @@
+import time
+
+from boto3.exceptions import Boto3Error
+from botocore.exceptions import ClientError, WaiterError
+
+from .. import log_debug, log_info, log_warn, os_to_settings, aws_client, aws_get_region, env
+from .. import ec2_nodes_ensure, ec2_node_public_ip, ec2_node_terminate
+from .. import ec2_baked_ami, ec2_baked_ami_tags, ec2_baked_ami_invalidate
+from ..SSH import SSH, SSHError
+from ..Bootstrap import Bootstrap, BootstrapError
+from ..Trace import trace_span
+
+
+#
+class AMIError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(AMIError, self).__init__(self.message)
+
+
+#
+class AMIBaker(object):
+    """
+    Build a private AMI with the bootstrap already applied.
+
+    One image is baked per operating system, Docker version, native Docker
+    and SELinux flag, taken from the same envvars as provisioning. A builder
+    node is launched from the stock image, bootstrapped, imaged and then
+    terminated. Nodes launched later with matching settings use the image and
+    skip the bootstrap.
+    """
+
+    #
+    def __validate_envvars(self):
+        required_envvars = ['AWS_ACCESS_KEY_ID',
+                            'AWS_SECRET_ACCESS_KEY',
+                            'AWS_DEFAULT_REGION',
+                            'AWS_TAGS',
+                            'AWS_SUBNET_ID',
+                            'AWS_SECURITY_GROUP_ID',
+                            'AWS_ZONE',
+                            'AWS_INSTANCE_PROFILE',
+                            'RANCHER_SERVER_OPERATINGSYSTEM',
+                            'RANCHER_DOCKER_VERSION']
+
+        missing = [envvar for envvar in required_envvars if envvar not in env()]
+        if 0 != len(missing):
+            for envvar in missing:
+                log_debug("Missing envvar '{}'!", envvar)
+            raise AMIError("The following environment variables are required: {}".format(', '.join(missing)))
+
+    #
+    def __init__(self):
+        self.__validate_envvars()
+
+    #
+    def os_name(self):
+        return str(env()['RANCHER_SERVER_OPERATINGSYSTEM']).rstrip()
+
+    #
+    def name(self):
+        n = ''
+        prefix = env().get('AWS_PREFIX')
+        docker_version = env()['RANCHER_DOCKER_VERSION'].replace('.', '').replace('~', '')
+
+        if None is not prefix:
+            prefix = prefix.replace('.', '-')
+            n = "{}-".format(prefix)
+
+        n += "ami-bake-d{}-{}".format(docker_version, self.os_name())
+
+        return n.rstrip()
+
+    #
+    def image_name(self, tags):
+        values = dict([(tag['Key'], tag['Value']) for tag in tags])
+        return "rancher-ci-{}-docker-{}-native-{}-selinux-{}-{}-{}".format(
+            self.os_name(),
+            values['rancher.docker.version'].replace('~', '-'),
+            values['rancher.docker.native'],
+            values['rancher.docker.rhel.selinux'],
+            values['rancher.ci.bootstrap'],
+            time.strftime('%Y%m%d%H%M%S', time.gmtime()))
+
+    #
+    def bake(self, force=False):
+        base_ami = os_to_settings(self.os_name())['ami-id']
+
+        if not force:
+            image_id = ec2_baked_ami(self.os_name(), base_ami, refresh=True)
+            if None is not image_id:
+                log_info("Baked image '{}' already matches '{}'. Nothing to do.", image_id, self.os_name())
+                return image_id
+
+        tags = ec2_baked_ami_tags(self.os_name(), base_ami)
+        instance_id = None
+
+        try:
+            with trace_span('ami.builder', node=self.name()):
+                instance_id = ec2_nodes_ensure([self.name()], instance_type=env().get('RANCHER_AMI_BAKE_INSTANCE_TYPE', 'm4.large'),
+                                               baked=False, operatingsystem=self.os_name())[self.name()]
+
+            with trace_span('ami.bootstrap', node=self.name()):
+                self.__bootstrap()
+
+            with trace_span('ami.image', node=self.name()):
+                image_id = self.__image(instance_id, tags)
+
+        except (RuntimeError, Boto3Error, ClientError, WaiterError) as e:
+            msg = "Failed while baking image for '{}'!: {}".format(self.os_name(), str(e))
+            log_debug(msg)
+            raise AMIError(msg) from e
+
+        finally:
+            if None is not instance_id:
+                try:
+                    ec2_node_terminate(self.name(), region=aws_get_region())
+                except RuntimeError as e:
+                    log_warn("Failed to terminate image builder '{}'. Please remove it by hand!: {}", self.name(), str(e))
+
+        ec2_baked_ami_invalidate()
+        log_info("Baked image '{}' for '{}'.", image_id, self.os_name())
+        return image_id
+
+    #
+    def __bootstrap(self):
+        ssh_user = os_to_settings(self.os_name())['ssh_username']
+        addr = ec2_node_public_ip(self.name(), region=aws_get_region())
+
+        try:
+            Bootstrap().run(self.name(), addr, ssh_user)
+
+            # make sure Docker is really there, then drop only the builder's own key. cloud-init installs
+            # the key of whichever node is later launched from the image, and the CI keys added by the
+            # bootstrap have to stay.
+            with open('.ssh/{}.pub'.format(self.name()), 'r') as f:
+                builder_key = f.read().split()[1]
+
+            sshcmd = "sudo docker version" \
+                     " && (grep -vF '{}' ~/.ssh/authorized_keys || true) > ~/.ssh/authorized_keys.baked" \
+                     " && mv -f ~/.ssh/authorized_keys.baked ~/.ssh/authorized_keys" \
+                     " && chmod 0600 ~/.ssh/authorized_keys".format(builder_key)
+            SSH(self.name(), addr, ssh_user, sshcmd, max_attempts=2)
+
+        except (SSHError, BootstrapError, IOError, OSError, IndexError) as e:
+            msg = "Failed while bootstrapping image builder '{}'!: {}".format(self.name(), str(e))
+            log_debug(msg)
+            raise AMIError(msg) from e
+
+    #
+    def __image(self, instance_id, tags):
+        ec2 = aws_client('ec2', region=aws_get_region())
+        image_name = self.image_name(tags)
+
+        log_info("Creating image '{}' from '{}'...", image_name, instance_id)
+
+        # letting EC2 reboot the builder gives a consistent filesystem in the image
+        image_id = ec2.create_image(InstanceId=instance_id,
+                                    Name=image_name,
+                                    Description="rancher CI bootstrap baked onto {}".format(self.os_name()))['ImageId']
+        ec2.create_tags(Resources=[image_id], Tags=tags)
+
+        log_info("Waiting for image '{}' to become available...", image_id)
+        ec2.get_waiter('image_available').wait(ImageIds=[image_id], WaiterConfig={'Delay': 15, 'MaxAttempts': 160})
+
+        return image_id
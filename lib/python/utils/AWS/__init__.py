@@ -1,6 +1,4 @@
-import os
-
-from .. import log_debug
+from .. import log_debug, env
 
 
 class AWSError(RuntimeError):
@@ -20,8 +18,8 @@ class AWS(object):
         result = True
         missing = []
         for envvar in required_envvars:
-            if envvar not in os.environ:
-                log_debug("Missing envvar \'{}\'!".format(envvar))
+            if envvar not in env():
+                log_debug("Missing envvar \'{}\'!", envvar)
                 missing.append(envvar)
                 result = False
         if False is result:
@@ -0,0 +1,241 @@
+import os, sys, json, time, fcntl, atexit, threading
+
+from .. import log_debug, log_info, env, aws_cache, aws_cache_lock, aws_session_hooks
+
+
+# error codes AWS uses when an account is being rate limited
+AWS_THROTTLE_CODES = ['RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'RequestThrottled',
+                      'TooManyRequestsException', 'SlowDown']
+
+# shared plumbing; calls are charged to whichever helper went through it
+AWS_PLUMBING = ['aws_session', 'aws_client', 'aws_resource', 'ec2_inventory', 'ec2_inventory_seed', 'ec2_inventory_lookup']
+
+LIB_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+#
+class AWSStatsError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(AWSStatsError, self).__init__(self.message)
+
+
+#
+def aws_stats_enabled():
+    return 'false' != str(env().get('RANCHER_AWS_STATS', 'true')).rstrip()
+
+
+#
+def aws_stats_path():
+    workspace = str(env().get('WORKSPACE_DIR', os.getcwd())).rstrip()
+    if env().get('BUILD_NUMBER'):
+        return "{}/aws_stats.{}.json".format(workspace, str(env()['BUILD_NUMBER']).rstrip())
+    return "{}/aws_stats.json".format(workspace)
+
+
+#
+def aws_stats_caller(frame):
+    while None is not frame:
+        code = frame.f_code
+        if code.co_filename.startswith(LIB_DIR) and code.co_filename != __file__ \
+           and code.co_name not in AWS_PLUMBING:
+            owner = frame.f_locals.get('self')
+            if None is not owner:
+                return '{}.{}'.format(type(owner).__name__, code.co_name)
+            return code.co_name
+        frame = frame.f_back
+
+    return 'unknown'
+
+
+#
+def aws_stats_error_code(parsed):
+    if not isinstance(parsed, dict):
+        return None
+    return parsed.get('Error', {}).get('Code')
+
+
+#
+class AWSStats(object):
+    """
+    Count AWS API calls per (helper, service, operation) via botocore events.
+
+    Every client made from the shared Session is instrumented. For each
+    operation we record calls, errors, retries, throttled attempts and latency,
+    charged to the repo function which made the call. At exit the totals are
+    logged as a table and appended to the JSON stats file of the build each
+    call was made for, so matrix cells each get their own.
+    """
+
+    #
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__stats = {}
+        self.__started = time.time()
+        self.__registered = False
+
+    #
+    def install(self, session):
+        if not aws_stats_enabled():
+            return False
+
+        log_debug('Registering AWS API call accounting on boto3 session...')
+        session.events.register('before-call', self.before_call, unique_id='rancher-aws-stats-before')
+        session.events.register('needs-retry', self.needs_retry, unique_id='rancher-aws-stats-retry')
+        session.events.register('after-call', self.after_call, unique_id='rancher-aws-stats-after')
+
+        with self.__lock:
+            if not self.__registered:
+                atexit.register(self.flush)
+                self.__registered = True
+
+        return True
+
+    #
+    def __entry(self, helper, model):
+        stats = self.__stats.setdefault(aws_stats_path(), {})
+        key = (helper, model.service_model.service_name, model.name)
+        entry = stats.get(key)
+        if None is entry:
+            entry = {'calls': 0, 'errors': 0, 'retries': 0, 'throttles': 0, 'latency': 0.0, 'latency_max': 0.0}
+            stats[key] = entry
+        return entry
+
+    #
+    def before_call(self, model=None, context=None, **kwargs):
+        if None is not context:
+            context['aws_stats_helper'] = aws_stats_caller(sys._getframe(1))
+            context['aws_stats_start'] = time.time()
+
+    #
+    def needs_retry(self, response=None, operation=None, request_dict=None, **kwargs):
+        if None is response or None is operation:
+            return None
+
+        if aws_stats_error_code(response[1]) in AWS_THROTTLE_CODES:
+            context = (request_dict or {}).get('context', {})
+            helper = context.get('aws_stats_helper') or aws_stats_caller(sys._getframe(1))
+            with self.__lock:
+                self.__entry(helper, operation)['throttles'] += 1
+
+        return None
+
+    #
+    def after_call(self, http_response=None, parsed=None, model=None, context=None, **kwargs):
+        context = context or {}
+        helper = context.get('aws_stats_helper') or aws_stats_caller(sys._getframe(1))
+        latency = time.time() - context.get('aws_stats_start', time.time())
+        metadata = parsed.get('ResponseMetadata', {}) if isinstance(parsed, dict) else {}
+        status = metadata.get('HTTPStatusCode') or getattr(http_response, 'status_code', 200)
+
+        with self.__lock:
+            entry = self.__entry(helper, model)
+            entry['calls'] += 1
+            entry['retries'] += metadata.get('RetryAttempts', 0)
+            entry['latency'] += latency
+            entry['latency_max'] = max(entry['latency_max'], latency)
+            if 300 <= status:
+                entry['errors'] += 1
+
+    #
+    def snapshot(self, path=None):
+        with self.__lock:
+            rows = []
+            for stats_path, stats in self.__stats.items():
+                if None is not path and path != stats_path:
+                    continue
+                for (helper, service, operation), entry in stats.items():
+                    row = {'helper': helper, 'service': service, 'operation': operation}
+                    row.update(entry)
+                    rows.append(row)
+
+        return sorted(rows, key=lambda row: (-row['calls'], row['helper'], row['operation']))
+
+    #
+    def reset(self):
+        with self.__lock:
+            self.__stats = {}
+            self.__started = time.time()
+
+    #
+    def table(self, rows):
+        lines = ['{:<48} {:<28} {:>6} {:>6} {:>7} {:>9} {:>8} {:>8}'.format(
+            'helper', 'operation', 'calls', 'errors', 'retries', 'throttles', 'avg ms', 'max ms')]
+
+        for row in rows:
+            lines.append('{:<48} {:<28} {:>6} {:>6} {:>7} {:>9} {:>8.0f} {:>8.0f}'.format(
+                row['helper'], '{}.{}'.format(row['service'], row['operation']),
+                row['calls'], row['errors'], row['retries'], row['throttles'],
+                1000 * row['latency'] / max(1, row['calls']), 1000 * row['latency_max']))
+
+        lines.append('{:<77} {:>6} {:>6} {:>7} {:>9}'.format(
+            'total', sum([row['calls'] for row in rows]), sum([row['errors'] for row in rows]),
+            sum([row['retries'] for row in rows]), sum([row['throttles'] for row in rows])))
+
+        return '\n'.join(lines)
+
+    #
+    def flush(self, path=None):
+        # an explicit path takes every call regardless of the build it was made for
+        if None is not path:
+            groups = {path: self.snapshot()}
+        else:
+            with self.__lock:
+                paths = sorted(self.__stats.keys())
+            groups = dict([(stats_path, self.snapshot(stats_path)) for stats_path in paths])
+
+        written = False
+        for stats_path in sorted(groups.keys()):
+            if 0 != len(groups[stats_path]):
+                written = self.__write(stats_path, groups[stats_path]) or written
+
+        self.reset()
+        return written
+
+    #
+    def __write(self, path, rows):
+        log_info("AWS API calls made by '{}':\n{}", ' '.join(sys.argv[1:]), self.table(rows))
+
+        run = {
+            'task': ' '.join(sys.argv[1:]),
+            'pid': os.getpid(),
+            'started': self.__started,
+            'finished': time.time(),
+            'operations': rows
+        }
+
+        try:
+            # several invoke processes may append to the same build stats
+            with open('{}.lock'.format(path), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+                stats = {'runs': []}
+                if os.path.isfile(path):
+                    with open(path, 'r') as f:
+                        stats = json.load(f)
+                stats['runs'].append(run)
+
+                tmppath = '{}.{}.tmp'.format(path, os.getpid())
+                with open(tmppath, 'w') as f:
+                    json.dump(stats, f, indent=2, sort_keys=True)
+                os.replace(tmppath, path)
+
+        except (IOError, OSError, ValueError) as e:
+            msg = "Failed while writing AWS stats file '{}'!: {}".format(path, str(e))
+            log_debug(msg)
+            raise AWSStatsError(msg) from e
+
+        log_info("Wrote AWS API call stats to '{}'.", path)
+        return True
+
+
+#
+aws_stats = AWSStats()
+aws_session_hooks.append(aws_stats.install)
+
+# a Session made before this module was imported would otherwise go uncounted
+with aws_cache_lock:
+    if None is not aws_cache['session']:
+        aws_stats.install(aws_cache['session'])
@@ -0,0 +1,156 @@
+import os, io, glob, gzip, hashlib, tarfile, threading
+
+from .. import log_debug, log_info, env
+from ..SSH import SSH, SCP, SSHError
+from ..Trace import trace_span
+
+
+#
+class BootstrapError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(BootstrapError, self).__init__(self.message)
+
+
+#
+bundle_lock = threading.Lock()
+bundle_cache = {}
+
+
+#
+def bootstrap_src():
+    # lib/bash next to this package, wherever invoke was started from
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'bash', '*.sh'))
+
+
+#
+def bootstrap_outdir():
+    return os.path.join(str(env().get('WORKSPACE_DIR', os.getcwd())).rstrip(), '.bundle')
+
+
+#
+def bootstrap_bundle(src=None, outdir=None):
+    """
+    Pack the bootstrap scripts into a compressed archive named by its content hash.
+
+    The archive is built once per process. Member metadata is normalized so the
+    same scripts always produce the same hash.
+
+    Args:
+      src (str): glob of files to bundle, defaults to the repo's lib/bash/*.sh
+      outdir (str): local directory to write the archive to, defaults to .bundle in the workspace
+
+    Returns:
+      dict: 'hash', 'filename' and local 'path' of the archive
+    """
+    if None is src:
+        src = bootstrap_src()
+    if None is outdir:
+        outdir = bootstrap_outdir()
+
+    with bundle_lock:
+        if src in bundle_cache:
+            return bundle_cache[src]
+
+        paths = sorted(glob.glob(src))
+        if 0 == len(paths):
+            msg = "No bootstrap files match '{}'!".format(src)
+            log_debug(msg)
+            raise BootstrapError(msg)
+
+        digest = hashlib.sha256()
+        members = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                content = f.read()
+            mode = os.stat(path).st_mode & 0o777
+            digest.update('{}:{}:{}\n'.format(os.path.basename(path), mode, len(content)).encode('utf-8'))
+            digest.update(content)
+            members.append((os.path.basename(path), mode, content))
+
+        bundle_hash = digest.hexdigest()[:16]
+        filename = 'rancher-ci-bootstrap-{}.tar.gz'.format(bundle_hash)
+        path = os.path.join(outdir, filename)
+
+        if not os.path.isfile(path):
+            log_info("Bundling {} bootstrap file(s) into '{}'...", len(members), path)
+            os.makedirs(outdir, exist_ok=True)
+
+            tmppath = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmppath, 'wb') as raw:
+                with gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0) as gz:
+                    with tarfile.open(fileobj=gz, mode='w') as tar:
+                        for name, mode, content in members:
+                            info = tarfile.TarInfo(name)
+                            info.size = len(content)
+                            info.mode = mode
+                            info.mtime = 0
+                            tar.addfile(info, io.BytesIO(content))
+            os.replace(tmppath, path)
+
+        bundle_cache[src] = {'hash': bundle_hash, 'filename': filename, 'path': path}
+        log_debug("bootstrap bundle: {}", bundle_cache[src])
+
+        return bundle_cache[src]
+
+
+#
+class Bootstrap(object):
+
+    bundle = None
+    remote_dir = None
+
+    #
+    def __init__(self, src=None, remote_dir='/tmp'):
+        self.bundle = bootstrap_bundle(src)
+        self.remote_dir = remote_dir
+
+    #
+    def __marker(self):
+        return '{}/.rancher-ci-bootstrap.{}'.format(self.remote_dir, self.bundle['hash'])
+
+    #
+    def ensure(self, key, addr, user, tag=None):
+        with trace_span('bootstrap.upload', node=key, bundle=self.bundle['hash']):
+            return self.__ensure(key, addr, user, tag)
+
+    #
+    def __ensure(self, key, addr, user, tag):
+        try:
+            sshcmd = "test -f {} && echo bundle-present || echo bundle-missing".format(self.__marker())
+            if 'bundle-present' in SSH(key, addr, user, sshcmd, tag=tag).stdout:
+                log_info("Node '{}' already has bootstrap bundle '{}'. Skipping upload.", addr, self.bundle['hash'])
+                return False
+
+            log_info("Uploading bootstrap bundle '{}' to '{}'...", self.bundle['hash'], addr)
+            SCP(key, addr, user, self.bundle['path'], '/tmp/')
+
+            remote_bundle = '/tmp/{}'.format(self.bundle['filename'])
+            sshcmd = "mkdir -p {0} && tar xzf {1} -C {0} && rm -f {1} && touch {2}".format(
+                self.remote_dir, remote_bundle, self.__marker())
+            SSH(key, addr, user, sshcmd, tag=tag)
+
+        except SSHError as e:
+            msg = "Failed while uploading bootstrap bundle to '{}'!: {}".format(addr, str(e))
+            log_debug(msg)
+            raise BootstrapError(msg) from e
+
+        return True
+
+    #
+    def run(self, key, addr, user, tag=None, max_attempts=10):
+        self.ensure(key, addr, user, tag)
+
+        try:
+            sshcmd = '{}/rancher_ci_bootstrap.sh'.format(self.remote_dir)
+            with trace_span('bootstrap.run', node=key):
+                result = SSH(key, addr, user, sshcmd, max_attempts=max_attempts, tag=tag)
+
+        except SSHError as e:
+            msg = "Failed while running bootstrap on '{}'!: {}".format(addr, str(e))
+            log_debug(msg)
+            raise BootstrapError(msg) from e
+
+        return result.return_code
@@ -0,0 +1,183 @@
+import os, json, time, fcntl, threading
+
+from .. import log_debug, env
+
+
+#
+class ManifestError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(ManifestError, self).__init__(self.message)
+
+
+#
+def manifest_enabled():
+    return 'false' != str(env().get('RANCHER_MANIFEST', 'true')).rstrip()
+
+
+#
+def manifest_path():
+    workspace = str(env().get('WORKSPACE_DIR', os.getcwd())).rstrip()
+    if env().get('BUILD_NUMBER'):
+        return "{}/run_manifest.{}.json".format(workspace, str(env()['BUILD_NUMBER']).rstrip())
+
+    # outside of Jenkins, runs with different node names must not share state
+    if env().get('AWS_PREFIX'):
+        return "{}/run_manifest.{}.json".format(workspace, str(env()['AWS_PREFIX']).rstrip().replace('/', '-'))
+    return "{}/run_manifest.json".format(workspace)
+
+
+#
+class RunManifest(object):
+    """
+    Run state shared by the invoke tasks of one build, kept as JSON in the workspace.
+
+    Every Jenkins stage is a fresh invoke process. Whatever one stage learned
+    about the run (instances and their addresses, ssh key paths, project id,
+    registration command) is written here so later stages read it back rather
+    than asking AWS or the Rancher API again. Writes are read-modify-write
+    under a file lock and land with an atomic rename.
+    """
+
+    #
+    def __init__(self, path=None):
+        self.__path = path
+        self.__lock = threading.RLock()
+        self.__cache = {}
+
+    #
+    def path(self):
+        if None is not self.__path:
+            return self.__path
+        return manifest_path()
+
+    #
+    def __empty(self):
+        return {'version': 1, 'build': env().get('BUILD_NUMBER'), 'values': {}, 'inventory': {}}
+
+    #
+    def __read(self):
+        path = self.path()
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return self.__empty()
+
+        # another process may have written since we last looked
+        cached = self.__cache.get(path)
+        if None is not cached and mtime == cached[0]:
+            return cached[1]
+
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            log_debug("Ignoring unreadable run manifest '{}': {}", path, str(e))
+            return self.__empty()
+
+        if 1 != data.get('version'):
+            return self.__empty()
+
+        self.__cache[path] = (mtime, data)
+        return data
+
+    #
+    def load(self):
+        if not manifest_enabled():
+            return self.__empty()
+
+        with self.__lock:
+            return self.__read()
+
+    #
+    def update(self, fn):
+        """
+        Apply fn to the manifest data and write the result.
+
+        Args:
+          fn (callable): called with the data dict, which it changes in place
+
+        Returns:
+          dict: the data as written
+        """
+        if not manifest_enabled():
+            return None
+
+        path = self.path()
+        with self.__lock:
+            try:
+                with open('{}.lock'.format(path), 'w') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+
+                    self.__cache.pop(path, None)
+                    data = self.__read()
+                    fn(data)
+                    data['updated'] = time.time()
+
+                    tmppath = '{}.{}.tmp'.format(path, os.getpid())
+                    with open(tmppath, 'w') as f:
+                        json.dump(data, f, indent=2, sort_keys=True)
+                    os.replace(tmppath, path)
+
+                    self.__cache[path] = (os.stat(path).st_mtime, data)
+
+            except (IOError, OSError) as e:
+                msg = "Failed while writing run manifest '{}'!: {}".format(path, str(e))
+                log_debug(msg)
+                raise ManifestError(msg) from e
+
+        return data
+
+    #
+    def get(self, key, default=None):
+        value = self.load()['values'].get(key)
+        if None is value:
+            return default
+        return value
+
+    #
+    def set(self, **values):
+        def apply(data):
+            data['values'].update(values)
+        return self.update(apply)
+
+    #
+    def inventory(self, region, pattern):
+        entry = self.load()['inventory'].get(region)
+        if None is entry or pattern != entry.get('pattern'):
+            return None
+        return entry
+
+    #
+    def record_inventory(self, region, pattern, nodes, validated=None):
+        if None is validated:
+            validated = time.time()
+
+        # the caller's dicts are its inventory cache; leave them as they are
+        nodes = dict([(name, dict(node)) for name, node in nodes.items()])
+        for name, node in nodes.items():
+            keypath = '.ssh/{}'.format(name)
+            node['key_path'] = os.path.abspath(keypath) if os.path.isfile(keypath) else None
+
+        def apply(data):
+            data['inventory'][region] = {'pattern': pattern, 'validated': validated, 'nodes': nodes}
+        return self.update(apply)
+
+    #
+    def invalidate_inventory(self):
+        # nodes are kept as the list to revalidate, only their freshness is dropped
+        stale = [entry for entry in self.load()['inventory'].values() if 0 != entry.get('validated')]
+        if 0 == len(stale):
+            return False
+
+        def apply(data):
+            for entry in data['inventory'].values():
+                entry['validated'] = 0
+        self.update(apply)
+        return True
+
+
+#
+run_manifest = RunManifest()
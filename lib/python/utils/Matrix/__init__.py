@@ -0,0 +1,334 @@
+import os, json, time, yaml, itertools, threading
+
+from .. import log_debug, log_info, log_warn, env, env_overlay, EnvThreadPoolExecutor
+from ..RancherServer import RancherServer
+from ..RancherAgents import RancherAgents
+from ..Pipeline import Pipeline, PipelineError
+from ..Trace import trace_span
+
+
+#
+class MatrixError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(MatrixError, self).__init__(self.message)
+
+
+#
+def matrix_max_vcpus():
+    return int(str(env().get('RANCHER_MATRIX_MAX_VCPUS', 64)).rstrip())
+
+
+#
+def matrix_max_instances():
+    return int(str(env().get('RANCHER_MATRIX_MAX_INSTANCES', 20)).rstrip())
+
+
+#
+def matrix_results_path():
+    workspace = str(env().get('WORKSPACE_DIR', os.getcwd())).rstrip()
+    if env().get('BUILD_NUMBER'):
+        return "{}/matrix.{}.json".format(workspace, str(env()['BUILD_NUMBER']).rstrip())
+    return "{}/matrix.json".format(workspace)
+
+
+#
+def matrix_load(path):
+    """
+    Read the cells of a matrix from YAML.
+
+    'axes' maps envvar names to lists of values and yields one cell per
+    combination of them. A value may instead be a mapping of several envvars
+    which always go together, e.g. server and agent OS; the axis name is then
+    only a label. 'cells' lists further cells as they are. 'exclude' drops any
+    cell containing all of the values of one of its entries.
+
+    Args:
+      path (str): path to the matrix file
+
+    Returns:
+      list: one dict of envvar overrides per cell
+    """
+    try:
+        with open(path, 'r') as f:
+            spec = yaml.safe_load(f) or {}
+    except (IOError, OSError, yaml.YAMLError) as e:
+        msg = "Failed while loading matrix '{}'!: {}".format(path, str(e))
+        log_debug(msg)
+        raise MatrixError(msg) from e
+
+    cells = []
+    axes = spec.get('axes') or {}
+    names = sorted(axes.keys())
+    for values in itertools.product(*[axes[name] for name in names]):
+        cell = {}
+        for name, value in zip(names, values):
+            if isinstance(value, dict):
+                cell.update(dict([(k, str(v)) for k, v in value.items()]))
+            else:
+                cell[name] = str(value)
+        cells.append(cell)
+
+    for cell in spec.get('cells') or []:
+        cells.append(dict([(name, str(value)) for name, value in cell.items()]))
+
+    excludes = [dict([(name, str(value)) for name, value in exclude.items()]) for exclude in spec.get('exclude') or []]
+    cells = [cell for cell in cells if not any([all([cell.get(k) == v for k, v in exclude.items()]) for exclude in excludes])]
+
+    if 0 == len(cells):
+        msg = "Matrix '{}' has no cells!".format(path)
+        log_debug(msg)
+        raise MatrixError(msg)
+
+    return cells
+
+
+#
+# default vCPUs per instance type; the pinned botocore predates DescribeInstanceTypes
+INSTANCE_VCPUS = {
+    't2.micro': 1, 't2.small': 1, 't2.medium': 2, 't2.large': 2, 't2.xlarge': 4, 't2.2xlarge': 8,
+    'm4.large': 2, 'm4.xlarge': 4, 'm4.2xlarge': 8, 'm4.4xlarge': 16, 'm4.10xlarge': 40, 'm4.16xlarge': 64,
+    'm5.large': 2, 'm5.xlarge': 4, 'm5.2xlarge': 8, 'm5.4xlarge': 16, 'm5.12xlarge': 48, 'm5.24xlarge': 96,
+    'c4.large': 2, 'c4.xlarge': 4, 'c4.2xlarge': 8, 'c4.4xlarge': 16, 'c4.8xlarge': 36,
+    'c5.large': 2, 'c5.xlarge': 4, 'c5.2xlarge': 8, 'c5.4xlarge': 16, 'c5.9xlarge': 36, 'c5.18xlarge': 72,
+    'r4.large': 2, 'r4.xlarge': 4, 'r4.2xlarge': 8, 'r4.4xlarge': 16, 'r4.8xlarge': 32, 'r4.16xlarge': 64,
+}
+
+
+#
+def instance_vcpus(instance_types):
+    missing = sorted(set([t for t in instance_types if t not in INSTANCE_VCPUS]))
+    if 0 != len(missing):
+        msg = "Unknown vCPUs for instance type(s) '{}'! Add them to INSTANCE_VCPUS.".format(', '.join(missing))
+        log_debug(msg)
+        raise MatrixError(msg)
+
+    return dict([(t, INSTANCE_VCPUS[t]) for t in instance_types])
+
+
+#
+class MatrixCell(object):
+
+    index = None
+    values = None
+    config = None
+    state = None
+    error = None
+    queued = None
+    start = None
+    end = None
+    critical_path = None
+
+    #
+    def __init__(self, index, values):
+        self.index = index
+        self.values = dict(values)
+        self.state = 'pending'
+        self.critical_path = []
+
+        # each cell gets its own node names, manifest and result files
+        build = str(env().get('BUILD_NUMBER', 'matrix')).rstrip()
+        prefix = env().get('AWS_PREFIX')
+        self.config = dict(self.values)
+        self.config['BUILD_NUMBER'] = '{}-m{}'.format(build, index)
+        self.config['AWS_PREFIX'] = 'm{}'.format(index) if None is prefix else '{}-m{}'.format(str(prefix).rstrip(), index)
+
+    #
+    @property
+    def name(self):
+        return ' '.join(['{}={}'.format(k, self.values[k]) for k in sorted(self.values.keys())])
+
+    #
+    @property
+    def elapsed(self):
+        if None is self.start or None is self.end:
+            return 0.0
+        return self.end - self.start
+
+
+#
+class MatrixAdmission(object):
+    """
+    Hold cells back until their instances and vCPUs fit under the matrix quotas.
+    """
+
+    #
+    def __init__(self, max_vcpus, max_instances):
+        self.max_vcpus = max_vcpus
+        self.max_instances = max_instances
+        self.__vcpus = 0
+        self.__instances = 0
+        self.__cond = threading.Condition()
+
+    #
+    def fits(self, vcpus, instances):
+        return vcpus <= self.max_vcpus and instances <= self.max_instances
+
+    #
+    def acquire(self, vcpus, instances):
+        with self.__cond:
+            while self.__vcpus + vcpus > self.max_vcpus or self.__instances + instances > self.max_instances:
+                self.__cond.wait()
+            self.__vcpus += vcpus
+            self.__instances += instances
+
+        return True
+
+    #
+    def release(self, vcpus, instances):
+        with self.__cond:
+            self.__vcpus -= vcpus
+            self.__instances -= instances
+            self.__cond.notify_all()
+
+        return True
+
+
+#
+class Matrix(object):
+    """
+    Run the server and agent lifecycle of many combinations at once from one process.
+
+    Every cell runs in its own thread under an env() overlay with its values,
+    so nothing touches os.environ. A cell is admitted once its instances and
+    vCPUs fit under RANCHER_MATRIX_MAX_INSTANCES and RANCHER_MATRIX_MAX_VCPUS
+    next to the cells already running. Its nodes are deprovisioned when it is
+    done unless the matrix is kept. Results are reported per cell.
+    """
+
+    #
+    def __init__(self, cells, keep=False):
+        self.cells = [MatrixCell(index, values) for index, values in enumerate(cells)]
+        self.keep = keep
+        self.admission = MatrixAdmission(matrix_max_vcpus(), matrix_max_instances())
+
+    #
+    def cost(self):
+        server_type = str(env().get('RANCHER_SERVER_AWS_INSTANCE_TYPE', 'm4.large')).rstrip()
+        agent_type = str(env().get('RANCHER_AGENT_AWS_INSTANCE_TYPE', 'm4.large')).rstrip()
+        agent_count = int(str(env()['RANCHER_AGENTS_COUNT']).rstrip())
+
+        vcpus = instance_vcpus([server_type, agent_type])
+        return vcpus[server_type] + agent_count * vcpus[agent_type], 1 + agent_count
+
+    #
+    def __lifecycle(self, cell):
+        dag = Pipeline('matrix')
+        dag.add('server.provision', lambda: RancherServer().provision())
+        dag.add('server.configure', lambda: RancherServer().configure(), ['server.provision'])
+        dag.add('agents.launch', lambda: RancherAgents().launch())
+        dag.add('agents.register', lambda: RancherAgents().register(), ['server.configure', 'agents.launch'])
+        dag.add('server.infrastructure', lambda: RancherServer().wait_for_infrastructure(), ['agents.register'])
+
+        try:
+            dag.run()
+        finally:
+            cell.critical_path = [{'step': step.name, 'elapsed': step.elapsed} for step in dag.critical_path()]
+
+    #
+    def __deprovision(self, cell):
+        for deprovision in [lambda: RancherAgents().deprovision(), lambda: RancherServer().deprovision()]:
+            try:
+                deprovision()
+            except RuntimeError as e:
+                log_warn("Failed while deprovisioning matrix cell {} ({}). Please check for leftover nodes!: {}",
+                         cell.index, cell.name, str(e))
+
+    #
+    def __run_cell(self, cell):
+        with env_overlay(cell.config):
+            try:
+                vcpus, instances = self.cost()
+            except (MatrixError, KeyError, ValueError) as e:
+                cell.state = 'failed'
+                cell.error = "Failed to size cell!: {}".format(str(e))
+                return cell
+
+            if not self.admission.fits(vcpus, instances):
+                cell.state = 'rejected'
+                cell.error = "Needs {} vCPUs and {} instances, more than the quotas of {} and {}.".format(
+                    vcpus, instances, self.admission.max_vcpus, self.admission.max_instances)
+                log_warn("Matrix cell {} ({}): {}", cell.index, cell.name, cell.error)
+                return cell
+
+            cell.queued = time.time()
+            self.admission.acquire(vcpus, instances)
+            cell.start = time.time()
+            cell.state = 'running'
+            log_info("Matrix cell {} ({}) admitted after {:.1f}s with {} vCPUs on {} instances.",
+                     cell.index, cell.name, cell.start - cell.queued, vcpus, instances)
+
+            try:
+                with trace_span('matrix.cell', cell=cell.index, values=cell.name):
+                    self.__lifecycle(cell)
+                cell.state = 'passed'
+
+            except (PipelineError, RuntimeError) as e:
+                cell.state = 'failed'
+                cell.error = str(e)
+
+            finally:
+                if not self.keep:
+                    self.__deprovision(cell)
+                cell.end = time.time()
+                self.admission.release(vcpus, instances)
+
+        log_info("Matrix cell {} ({}) {} after {:.1f}s.", cell.index, cell.name, cell.state, cell.elapsed)
+        return cell
+
+    #
+    def run(self):
+        log_info("Running {} matrix cell(s) within {} vCPUs and {} instances...",
+                 len(self.cells), self.admission.max_vcpus, self.admission.max_instances)
+        started = time.time()
+
+        with EnvThreadPoolExecutor(max_workers=max(1, len(self.cells))) as pool:
+            list(pool.map(self.__run_cell, self.cells))
+
+        results = self.report(started)
+
+        failed = [cell for cell in self.cells if 'passed' != cell.state]
+        if 0 != len(failed):
+            msg = "{} of {} matrix cell(s) did not pass: {}".format(
+                len(failed), len(self.cells), '; '.join(['{} ({}): {}'.format(cell.index, cell.name, cell.error) for cell in failed]))
+            log_debug(msg)
+            raise MatrixError(msg)
+
+        return results
+
+    #
+    def report(self, started):
+        results = []
+        lines = ['{:>4} {:<8} {:>10} {:>10}  {}'.format('cell', 'state', 'queued (s)', 'wall (s)', 'values')]
+
+        for cell in self.cells:
+            queued = 0.0 if None is cell.queued or None is cell.start else cell.start - cell.queued
+            lines.append('{:>4} {:<8} {:>10.1f} {:>10.1f}  {}'.format(cell.index, cell.state, queued, cell.elapsed, cell.name))
+            results.append({
+                'cell': cell.index,
+                'values': cell.values,
+                'build': cell.config['BUILD_NUMBER'],
+                'state': cell.state,
+                'queued': queued,
+                'elapsed': cell.elapsed,
+                'error': cell.error,
+                'critical_path': cell.critical_path
+            })
+
+        lines.append('matrix wall time: {:.1f}s'.format(time.time() - started))
+        log_info("Matrix summary:\n{}", '\n'.join(lines))
+
+        path = matrix_results_path()
+        try:
+            tmppath = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmppath, 'w') as f:
+                json.dump({'started': started, 'finished': time.time(), 'cells': results}, f, indent=2, sort_keys=True)
+            os.replace(tmppath, path)
+            log_info("Wrote matrix results to '{}'.", path)
+
+        except (IOError, OSError) as e:
+            log_warn("Failed while writing matrix results '{}'!: {}", path, str(e))
+
+        return results
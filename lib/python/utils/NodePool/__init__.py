@@ -0,0 +1,222 @@
+import os, time, uuid
+
+from boto3.exceptions import Boto3Error
+from botocore.exceptions import ClientError
+
+from .. import log_debug, log_info, log_warn, aws_client, aws_get_region, env
+from .. import ec2_inventory_lookup, ec2_inventory_invalidate, ec2_copy_ssh_keypair
+from ..SSH import SSH, SSHError
+from ..Trace import trace_span
+
+
+#
+class NodePoolError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(NodePoolError, self).__init__(self.message)
+
+
+#
+def node_pool_enabled():
+    return 'true' == str(env().get('RANCHER_NODE_POOL', 'false')).rstrip()
+
+
+#
+def node_pool_ttl():
+    return int(str(env().get('RANCHER_NODE_POOL_TTL', 3600)).rstrip())
+
+
+#
+def node_pool_name(instance_id):
+    prefix = env().get('AWS_PREFIX')
+    if None is not prefix:
+        return "{}-pool-{}".format(prefix.replace('.', '-'), instance_id)
+    return "pool-{}".format(instance_id)
+
+
+#
+def node_pool_keyname(instance_id):
+    return 'pool-{}'.format(instance_id)
+
+
+#
+class NodePool(object):
+    """
+    Hand nodes from one build to the next instead of terminating and relaunching them.
+
+    Releasing a node resets it over SSH and tags it idle under a pool name,
+    with a pool key of OS, Docker settings and instance type. Acquiring
+    claims idle nodes with the same key and renames them for the new build.
+    The caller launches fresh nodes for any shortfall. Nodes idle for longer
+    than RANCHER_NODE_POOL_TTL seconds are terminated. Pool state lives only
+    in EC2 tags, plus the node's ssh key kept in .ssh/ under its pool name.
+    """
+
+    region = None
+
+    #
+    def __init__(self, region=None):
+        if None is region:
+            region = aws_get_region()
+        self.region = str(region).rstrip()
+
+    #
+    def key(self, instance_type, operatingsystem):
+        return '{}/{}/{}/{}/{}'.format(
+            str(operatingsystem).rstrip(),
+            str(env()['RANCHER_DOCKER_VERSION']).rstrip(),
+            str(env().get('RANCHER_DOCKER_NATIVE', 'false')).rstrip(),
+            str(env().get('RANCHER_DOCKER_RHEL_SELINUX', 'false')).rstrip(),
+            instance_type)
+
+    #
+    def __idle(self, extra_filters=[]):
+        node_filter = [
+            {'Name': 'tag:rancher.pool.state', 'Values': ['idle']},
+            {'Name': 'instance-state-name', 'Values': ['running']}
+        ] + extra_filters
+
+        nodes = []
+        paginator = aws_client('ec2', region=self.region).get_paginator('describe_instances')
+        for page in paginator.paginate(Filters=node_filter):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    tags = dict([(tag['Key'], tag['Value']) for tag in instance.get('Tags', [])])
+                    nodes.append({
+                        'instance_id': instance['InstanceId'],
+                        'idle_since': float(tags.get('rancher.pool.idle_since', 0)),
+                        'claim': tags.get('rancher.pool.claim')
+                    })
+
+        return nodes
+
+    #
+    def evict(self):
+        ec2 = aws_client('ec2', region=self.region)
+        expired = [node['instance_id'] for node in self.__idle() if time.time() - node['idle_since'] > node_pool_ttl()]
+
+        if 0 != len(expired):
+            log_info("Evicting {} node(s) idle for longer than {} seconds: {}", len(expired), node_pool_ttl(), ', '.join(expired))
+            try:
+                ec2.terminate_instances(InstanceIds=expired)
+            except (Boto3Error, ClientError) as e:
+                log_warn("Failed while evicting pooled nodes!: {}", str(e))
+            ec2_inventory_invalidate()
+
+        return expired
+
+    #
+    def acquire(self, nodenames, instance_type, operatingsystem):
+        """
+        Claim idle pooled nodes for as many of nodenames as possible.
+
+        Args:
+          nodenames (list): names the claimed nodes are given, in order
+          instance_type (str): EC2 instance type the nodes must have
+          operatingsystem (str): OS the nodes must run, e.g. RANCHER_AGENT_OPERATINGSYSTEM for agents
+
+        Returns:
+          dict: node name to instance-id for each node taken from the pool
+        """
+        ec2 = aws_client('ec2', region=self.region)
+        self.evict()
+
+        key = self.key(instance_type, operatingsystem)
+        candidates = self.__idle([{'Name': 'tag:rancher.pool.key', 'Values': [key]}])
+
+        # most recently used first, and only nodes whose ssh key is here to be handed over
+        candidates = sorted(candidates, key=lambda node: -node['idle_since'])
+        candidates = [node for node in candidates if os.path.isfile('.ssh/{}'.format(node_pool_keyname(node['instance_id'])))]
+        candidates = candidates[:len(nodenames)]
+
+        if 0 == len(candidates):
+            log_info("No idle pooled nodes for '{}'.", key)
+            return {}
+
+        try:
+            # tagging is not atomic; claim, then keep only the nodes no other build claimed since
+            token = uuid.uuid4().hex
+            ids = [node['instance_id'] for node in candidates]
+            ec2.create_tags(Resources=ids, Tags=[{'Key': 'rancher.pool.claim', 'Value': token}])
+            time.sleep(2)
+            claimed = [node['instance_id'] for node in self.__idle([{'Name': 'instance-id', 'Values': ids}]) if token == node['claim']]
+
+            nodes = {}
+            for nodename, instance_id in zip(nodenames, [i for i in ids if i in claimed]):
+                log_info("Taking pooled node '{}' as '{}'...", instance_id, nodename)
+                ec2.create_tags(Resources=[instance_id], Tags=[
+                    {'Key': 'Name', 'Value': nodename},
+                    {'Key': 'rancher.pool.state', 'Value': 'claimed'},
+                    {'Key': 'rancher.pool.reused', 'Value': 'true'}])
+                ec2_copy_ssh_keypair(node_pool_keyname(instance_id), nodename)
+                nodes[nodename] = instance_id
+
+        except (RuntimeError, Boto3Error, ClientError) as e:
+            msg = "Failed while claiming pooled nodes!: {}".format(str(e))
+            log_debug(msg)
+            raise NodePoolError(msg) from e
+
+        finally:
+            ec2_inventory_invalidate()
+
+        log_info("Took {} of {} node(s) from the pool.", len(nodes), len(nodenames))
+        return nodes
+
+    #
+    def reset(self, nodename, addr, ssh_user):
+        docker_version = str(env()['RANCHER_DOCKER_VERSION']).rstrip().replace('~', '-')
+
+        # remove every container, volume and user-defined network and the Rancher agent state, then
+        # report the engine version. 'prune' needs Docker 1.13 and RancherOS keeps its own state under
+        # /var/lib/rancher, so neither is used.
+        sshcmd = 'sudo docker ps -aq | xargs -r sudo docker rm -f' \
+                 ' && sudo docker volume ls -q | xargs -r sudo docker volume rm' \
+                 ' && sudo docker network ls -q --filter type=custom | xargs -r sudo docker network rm' \
+                 ' && sudo rm -rf /var/lib/rancher/state /var/lib/cattle' \
+                 ' && sudo docker version --format "{{.Server.Version}}"'
+        result = SSH(nodename, addr, ssh_user, sshcmd, max_attempts=2)
+
+        version = result.stdout.strip().splitlines()[-1].strip() if result.stdout.strip() else ''
+        if not version.replace('~', '-').startswith(docker_version):
+            msg = "Node '{}' runs Docker '{}' rather than '{}'!".format(nodename, version, docker_version)
+            log_debug(msg)
+            raise NodePoolError(msg)
+
+        return True
+
+    #
+    def release(self, nodename, ssh_user, operatingsystem):
+        ec2 = aws_client('ec2', region=self.region)
+
+        node = ec2_inventory_lookup(nodename, region=self.region, states=['running'])
+        if None is node:
+            log_info("No running node '{}' to return to the pool.", nodename)
+            return False
+
+        instance_id = node['instance_id']
+
+        try:
+            with trace_span('node_pool.reset', node=nodename):
+                self.reset(nodename, node['public_ip'], ssh_user)
+
+            ec2_copy_ssh_keypair(nodename, node_pool_keyname(instance_id))
+            ec2.create_tags(Resources=[instance_id], Tags=[
+                {'Key': 'Name', 'Value': node_pool_name(instance_id)},
+                {'Key': 'rancher.pool.state', 'Value': 'idle'},
+                {'Key': 'rancher.pool.key', 'Value': self.key(node['instance_type'], operatingsystem)},
+                {'Key': 'rancher.pool.idle_since', 'Value': str(time.time())}])
+            ec2.delete_tags(Resources=[instance_id], Tags=[{'Key': 'rancher.pool.claim'}])
+            log_info("Returned node '{}' ({}) to the pool.", nodename, instance_id)
+
+        except (SSHError, NodePoolError, RuntimeError, Boto3Error, ClientError) as e:
+            # a node which cannot be cleaned up is not fit for the next build
+            log_warn("Failed to return node '{}' to the pool. Terminating it!: {}", nodename, str(e))
+            ec2.terminate_instances(InstanceIds=[instance_id])
+            return False
+
+        finally:
+            ec2_inventory_invalidate()
+
+        return True
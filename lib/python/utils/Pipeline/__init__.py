@@ -0,0 +1,188 @@
+import time, threading
+
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from .. import log_debug, log_info, log_warn, EnvThreadPoolExecutor
+from ..Trace import trace_span
+
+
+#
+class PipelineError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(PipelineError, self).__init__(self.message)
+
+
+#
+class PipelineStep(object):
+
+    name = None
+    fn = None
+    deps = None
+    state = None
+    start = None
+    end = None
+    error = None
+
+    #
+    def __init__(self, name, fn, deps):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.state = 'pending'
+
+    #
+    @property
+    def elapsed(self):
+        if None is self.start or None is self.end:
+            return 0.0
+        return self.end - self.start
+
+
+#
+class Pipeline(object):
+    """
+    Run steps as soon as the steps they depend on have finished.
+
+    Steps are added in dependency order, so the graph cannot have cycles. A
+    failed step skips everything that depends on it while unrelated steps run
+    to completion. Once done, the run is summarized with its critical path.
+    """
+
+    #
+    def __init__(self, name='pipeline'):
+        self.name = name
+        self.__steps = []
+        self.__index = {}
+        self.__lock = threading.Lock()
+        self.__started = None
+
+    #
+    def add(self, name, fn, deps=[]):
+        if name in self.__index:
+            raise PipelineError("Step '{}' was already added!".format(name))
+
+        for dep in deps:
+            if dep not in self.__index:
+                raise PipelineError("Step '{}' depends on unknown step '{}'!".format(name, dep))
+
+        step = PipelineStep(name, fn, deps)
+        self.__steps.append(step)
+        self.__index[name] = step
+        return step
+
+    #
+    def steps(self):
+        return list(self.__steps)
+
+    #
+    def __run_step(self, step):
+        with self.__lock:
+            step.state = 'running'
+            step.start = time.time()
+
+        log_info("Pipeline step '{}' started.", step.name)
+        try:
+            with trace_span('{}.{}'.format(self.name, step.name)):
+                step.fn()
+
+        except Exception as e:
+            with self.__lock:
+                step.state = 'failed'
+                step.error = str(e)
+                step.end = time.time()
+            log_warn("Pipeline step '{}' failed after {:.1f} seconds!: {}", step.name, step.elapsed, step.error)
+            return step
+
+        with self.__lock:
+            step.state = 'done'
+            step.end = time.time()
+        log_info("Pipeline step '{}' finished after {:.1f} seconds.", step.name, step.elapsed)
+        return step
+
+    #
+    def __ready(self):
+        # skipping a step can make steps which depend on it skippable too, so settle first
+        settled = False
+        while not settled:
+            settled = True
+            for step in self.__steps:
+                if 'pending' == step.state and any([self.__index[dep].state in ['failed', 'skipped'] for dep in step.deps]):
+                    log_warn("Skipping pipeline step '{}' as a step it depends on did not succeed.", step.name)
+                    step.state = 'skipped'
+                    settled = False
+
+        return [step for step in self.__steps
+                if 'pending' == step.state and all([self.__index[dep].state == 'done' for dep in step.deps])]
+
+    #
+    def run(self):
+        self.__started = time.time()
+        futures = set()
+
+        with EnvThreadPoolExecutor(max_workers=max(1, len(self.__steps))) as pool:
+            while True:
+                with self.__lock:
+                    ready = self.__ready()
+                    for step in ready:
+                        step.state = 'queued'
+
+                for step in ready:
+                    futures.add(pool.submit(self.__run_step, step))
+
+                if 0 == len(futures):
+                    break
+
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+
+        self.report()
+
+        failed = [step.name for step in self.__steps if step.state in ['failed', 'skipped']]
+        if 0 != len(failed):
+            errors = ["{}: {}".format(step.name, step.error) for step in self.__steps if 'failed' == step.state]
+            msg = "Pipeline '{}' did not complete! Failed or skipped steps: {} :: {}".format(
+                self.name, ', '.join(failed), '; '.join(errors))
+            log_debug(msg)
+            raise PipelineError(msg)
+
+        return True
+
+    #
+    def critical_path(self):
+        """
+        Walk back from the last step to finish, each time through the dependency which finished last.
+
+        Returns:
+          list: PipelineStep objects from the first step on the path to the last
+        """
+        finished = [step for step in self.__steps if step.state in ['done', 'failed']]
+        if 0 == len(finished):
+            return []
+
+        path = [max(finished, key=lambda step: step.end)]
+        while True:
+            deps = [self.__index[dep] for dep in path[-1].deps if None is not self.__index[dep].end]
+            if 0 == len(deps):
+                break
+            path.append(max(deps, key=lambda step: step.end))
+
+        return list(reversed(path))
+
+    #
+    def report(self):
+        started = self.__started or time.time()
+
+        lines = ['{:<28} {:<8} {:>10} {:>10}'.format('step', 'state', 'start (s)', 'wall (s)')]
+        for step in self.__steps:
+            offset = '-' if None is step.start else '{:.1f}'.format(step.start - started)
+            lines.append('{:<28} {:<8} {:>10} {:>10.1f}'.format(step.name, step.state, offset, step.elapsed))
+
+        path = self.critical_path()
+        total = 0.0 if 0 == len(path) else path[-1].end - started
+        lines.append('critical path ({:.1f}s): {}'.format(
+            total, ' -> '.join(['{} ({:.1f}s)'.format(step.name, step.elapsed) for step in path])))
+
+        log_info("Pipeline '{}' summary:\n{}", self.name, '\n'.join(lines))
+        return path
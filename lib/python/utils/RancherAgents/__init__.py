@@ -1,12 +1,16 @@
-import os
-
+from concurrent.futures import as_completed
 from invoke import run, Failure
 from time import sleep, time
-from .. import log_info, log_success, log_debug, log_warn, os_to_settings
-from .. import ec2_node_ensure, ec2_node_terminate, ec2_node_public_ip
+from .. import log_info, log_success, log_debug, log_warn, os_to_settings, backoff_delays, env
+from .. import EnvThreadPoolExecutor
+from .. import ec2_node_ensure, ec2_nodes_ensure, ec2_teardown, ec2_node_public_ip, ec2_running_node_names
+from .. import ec2_node_is_prepared
 
 from ..RancherServer import RancherServer, RancherServerError
-from ..SSH import SSH, SCP, SSHError
+from ..SSH import SSHError, fan_out, fan_out_check, fan_out_parallelism, ssh_fan_out
+from ..Bootstrap import Bootstrap, BootstrapError
+from ..Trace import traced, trace_span
+from ..NodePool import NodePool, NodePoolError, node_pool_enabled
 
 
 class RancherAgentsError(RuntimeError):
@@ -39,8 +43,8 @@ class RancherAgents(object):
                 result = True
                 missing = []
                 for envvar in required_envvars:
-                        if envvar not in os.environ:
-                                log_debug("Missing envvar \'{}\'!".format(envvar))
+                        if envvar not in env():
+                                log_debug("Missing envvar \'{}\'!", envvar)
                                 missing.append(envvar)
                                 result = False
                 if False is result:
@@ -53,11 +57,11 @@ class RancherAgents(object):
         #
         def __agent_name_prefix(self):
                 n = ''
-                prefix = os.environ.get('AWS_PREFIX')
-                rancher_version = os.environ['RANCHER_VERSION'].replace('.', '')
-                docker_version = os.environ['RANCHER_DOCKER_VERSION'].replace('.', '').replace('~', '')
-                rancher_agent_os = os.environ['RANCHER_AGENT_OPERATINGSYSTEM']
-                rancher_orch = os.environ['RANCHER_ORCHESTRATION']
+                prefix = env().get('AWS_PREFIX')
+                rancher_version = env()['RANCHER_VERSION'].replace('.', '')
+                docker_version = env()['RANCHER_DOCKER_VERSION'].replace('.', '').replace('~', '')
+                rancher_agent_os = env()['RANCHER_AGENT_OPERATINGSYSTEM']
+                rancher_orch = env()['RANCHER_ORCHESTRATION']
 
                 if None is not prefix:
                         prefix = prefix.replace('.', '-')
@@ -66,6 +70,11 @@ class RancherAgents(object):
                 n += "{}-{}-d{}-{}-agent".format(rancher_version, rancher_orch, docker_version, rancher_agent_os)
                 return n.rstrip()
 
+        #
+        def name_pattern(self):
+                # matches every agent of this configuration, whatever the agent count was
+                return self.__agent_name_prefix() + '*'
+
         #
         def __get_agent_names(self, count):
                 agent_names = []
@@ -74,51 +83,56 @@ class RancherAgents(object):
                 return agent_names
 
         #
-        def __wait_on_active_agents(self, count):
-                rancher_version = str(os.environ['RANCHER_VERSION']).rstrip()
-                if "v2" in rancher_version:
-                    rancher_url = "http://{}:8080/v3/schemas".format(RancherServer().IP())
-                else:
-                    rancher_url = "http://{}:8080/v2-beta/schemas".format(RancherServer().IP())
-                os.environ['RANCHER_URL'] = rancher_url
-                rancher_orch = str(os.environ['RANCHER_ORCHESTRATION']).rstrip()
+        @traced('rancher_agents.activation')
+        def __wait_on_active_agents(self, count, timeout=600):
+                server = RancherServer()
+                active = {}
+                delays = backoff_delays(initial=2, maximum=30)
 
-                actual_count = 0
-                timeout = 600
-                elapsed_time = 0
-                sleep_step = 30
+                try:
+                        project_id = server.project_id()
+                        log_info("Waiting for {} active Rancher Agents in project '{}'...", count, project_id)
+
+                        start_time = time()
+                        while True:
+                                now = time()
+                                for host in server.hosts(project_id):
+                                        if 'active' == host.get('state') and host['id'] not in active:
+                                                active[host['id']] = {'hostname': host.get('hostname'), 'active_at': now}
+                                                log_info("Host '{}' ({}) became active after {:.0f} seconds.",
+                                                         host.get('hostname'), host['id'], now - start_time)
 
-                start_time = time()
-                while actual_count < count and elapsed_time < timeout:
-                        try:
-                                sleep(sleep_step)
-                                project_id = '1a5'
-                                if rancher_orch == 'k8s':
-                                    project_id = run('rancher --url http://{}:8080 env ls --quiet | grep -v 1a5'.format(RancherServer().IP())).stdout.rstrip('\n\r')
-                                result = run('rancher --env {} host list -q | grep active| wc -l'.format(project_id), echo=True)
-                                actual_count = int(result.stdout.rstrip())
                                 elapsed_time = time() - start_time
-                                log_info("{} seconds elapsed waiting for {} active Rancher Agents...".format(elapsed_time, count))
+                                if len(active) >= count:
+                                        break
 
-                        except Failure as e:
-                                msg = "Failed while trying to count active agents!: {}".format(str(e))
-                                log_debug(msg)
-                                raise RancherAgentsError(msg) from e
+                                if elapsed_time >= timeout:
+                                        msg = "Timed out waiting for {} agents to become active! Only {} are: {}".format(
+                                                count, len(active), ', '.join(sorted(str(h['hostname']) for h in active.values())))
+                                        log_debug(msg)
+                                        raise RancherAgentsError(msg)
 
-                if actual_count < count and elapsed_time > timeout:
-                        msg = "Timed out waiting for {} agents to become active!".format(count)
+                                log_info("{:.0f} seconds elapsed waiting for {} active Rancher Agents ({} active)...",
+                                         elapsed_time, count, len(active))
+                                sleep(min(next(delays), timeout - elapsed_time))
+
+                except RancherServerError as e:
+                        msg = "Failed while trying to count active agents!: {}".format(str(e))
                         log_debug(msg)
-                        raise RancherAgentsError(msg)
+                        raise RancherAgentsError(msg) from e
+
+                return active
 
         #
+        @traced('rancher_agents.k8s_stack')
         def __wait_on_active_k8s(self):
-                rancher_version = str(os.environ['RANCHER_VERSION']).rstrip()
+                rancher_version = str(env()['RANCHER_VERSION']).rstrip()
                 if "v2" in rancher_version:
                     rancher_url = "http://{}:8080/v3/schemas".format(RancherServer().IP())
                 else:
                     rancher_url = "http://{}:8080/v2-beta/schemas".format(RancherServer().IP())
-                os.environ['RANCHER_URL'] = rancher_url
-                rancher_orch = str(os.environ['RANCHER_ORCHESTRATION']).rstrip()
+                env()['RANCHER_URL'] = rancher_url
+                rancher_orch = str(env()['RANCHER_ORCHESTRATION']).rstrip()
 
                 stack_health = "unhealthy"
                 timeout = 600
@@ -132,9 +146,9 @@ class RancherAgents(object):
                                 project_id = '1a5'
                                 if rancher_orch == 'k8s':
                                     project_id = run('rancher --url http://{}:8080 env ls --quiet | grep -v 1a5'.format(RancherServer().IP())).stdout.rstrip('\n\r')
-                                stack_health = run("rancher inspect {} | jq .healthState".format(project_id)).stdout.rstrip('\n\r')
+                                stack_health = run("rancher inspect {} | jq .healthState".format(project_id), env={'RANCHER_URL': rancher_url}).stdout.rstrip('\n\r')
                                 elapsed_time = time() - start_time
-                                log_info("{} seconds elapsed waiting for k8s stack...".format(elapsed_time))
+                                log_info("{} seconds elapsed waiting for k8s stack...", elapsed_time)
 
                         except Failure as e:
                                 msg = "Failed while trying to wait to kubernetes stack!: {}".format(str(e))
@@ -147,111 +161,205 @@ class RancherAgents(object):
                         raise RancherAgentsError(msg)
 
         #
-        def __ensure_rancher_agents(self):
-                agent_count = int(str(os.environ['RANCHER_AGENTS_COUNT']).rstrip())
-                max_attempts = 10
+        def __agents_parallelism(self, agent_count):
+                parallelism = int(str(env().get('RANCHER_AGENTS_PARALLELISM', '1')).rstrip())
+                return max(1, min(parallelism, agent_count))
+
+        #
+        def __ensure_rancher_agent(self, agent_name, max_attempts):
                 attempts = 0
-                agents = 0
-                agent_name_prefix = self.__agent_name_prefix()
+                last_error = None
 
                 while attempts < max_attempts:
-                        result = False
-                        agent_name = agent_name_prefix + str(agents)
+                        attempts += 1
+
+                        try:
+                                log_info("Provisioning agent '{}' (attempt {}/{})...", agent_name, attempts, max_attempts)
+                                with trace_span('rancher_agents.ec2_launch.node', node=agent_name, attempt=attempts):
+                                        if True is ec2_node_ensure(agent_name, instance_type=env().get('RANCHER_AGENT_AWS_INSTANCE_TYPE'),
+                                                           operatingsystem=env()['RANCHER_AGENT_OPERATINGSYSTEM']):
+                                                return True
 
+                        except RuntimeError as e:
+                                last_error = str(e)
+                                msg = "Failed while provisioning agent '{}'!: {}".format(agent_name, last_error)
+                                log_warn(msg)
+
+                msg = "Failed to provision agent '{}' after {} attempts!: {}".format(agent_name, max_attempts, last_error)
+                log_debug(msg)
+                raise RancherAgentsError(msg)
+
+        #
+        def __ensure_rancher_agents_batch(self, agent_names, max_attempts):
+                region = str(env()['AWS_DEFAULT_REGION']).rstrip()
+                missing = list(agent_names)
+                attempts = 0
+
+                while attempts < max_attempts and 0 != len(missing):
                         attempts += 1
 
                         try:
-                                log_info("Provisioning agent '{}'...".format(agent_name))
-                                if True is ec2_node_ensure(agent_name, instance_type=os.environ.get('RANCHER_AGENT_AWS_INSTANCE_TYPE')):
-                                        agents += 1
+                                log_info("Batch provisioning agents '{}' (attempt {}/{})...", ', '.join(missing), attempts, max_attempts)
+                                ec2_nodes_ensure(missing, instance_type=env().get('RANCHER_AGENT_AWS_INSTANCE_TYPE'),
+                                                 operatingsystem=env()['RANCHER_AGENT_OPERATINGSYSTEM'])
 
                         except RuntimeError as e:
-                                msg = "Failed while provisioning agent '{}'!: {}".format(agent_name, str(e))
+                                msg = "Failed while batch provisioning agents!: {}".format(str(e))
                                 log_warn(msg)
 
-                        if agents >= agent_count or attempts >= max_attempts:
-                                break
+                        running = ec2_running_node_names(agent_names, region=region)
+                        missing = [name for name in agent_names if name not in running]
+
+                return missing
+
+        #
+        @traced('rancher_agents.ec2_launch')
+        def __ensure_rancher_agents(self):
+                agent_count = int(str(env()['RANCHER_AGENTS_COUNT']).rstrip())
+                agent_names = self.__get_agent_names(agent_count)
+                batch_launch = 'true' == str(env().get('RANCHER_AGENTS_BATCH_LAUNCH', 'false')).rstrip()
+                parallelism = self.__agents_parallelism(agent_count)
+                max_attempts = 10
+                failed = []
+
+                # only the shortfall after what the node pool can hand over is launched
+                launch_names = agent_names
+                if node_pool_enabled():
+                        try:
+                                instance_type = env().get('RANCHER_AGENT_AWS_INSTANCE_TYPE', 'm4.large')
+                                pooled = NodePool().acquire(agent_names, instance_type, env()['RANCHER_AGENT_OPERATINGSYSTEM'])
+                                launch_names = [name for name in agent_names if name not in pooled]
+                        except NodePoolError as e:
+                                log_warn("Failed to take agents from the node pool. Launching all of them!: {}", str(e))
+
+                if 0 == len(launch_names):
+                        log_info("All {} agents were taken from the node pool.", agent_count)
+
+                elif batch_launch:
+                        failed = self.__ensure_rancher_agents_batch(launch_names, max_attempts)
 
-                if agents >= agent_count:
-                        return True
                 else:
-                        msg = "Failed to provision " + str(agent_count) + " agents after 10 attempts! Giving up..."
+                        log_info("Provisioning {} agents with a parallelism of {}...", len(launch_names), parallelism)
+
+                        with EnvThreadPoolExecutor(max_workers=parallelism) as pool:
+                                futures = {}
+                                for agent_name in launch_names:
+                                        futures[pool.submit(self.__ensure_rancher_agent, agent_name, max_attempts)] = agent_name
+
+                                for future in as_completed(futures):
+                                        try:
+                                                future.result()
+                                        except RancherAgentsError:
+                                                failed.append(futures[future])
+
+                result = {
+                        'provisioned': [name for name in agent_names if name not in failed],
+                        'failed': [name for name in agent_names if name in failed]
+                }
+                log_debug("agent provisioning result: {}", result)
+
+                if 0 != len(result['failed']):
+                        msg = "Failed to provision {} of {} agents after {} attempts each! Giving up on: {}".format(
+                                len(result['failed']), agent_count, max_attempts, ', '.join(result['failed']))
                         log_debug(msg)
                         raise RancherAgentsError(msg)
 
+                return result
+
         #
-        def __install_docker(self, agentname):
-                region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
-                agent_os = str(os.environ['RANCHER_AGENT_OPERATINGSYSTEM']).rstrip()
-                os_settings = os_to_settings(agent_os)
-                ssh_user = os_settings['ssh_username']
+        def __agent_nodes(self, agent_count):
+                region = str(env()['AWS_DEFAULT_REGION']).rstrip()
+                agent_os = str(env()['RANCHER_AGENT_OPERATINGSYSTEM']).rstrip()
+                ssh_user = os_to_settings(agent_os)['ssh_username']
 
-                try:
-                        addr = ec2_node_public_ip(agentname, region=region)
+                nodes = []
+                for agent_name in self.__get_agent_names(agent_count):
+                        nodes.append((agent_name, ec2_node_public_ip(agent_name, region=region), ssh_user))
+                return nodes
 
-                        SCP(agentname, addr, ssh_user, './lib/bash/*.sh', '/tmp/')
-                        SSH(agentname, addr, ssh_user, 'chmod +x /tmp/*.sh && /tmp/rancher_ci_bootstrap.sh')
+        #
+        def __install_docker(self, agentname, addr, ssh_user):
+                try:
+                        if ec2_node_is_prepared(agentname):
+                                log_info("Rancher Agent '{}' already has Docker installed. Skipping Docker install.", agentname)
+                                return 0
 
-                except SSHError as e:
-                        msg = "Failed while Dockerizing Rancher Agent '{}'!: {}".format(agentname, str(e))
-                        log_debug(msg)
-                        raise RancherAgentsError(msg) from e
+                        log_info("Installing Docker on Rancher Agent '{}'...", agentname)
+                        return Bootstrap().run(agentname, addr, ssh_user, tag=agentname)
 
-                return True
+                except (BootstrapError, RuntimeError) as e:
+                        raise SSHError(str(e)) from e
 
         #
+        @traced('rancher_agents.docker')
         def __ensure_agents_docker(self):
-                agent_prefix = self.__agent_name_prefix()
-                agent_count = int(str(os.environ['RANCHER_AGENTS_COUNT']).rstrip())
+                agent_count = int(str(env()['RANCHER_AGENTS_COUNT']).rstrip())
 
                 try:
-                        for agent in range(0, agent_count):
-                                agent_name = agent_prefix + str(agent)
-                                log_info("Installing Docker on Rancher Agent '{}'...".format(agent_name))
-                                self.__install_docker(agent_name)
+                        nodes = self.__agent_nodes(agent_count)
+                        results = fan_out(nodes, self.__install_docker, label='rancher_agents.docker.node')
+                        fan_out_check(results, nodes, 'Dockerizing Rancher Agents')
 
-                except RancherAgentsError as e:
+                except (RuntimeError, SSHError) as e:
                         msg = "Failed while Dockerizing Rancher Agents!: {}".format(str(e))
                         log_debug(msg)
                         raise RancherAgentsError(msg) from e
 
-                return True
+                return results
 
         #
+        @traced('rancher_agents.registration')
         def __ensure_rancher_agents_container(self):
                 log_info("Deploying Rancher Agent container...")
 
-                agent_count = int(str(os.environ['RANCHER_AGENTS_COUNT']).rstrip())
-                region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
-                agent_os = str(os.environ['RANCHER_AGENT_OPERATINGSYSTEM']).rstrip()
-                os_settings = os_to_settings(agent_os)
-                ssh_user = os_settings['ssh_username']
-                agent_prefix = self.__agent_name_prefix()
+                agent_count = int(str(env()['RANCHER_AGENTS_COUNT']).rstrip())
 
                 try:
                         reg_command = RancherServer().reg_command()
+                        results = ssh_fan_out(self.__agent_nodes(agent_count), reg_command)
 
-                        for agent in range(0, agent_count):
-                                agent_name = agent_prefix + str(agent)
-                                addr = ec2_node_public_ip(agent_name, region=region)
-                                SSH(agent_name, addr, ssh_user, reg_command)
-
-                except (RancherServerError, SSHError) as e:
+                except (RancherServerError, RuntimeError, SSHError) as e:
                         msg = "Failed while launcing Rancher Agent container!: {}".format(str(e))
                         log_debug(msg)
                         raise RancherAgentsError(msg) from e
 
-                return True
+                return results
 
         #
-        def provision(self):
-                agent_count = int(str(os.environ['RANCHER_AGENTS_COUNT']).rstrip())
+        # Launching and Dockerizing agents does not need Rancher Server, so it can overlap with
+        # server provisioning. Only registration has to wait for a configured server.
+        @traced('rancher_agents.launch')
+        def launch(self):
                 try:
-                        rancher_orch = str(os.environ['RANCHER_ORCHESTRATION']).rstrip()
                         self.__ensure_rancher_agents()
                         self.__ensure_agents_docker()
+                except RancherAgentsError as e:
+                        msg = "Failed while launching Rancher Agents!: {}".format(str(e))
+                        log_debug(msg)
+                        raise RancherAgentsError(msg) from e
+
+                return True
+
+        #
+        @traced('rancher_agents.register')
+        def register(self):
+                agent_count = int(str(env()['RANCHER_AGENTS_COUNT']).rstrip())
+                try:
                         self.__ensure_rancher_agents_container()
                         self.__wait_on_active_agents(agent_count)
+                except RancherAgentsError as e:
+                        msg = "Failed while registering Rancher Agents!: {}".format(str(e))
+                        log_debug(msg)
+                        raise RancherAgentsError(msg) from e
+
+                return True
+
+        #
+        @traced('rancher_agents.provision')
+        def provision(self):
+                try:
+                        self.launch()
+                        self.register()
                 except RancherAgentsError as e:
                         msg = "Failed while provisioning Rancher Agents!: {}".format(str(e))
                         log_debug(msg)
@@ -260,14 +368,10 @@ class RancherAgents(object):
                 return True
 
         #
+        @traced('rancher_agents.provision_standalone')
         def provision_standalone(self):
-                agent_count = int(str(os.environ['RANCHER_AGENTS_COUNT']).rstrip())
-                agent_prefix = self.__agent_name_prefix()
-                region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
-                reg_command = str(os.environ.get('RANCHER_REGISTRATION_COMMAND', False)).rstrip()
-                agent_os = str(os.environ['RANCHER_AGENT_OPERATINGSYSTEM']).rstrip()
-                os_settings = os_to_settings(agent_os)
-                ssh_user = os_settings['ssh_username']
+                agent_count = int(str(env()['RANCHER_AGENTS_COUNT']).rstrip())
+                reg_command = str(env().get('RANCHER_REGISTRATION_COMMAND', False)).rstrip()
 
                 try:
                         self.__ensure_rancher_agents()
@@ -278,26 +382,41 @@ class RancherAgents(object):
                         log_debug(msg)
                         raise RancherAgentsError(msg) from e
 
-                for agent in range(0, agent_count):
-                    agent_name = agent_prefix + str(agent)
-                    addr = ec2_node_public_ip(agent_name, region=region)
-                    log_success("Standalone Agent {}: {}".format(agent_name, addr))
-                    if reg_command is not 'False':
-                        SSH(agent_name, addr, ssh_user, reg_command)
+                try:
+                        nodes = self.__agent_nodes(agent_count)
+                        for agent_name, addr, user in nodes:
+                                log_success("Standalone Agent {}: {}".format(agent_name, addr))
+
+                        if reg_command != 'False':
+                                ssh_fan_out(nodes, reg_command)
+
+                except (RuntimeError, SSHError) as e:
+                        msg = "Failed while registering standalone Rancher Agents!: {}".format(str(e))
+                        log_debug(msg)
+                        raise RancherAgentsError(msg) from e
 
                 return True
 
         #
+        @traced('rancher_agents.deprovision')
         def deprovision(self):
                 log_info("Deprovisioning Rancher Agents...")
 
-                region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
-                agent_count = int(str(os.environ['RANCHER_AGENTS_COUNT']).rstrip())
+                region = str(env()['AWS_DEFAULT_REGION']).rstrip()
+                agent_count = int(str(env()['RANCHER_AGENTS_COUNT']).rstrip())
+
+                if node_pool_enabled():
+                        agent_os = str(env()['RANCHER_AGENT_OPERATINGSYSTEM']).rstrip()
+                        ssh_user = os_to_settings(agent_os)['ssh_username']
+                        node_pool = NodePool(region)
+
+                        with EnvThreadPoolExecutor(max_workers=max(1, min(fan_out_parallelism(), agent_count))) as pool:
+                                list(pool.map(lambda agent_name: node_pool.release(agent_name, ssh_user, agent_os), self.__get_agent_names(agent_count)))
+                        return True
+
+                # the wildcard also catches agents left over from a run with a higher agent count
                 try:
-                        for agent in range(0, agent_count):
-                                agent_name = self.__agent_name_prefix() + str(agent)
-                                ec2_node_terminate(agent_name, region=region)
-                                # nuke_aws_keypair(agent_name)
+                        ec2_teardown([self.name_pattern()], region=region, volumes=False)
 
                 except (RancherAgentsError, RuntimeError) as e:
                         msg = "Failed with deprovisioning agent!: {}".format(str(e))
@@ -1,15 +1,17 @@
-import os, boto3
-
 from invoke import run, Failure
-from requests import ConnectionError, HTTPError
-from time import sleep
 from boto3.exceptions import Boto3Error
 from botocore.exceptions import ClientError
 
-from .. import log_debug, log_info, log_warn, request_with_retries, os_to_settings
-from .. import ec2_tag_value, aws_get_region, ec2_node_ensure, ec2_node_public_ip
+from .. import log_debug, log_info, log_warn, request_with_retries, os_to_settings, env
+from .. import ec2_tag_value, aws_get_region, aws_client, ec2_node_ensure, ec2_node_public_ip
+from .. import ec2_inventory_lookup, ec2_inventory_invalidate, ec2_node_is_prepared
 
-from ..SSH import SSH, SSHError, SCP
+from ..SSH import SSH, SSHError
+from ..Bootstrap import Bootstrap, BootstrapError
+from ..Trace import traced, trace_span
+from ..NodePool import NodePool, node_pool_enabled
+from ..Manifest import run_manifest, ManifestError
+from ..Readiness import readiness_wait, readiness_api_timeout, ReadinessError, TCPProbe, HTTPProbe, StacksHealthyProbe
 
 
 class RancherServerError(RuntimeError):
@@ -43,8 +45,8 @@ class RancherServer(object):
                 result = True
                 missing = []
                 for envvar in required_envvars:
-                        if envvar not in os.environ:
-                                log_debug("Missing envvar \'{}\'!".format(envvar))
+                        if envvar not in env():
+                                log_debug("Missing envvar \'{}\'!", envvar)
                                 missing.append(envvar)
                                 result = False
                 if False is result:
@@ -57,11 +59,11 @@ class RancherServer(object):
         #
         def name(self):
                 n = ''
-                prefix = os.environ.get('AWS_PREFIX')
-                rancher_version = os.environ['RANCHER_VERSION'].replace('.', '')
-                docker_version = os.environ['RANCHER_DOCKER_VERSION'].replace('.', '').replace('~', '')
-                rancher_server_os = os.environ['RANCHER_SERVER_OPERATINGSYSTEM']
-                rancher_orch = os.environ['RANCHER_ORCHESTRATION']
+                prefix = env().get('AWS_PREFIX')
+                rancher_version = env()['RANCHER_VERSION'].replace('.', '')
+                docker_version = env()['RANCHER_DOCKER_VERSION'].replace('.', '').replace('~', '')
+                rancher_server_os = env()['RANCHER_SERVER_OPERATINGSYSTEM']
+                rancher_orch = env()['RANCHER_ORCHESTRATION']
 
                 if None is not prefix:
                         prefix = prefix.replace('.', '-')
@@ -71,21 +73,32 @@ class RancherServer(object):
 
                 return n.rstrip()
 
+        #
+        def __remember(self, **values):
+                try:
+                        run_manifest.set(**values)
+                except ManifestError as e:
+                        log_warn(e.message)
+
+        #
+        def __recall(self, key):
+                # values learned from another server, e.g. by an earlier run sharing the manifest, do not apply
+                if "http://{}:8080".format(self.IP()) != run_manifest.get('cattle_test_url'):
+                        return None
+                return run_manifest.get(key)
+
         #
         def IP(self):
-                log_debug("Getting IP address for node '{}'...".format(self.name()))
+                log_debug("Getting IP address for node '{}'...", self.name())
 
                 try:
-                        node_filter = [
-                                {'Name': 'tag:Name', 'Values': [self.name()]},
-                                {'Name': 'instance-state-name', 'Values': ['running']}
-                        ]
+                        node = ec2_inventory_lookup(self.name(), region=aws_get_region(), states=['running'])
+                        if None is node or None is node['public_ip']:
+                                raise RuntimeError("No running node found by name of '{}'!".format(self.name()))
 
-                        ec2 = boto3.client('ec2', region_name=aws_get_region())
-                        rez = ec2.describe_instances(Filters=node_filter)['Reservations']
-                        ipaddr = str(rez[0]['Instances'][0]['NetworkInterfaces'][0]['Association']['PublicIp'])
+                        ipaddr = str(node['public_ip'])
 
-                except (ClientError, Boto3Error) as e:
+                except RuntimeError as e:
                         msg = "Failed to resolve IP addr for '{}'!: {}".format(self.name(), str(e))
                         log_debug(msg)
                         raise RancherServerError(msg) from e
@@ -117,9 +130,15 @@ class RancherServer(object):
         #                 raise RancherServerError(msg)
 
         #
+        @traced('rancher_server.deprovision')
         def deprovision(self):
-                log_info("Deprovisioning Rancher Server '{}'...".format(self.name()))
-                region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
+                log_info("Deprovisioning Rancher Server '{}'...", self.name())
+                region = str(env()['AWS_DEFAULT_REGION']).rstrip()
+
+                if node_pool_enabled():
+                        server_os = str(env()['RANCHER_SERVER_OPERATINGSYSTEM']).rstrip()
+                        NodePool(region).release(self.name(), os_to_settings(server_os)['ssh_username'], server_os)
+                        return True
 
                 try:
                         node_filter = [
@@ -127,12 +146,12 @@ class RancherServer(object):
                                 {'Name': 'instance-state-name', 'Values': ['running']}
                         ]
 
-                        ec2 = boto3.client('ec2', region_name=region)
+                        ec2 = aws_client('ec2', region=region)
                         reservations = ec2.describe_instances(Filters=node_filter)['Reservations']
-                        log_debug("reservation info: {}".format(reservations))
+                        log_debug("reservation info: {}", reservations)
 
                         if len(reservations) < 1:
-                                log_info("No nodes matching name '{}' to deprovision.".format(self.name()))
+                                log_info("No nodes matching name '{}' to deprovision.", self.name())
 
                         elif len(reservations) > 1:
                                 msg = "Found more than one instance matching name '{}'. That's very strange!"
@@ -142,8 +161,9 @@ class RancherServer(object):
 
                         else:
                                 instance_id = reservations[0]['Instances'][0]['InstanceId']
-                                log_info("Deprovisioning '{}'...".format(instance_id))
+                                log_info("Deprovisioning '{}'...", instance_id)
                                 ec2.terminate_instances(InstanceIds=[instance_id])
+                                ec2_inventory_invalidate()
                                 # ec2.delete_key_pair(KeyName=self.name())
 
                 except (Boto3Error, ClientError) as e:
@@ -154,29 +174,26 @@ class RancherServer(object):
                 return True
 
         #
+        @traced('rancher_server.api_wait')
         def __wait_for_api_provider(self):
-                rancher_version = str(os.environ['RANCHER_VERSION']).rstrip()
-                if "v2" in rancher_version:
-                    api_url = "http://{}:8080/v3".format(self.IP())
-                else:
-                    api_url = "http://{}:8080/v2-beta".format(self.IP())
-                log_info("Polling \'{}\' for active API provider...".format(api_url))
+                log_info("Polling \'{}\' for active API provider...", self.api_url())
 
                 try:
-                        request_with_retries('GET', api_url, step=60, attempts=60)
-                except (ConnectionError, HTTPError) as e:
-                        msg = "Timed out waiting for API provider to become available!: {}".format(e.message)
+                        readiness_wait([TCPProbe(self.IP(), 8080), HTTPProbe(self.api_url())], timeout=readiness_api_timeout())
+                except ReadinessError as e:
+                        msg = "Timed out waiting for API provider to become available!: {}".format(str(e))
                         log_debug(msg)
                         raise RancherServerError(msg) from e
                 return True
 
         #
+        @traced('rancher_server.server_container')
         def __install_server_container(self):
-                rancher_version = str(os.environ['RANCHER_VERSION']).rstrip()
-                server_os = str(os.environ['RANCHER_SERVER_OPERATINGSYSTEM']).rstrip()
+                rancher_version = str(env()['RANCHER_VERSION']).rstrip()
+                server_os = str(env()['RANCHER_SERVER_OPERATINGSYSTEM']).rstrip()
                 os_settings = os_to_settings(server_os)
 
-                log_info('Deploying rancher/server:{}...'.format(rancher_version))
+                log_info('Deploying rancher/server:{}...', rancher_version)
 
                 try:
                          sshcmd = 'sudo docker run -e CATTLE_PROCESS_INSTANCE_PURGE_AFTER_SECONDS=172800 -d -p 8080:8080 --restart=always rancher/server:{}'.format(rancher_version)
@@ -188,28 +205,22 @@ class RancherServer(object):
                          raise RancherServerError(msg)
 
         #
+        @traced('rancher_server.docker_install')
         def __docker_install(self):
                 docker_version = ec2_tag_value(self.name(), 'rancher.docker.version')
 
-                log_info("Installing Docker version '{}'...".format(docker_version))
+                log_info("Installing Docker version '{}'...", docker_version)
 
                 try:
-                        server_os = str(os.environ['RANCHER_SERVER_OPERATINGSYSTEM']).rstrip()
+                        server_os = str(env()['RANCHER_SERVER_OPERATINGSYSTEM']).rstrip()
                         os_settings = os_to_settings(server_os)
 
-                        SCP(self.name(),
-                            self.IP(),
-                            os_settings['ssh_username'],
-                            './lib/bash/*.sh',
-                            '/tmp/')
-
-                        sshcmd = 'chmod +x /tmp/*.sh && /tmp/rancher_ci_bootstrap.sh'
-                        SSH(self.name(), self.IP(), os_settings['ssh_username'], sshcmd, max_attempts=1)
+                        Bootstrap().run(self.name(), self.IP(), os_settings['ssh_username'], max_attempts=1)
 
                         sshcmd = 'sudo usermod -aG docker $USER'
                         SSH(self.name(), self.IP(), os_settings['ssh_username'], sshcmd, max_attempts=2)
 
-                except SSHError as e:
+                except (SSHError, BootstrapError) as e:
                         msg = "Failed while installing Docker version {}!: {}".format(docker_version, str(e))
                         log_debug(msg)
                         raise RuntimeError(msg) from e
@@ -217,30 +228,41 @@ class RancherServer(object):
                 return True
 
         #
+        @traced('rancher_server.provision')
         def provision(self):
                 try:
-                        server_os = str(os.environ['RANCHER_SERVER_OPERATINGSYSTEM']).rstrip()
+                        server_os = str(env()['RANCHER_SERVER_OPERATINGSYSTEM']).rstrip()
                         os_settings = os_to_settings(server_os)
-                        region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
+                        region = str(env()['AWS_DEFAULT_REGION']).rstrip()
                         ssh_user = os_settings['ssh_username']
 
-                        ec2_node_ensure(self.name(), instance_type=os.environ.get('RANCHER_SERVER_AWS_INSTANCE_TYPE'))
-                        node_addr = ec2_node_public_ip(self.name(), region=region)
-
-                        SCP(self.name(), node_addr, ssh_user, './lib/bash/*.sh', '/tmp/')
-                        SSH(self.name(), node_addr, ssh_user, 'chmod +x /tmp/*.sh && /tmp/rancher_ci_bootstrap.sh')
+                        with trace_span('rancher_server.ec2_launch', node=self.name()):
+                                pooled = {}
+                                if node_pool_enabled():
+                                        pooled = NodePool(region).acquire([self.name()], env().get('RANCHER_SERVER_AWS_INSTANCE_TYPE', 'm4.large'), server_os)
+                                if self.name() not in pooled:
+                                        ec2_node_ensure(self.name(), instance_type=env().get('RANCHER_SERVER_AWS_INSTANCE_TYPE'),
+                                                        operatingsystem=server_os)
+                                node_addr = ec2_node_public_ip(self.name(), region=region)
+
+                        # baked images and pooled nodes already carry everything the bootstrap would install
+                        if ec2_node_is_prepared(self.name()):
+                                log_info("Node '{}' already has Docker installed. Skipping bootstrap.", self.name())
+                        else:
+                                with trace_span('rancher_server.bootstrap', node=self.name()):
+                                        Bootstrap().run(self.name(), node_addr, ssh_user)
 
 #                        # CoreOS and RancherOS ship w/ vendored Docker engine
 #                        if 'rancher' not in server_os and 'core' not in server_os:
 #                               self.__docker_install()
 
                         self.__install_server_container()
-                        pwd = str(os.environ['WORKSPACE_DIR']).rstrip()
+                        pwd = str(env()['WORKSPACE_DIR']).rstrip()
                         cattle_test_url_filename = pwd + '/cattle_test_url'
-                        log_debug("Current working directory: {}".format(pwd))
-                        if os.environ.get('BUILD_NUMBER'):
-                                cattle_test_url_filename = "{}/cattle_test_url.{}".format(pwd, os.environ.get('BUILD_NUMBER'))
-                                log_debug("Found BUILD_NUMBER so CATTLE_TEST_URL set in '{}'...".format(cattle_test_url_filename))
+                        log_debug("Current working directory: {}", pwd)
+                        if env().get('BUILD_NUMBER'):
+                                cattle_test_url_filename = "{}/cattle_test_url.{}".format(pwd, env().get('BUILD_NUMBER'))
+                                log_debug("Found BUILD_NUMBER so CATTLE_TEST_URL set in '{}'...", cattle_test_url_filename)
                         else:
                                 log_debug("Did not find BUILD_NUMBER so CATTLE_TEST_URL is set in default of 'cattle_test_url'...")
 
@@ -248,8 +270,11 @@ class RancherServer(object):
                                 f.write("http://{}:8080".format(self.IP()))
                                 f.close()
 
+                        # anything learned from an earlier server by this name is stale now
+                        self.__remember(cattle_test_url="http://{}:8080".format(self.IP()), project_id=None, reg_command=None)
+
                         public_ip = ec2_node_public_ip(self.name())
-                        log_info("Rancher Server will be available at 'http://{}:8080' shortly...".format(public_ip))
+                        log_info("Rancher Server will be available at 'http://{}:8080' shortly...", public_ip)
 
                 except RuntimeError as e:
                         msg = "Failed while provisining Rancher Server!: {}".format(str(e))
@@ -257,6 +282,24 @@ class RancherServer(object):
                         raise RancherServerError(msg) from e
 
         #
+        @traced('rancher_server.infra_wait')
+        def wait_for_infrastructure(self, timeout=600):
+                rancher_version = str(env()['RANCHER_VERSION']).rstrip()
+                if "v2" in rancher_version:
+                        log_info("Rancher '{}' has no infrastructure stacks to wait on.", rancher_version)
+                        return True
+
+                try:
+                        readiness_wait([HTTPProbe(self.api_url()), StacksHealthyProbe(self.api_url(), self.project_id())], timeout=timeout)
+                except ReadinessError as e:
+                        msg = "Infrastructure stacks did not become healthy!: {}".format(e.message)
+                        log_debug(msg)
+                        raise RancherServerError(msg) from e
+
+                return True
+
+        #
+        @traced('rancher_server.reg_token')
         def __set_reg_token(self, project_id):
                 log_info("Setting the initial agent reg token...")
                 reg_url = "http://{}:8080/v2-beta/projects/{}/registrationtokens".format(self.IP(), project_id)
@@ -267,18 +310,69 @@ class RancherServer(object):
                         log_debug(msg)
                         raise RancherServerError(msg) from e
 
-                log_debug("reg token response: {}".format(response))
+                log_debug("reg token response: {}", response)
                 log_info('Sucesssfully set the initial agent reg token.')
                 return True
 
         #
+        def api_url(self):
+                rancher_version = str(env()['RANCHER_VERSION']).rstrip()
+                if "v2" in rancher_version:
+                        return "http://{}:8080/v3".format(self.IP())
+                return "http://{}:8080/v2-beta".format(self.IP())
+
+        #
+        def project_id(self):
+                rancher_orch = str(env()['RANCHER_ORCHESTRATION']).rstrip()
+                project_id = self.__recall('project_id')
+                if None is not project_id:
+                        return project_id
+                project_id = '1a5'
+
+                # same as 'rancher env ls --quiet | grep -v 1a5' but without forking the CLI
+                if rancher_orch == 'k8s':
+                        try:
+                                response = request_with_retries('GET', "{}/projects?limit=-1".format(self.api_url()))
+                                project_ids = [project['id'] for project in response.json()['data'] if '1a5' != project['id']]
+                                project_id = project_ids[0]
+
+                        except (IndexError, KeyError, ValueError, Failure) as e:
+                                msg = "Failed while resolving the k8s project id!: {}".format(str(e))
+                                log_debug(msg)
+                                raise RancherServerError(msg) from e
+
+                return project_id
+
+        #
+        def hosts(self, project_id='1a5'):
+                rancher_version = str(env()['RANCHER_VERSION']).rstrip()
+                if "v2" in rancher_version:
+                        hosts_url = "{}/hosts?limit=-1".format(self.api_url())
+                else:
+                        hosts_url = "{}/projects/{}/hosts?limit=-1".format(self.api_url(), project_id)
+
+                try:
+                        response = request_with_retries('GET', hosts_url, step=5, attempts=3)
+                        hosts = response.json()['data']
+
+                except (KeyError, ValueError, Failure) as e:
+                        msg = "Failed while listing hosts!: {}".format(str(e))
+                        log_debug(msg)
+                        raise RancherServerError(msg) from e
+
+                return hosts
+
+        #
+        @traced('rancher_server.reg_command')
         def reg_command(self):
+                reg_command = self.__recall('reg_command')
+                if None is not reg_command:
+                        log_debug("reg command from run manifest: {}", reg_command)
+                        return reg_command
+
                 try:
-                        rancher_version = str(os.environ['RANCHER_VERSION']).rstrip()
-                        rancher_orch = str(os.environ['RANCHER_ORCHESTRATION']).rstrip()
-                        project_id = '1a5'
-                        if rancher_orch == 'k8s':
-                            project_id = run('rancher --url http://{}:8080 env ls --quiet | grep -v 1a5'.format(self.IP())).stdout.rstrip('\n\r')
+                        rancher_version = str(env()['RANCHER_VERSION']).rstrip()
+                        project_id = self.project_id()
                         if "v2" in rancher_version:
                             query_url = "http://{}:8080/v3/clusters/1c1/".format(self.IP())
                             response = request_with_retries('GET', query_url)
@@ -288,7 +382,8 @@ class RancherServer(object):
                             response = request_with_retries('GET', query_url)
                             reg_command = response.json()['data'][0]['command']
 
-                        log_debug("reg command: {}".format(reg_command))
+                        log_debug("reg command: {}", reg_command)
+                        self.__remember(reg_command=reg_command)
 
                 except (IndexError, KeyError, RancherServerError) as e:
                         msg = "Failed while retrieving registration command!: {}".format(str(e))
@@ -298,9 +393,10 @@ class RancherServer(object):
                 return reg_command
 
         #
+        @traced('rancher_server.reg_url')
         def __set_reg_url(self):
                 log_info("Setting the agent registration URL...")
-                rancher_version = str(os.environ['RANCHER_VERSION']).rstrip()
+                rancher_version = str(env()['RANCHER_VERSION']).rstrip()
                 if "v2" in rancher_version:
                     reg_url = "http://{}:8080/v3/settings/api.host".format(self.IP())
                 else:
@@ -315,47 +411,49 @@ class RancherServer(object):
                                 "value": "http://{}:8080".format(self.IP())
                         }
 
-                        response = request_with_retries('PUT', reg_url, request_data)
+                        # the API answers reads a while before it accepts writes, so keep trying for up to ten minutes
+                        response = request_with_retries('PUT', reg_url, request_data, step=10, attempts=60)
 
                 except Failure as e:
                         msg = "Failed setting the agent registration URL! : {}".format(str(e))
                         log_debug(msg)
                         raise RancherServerError(msg) from e
 
-                log_debug("reg url response: {}".format(response))
+                log_debug("reg url response: {}", response)
                 log_info('Successfully set the agent registration URL.')
                 return True
 
         #
+        @traced('rancher_server.configure')
         def configure(self):
                 try:
-                        rancher_orch = str(os.environ['RANCHER_ORCHESTRATION']).rstrip()
+                        rancher_orch = str(env()['RANCHER_ORCHESTRATION']).rstrip()
                         self.__wait_for_api_provider()
-                        log_info("Though the API provider is available, experience suggests sleeping for a bit is a good idea...")
-                        sleep(30)
+
                         project_id = '1a5'
                         if rancher_orch == 'k8s':
                             project_id = run('rancher --url http://{}:8080 env create -t kubernetes kubetest'.format(self.IP())).stdout.rstrip('\r\n')
-                        pwd = str(os.environ['WORKSPACE_DIR']).rstrip()
+                        pwd = str(env()['WORKSPACE_DIR']).rstrip()
                         project_id_filename = pwd + '/project_id'
-                        log_debug("Current working directory: {}".format(pwd))
-                        if os.environ.get('BUILD_NUMBER'):
-                                project_id_filename = "{}/project_id.{}".format(pwd, os.environ.get('BUILD_NUMBER'))
-                                log_debug("Found BUILD_NUMBER so PROJECT_ID set in '{}'...".format(project_id_filename))
+                        log_debug("Current working directory: {}", pwd)
+                        if env().get('BUILD_NUMBER'):
+                                project_id_filename = "{}/project_id.{}".format(pwd, env().get('BUILD_NUMBER'))
+                                log_debug("Found BUILD_NUMBER so PROJECT_ID set in '{}'...", project_id_filename)
                         else:
                                 log_debug("Did not find BUILD_NUMBER so PROJECT_ID is set in default of 'project_id'...")
 
                         with open(project_id_filename, 'w+') as f:
                                 f.write("{}".format(project_id))
                                 f.close()
-                        rancher_version = str(os.environ['RANCHER_VERSION']).rstrip()
+                        self.__remember(project_id=project_id)
+                        rancher_version = str(env()['RANCHER_VERSION']).rstrip()
                         if "v2" not in rancher_version:
                             self.__set_reg_token(project_id)
                         self.__set_reg_url()
 
-                except RancherServerError as e:
-                        msg = "Failed while configuring Rancher server \'{}\'!: {}".format(self.__name(), e.message)
+                except (RancherServerError, Failure) as e:
+                        msg = "Failed while configuring Rancher server \'{}\'!: {}".format(self.name(), str(e))
                         log_debug(msg)
-                        raise RancherServer(msg) from e
+                        raise RancherServerError(msg) from e
 
                 return True
@@ -0,0 +1,163 @@
+import time, socket
+
+from abc import ABC, abstractmethod
+from requests import RequestException
+
+from .. import log_debug, log_info, backoff_delays, env, http_session
+from ..Trace import trace_span
+
+
+#
+class ReadinessError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(ReadinessError, self).__init__(self.message)
+
+
+#
+def readiness_api_timeout():
+    return int(str(env().get('RANCHER_API_WAIT_TIMEOUT', 3600)).rstrip())
+
+
+#
+def tcp_connect(host, port, timeout):
+    socket.create_connection((host, port), timeout=timeout).close()
+    return True
+
+
+#
+class ReadinessProbe(ABC):
+    """
+    One condition to wait on, polled by readiness_wait().
+
+    Subclasses set 'name' for logging and implement check(), which looks once
+    and returns a tuple of (ready, detail): whether the condition holds and a
+    short description of what was seen. Failures to reach the thing being
+    probed are a 'not ready' result, never an exception.
+    """
+
+    name = None
+
+    #
+    @abstractmethod
+    def check(self):
+        pass
+
+
+#
+class TCPProbe(ReadinessProbe):
+
+    #
+    def __init__(self, host, port, timeout=3):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.name = 'tcp {}:{}'.format(host, port)
+
+    #
+    def check(self):
+        try:
+            tcp_connect(self.host, self.port, self.timeout)
+        except (socket.error, socket.timeout) as e:
+            return False, str(e)
+        return True, 'port open'
+
+
+#
+class HTTPProbe(ReadinessProbe):
+
+    #
+    def __init__(self, url, status=200, timeout=5):
+        self.url = url
+        self.status = status
+        self.timeout = timeout
+        self.name = 'http {}'.format(url)
+
+    #
+    def check(self):
+        try:
+            response = http_session(self.url).get(self.url, timeout=self.timeout)
+        except RequestException as e:
+            return False, str(e)
+        return self.status == response.status_code, 'HTTP {}'.format(response.status_code)
+
+
+#
+class StacksHealthyProbe(ReadinessProbe):
+    """
+    Every infrastructure stack of a project is active and healthy.
+    """
+
+    #
+    def __init__(self, api_url, project_id, timeout=5):
+        self.url = '{}/projects/{}/stacks?system=true&limit=-1'.format(api_url, project_id)
+        self.timeout = timeout
+        self.name = 'infrastructure stacks of {}'.format(project_id)
+
+    #
+    def check(self):
+        try:
+            response = http_session(self.url).get(self.url, timeout=self.timeout)
+            if 200 != response.status_code:
+                return False, 'HTTP {}'.format(response.status_code)
+            stacks = response.json()['data']
+
+        except (RequestException, KeyError, ValueError) as e:
+            return False, str(e)
+
+        # the catalogs are only deployed once agents register, so no stacks yet is not ready
+        if 0 == len(stacks):
+            return False, 'no infrastructure stacks yet'
+
+        unhealthy = ['{} ({}/{})'.format(stack['name'], stack.get('state'), stack.get('healthState'))
+                     for stack in stacks if 'active' != stack.get('state') or 'healthy' != stack.get('healthState')]
+        if 0 != len(unhealthy):
+            return False, 'waiting on {}'.format(', '.join(unhealthy))
+        return True, '{} stack(s) healthy'.format(len(stacks))
+
+
+#
+def readiness_wait(probes, timeout=600, maximum=10):
+    """
+    Poll probes in order, returning as soon as all of them hold.
+
+    A probe is only polled once the probes before it hold, and is not polled
+    again afterwards. Polling backs off from one second up to 'maximum'
+    seconds and starts over at each new probe.
+
+    Args:
+      probes (list): ReadinessProbe objects, cheapest and earliest condition first
+      timeout (int): seconds to wait on all of the probes together
+      maximum (int): cap in seconds on a single sleep between polls
+
+    Returns:
+      dict: probe name to seconds waited until it held
+    """
+    starttime = time.time()
+    waited = {}
+
+    for probe in probes:
+        log_info("Waiting on '{}'...", probe.name)
+        delays = backoff_delays(initial=1, maximum=maximum)
+
+        with trace_span('readiness.probe', probe=probe.name):
+            while True:
+                ready, detail = probe.check()
+                log_debug("probe '{}': ready: {} ; {}", probe.name, ready, detail)
+                if ready:
+                    break
+
+                remaining = timeout - (time.time() - starttime)
+                if remaining <= 0:
+                    msg = "Timed out after {} seconds waiting on '{}'!: {}".format(timeout, probe.name, detail)
+                    log_debug(msg)
+                    raise ReadinessError(msg)
+
+                time.sleep(min(next(delays), remaining))
+
+        waited[probe.name] = time.time() - starttime
+        log_info("'{}' is ready after {:.1f} seconds: {}", probe.name, waited[probe.name], detail)
+
+    return waited
@@ -1,7 +1,15 @@
-import time
+import os, sys, glob, time, codecs, socket, atexit, threading
+from concurrent.futures import as_completed
 from invoke import run, Failure
 
-from .. import log_debug, log_info
+# paramiko is optional; without it every command falls back to forking ssh/scp.
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+from .. import log_debug, log_info, log_warn, env, EnvThreadPoolExecutor
+from ..Trace import trace_span
 
 
 #
@@ -13,48 +21,256 @@ class SSHError(RuntimeError):
         super(SSHError, self).__init__(self.message)
 
 
+#
+def ssh_read_timeout():
+    return int(str(env().get('RANCHER_SSH_READ_TIMEOUT', '600')).rstrip())
+
+
+#
+class SSHResult(object):
+
+    return_code = None
+    stdout = None
+
+    #
+    def __init__(self, return_code, stdout):
+        self.return_code = return_code
+        self.stdout = stdout
+
+    #
+    @property
+    def ok(self):
+        return 0 == self.return_code
+
+
+#
+class SSHConnectionPool(object):
+    """
+    Authenticated SSH sessions shared per (host, user, key).
+
+    The first command against a node pays for the TCP connect, key exchange
+    and auth. Later commands and file copies open a new channel on the same
+    session. Sessions are kept alive and reopened when they have dropped.
+    """
+
+    #
+    def __init__(self, keepalive=30):
+        self.__keepalive = keepalive
+        self.__lock = threading.Lock()
+        self.__locks = {}
+        self.__sessions = {}
+
+    #
+    def __key_lock(self, key):
+        with self.__lock:
+            if key not in self.__locks:
+                self.__locks[key] = threading.Lock()
+            return self.__locks[key]
+
+    #
+    def session(self, addr, user, key, timeout=10):
+        pool_key = (addr, user, key)
+
+        with self.__key_lock(pool_key):
+            client = self.__sessions.get(pool_key)
+            transport = None if None is client else client.get_transport()
+
+            if None is transport or not transport.is_active():
+                if None is not client:
+                    log_debug("ssh session to {}@{} has dropped. Reconnecting...", user, addr)
+                    client.close()
+
+                log_debug("Opening ssh session to {}@{}...", user, addr)
+                client = paramiko.SSHClient()
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                client.connect(addr,
+                               username=user,
+                               key_filename='.ssh/{}'.format(key),
+                               timeout=timeout,
+                               allow_agent=False,
+                               look_for_keys=False)
+                client.get_transport().set_keepalive(self.__keepalive)
+                self.__sessions[pool_key] = client
+
+        return client
+
+    #
+    def discard(self, addr, user, key):
+        pool_key = (addr, user, key)
+
+        with self.__key_lock(pool_key):
+            client = self.__sessions.pop(pool_key, None)
+            if None is not client:
+                client.close()
+
+    #
+    def close_all(self):
+        with self.__lock:
+            sessions = list(self.__sessions.values())
+            self.__sessions.clear()
+
+        for client in sessions:
+            client.close()
+
+    #
+    def run(self, addr, user, key, cmd, timeout=10, tag=None):
+        channel = self.session(addr, user, key, timeout).get_transport().open_session()
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        output = []
+        pending = ''
+
+        try:
+            # equivalent of 'ssh -tt'; sudo on some distros insists on a tty
+            channel.get_pty()
+            channel.settimeout(ssh_read_timeout())
+            channel.exec_command(cmd)
+
+            # echo whole lines only, so tagged output of parallel nodes does not interleave mid-line
+            while True:
+                try:
+                    data = channel.recv(32768)
+                except socket.timeout as e:
+                    msg = "ssh command '{}' on {}@{} printed nothing for {} seconds!".format(cmd, user, addr, ssh_read_timeout())
+                    log_debug(msg)
+                    raise SSHError(msg) from e
+
+                if not data:
+                    break
+
+                lines, newline, pending = (pending + decoder.decode(data)).rpartition('\n')
+                if newline:
+                    output.append(lines + newline)
+                    ssh_echo(lines + newline, tag)
+
+            pending += decoder.decode(b'', final=True)
+            if pending:
+                output.append(pending)
+                ssh_echo(pending, tag)
+
+            return_code = channel.recv_exit_status()
+
+        finally:
+            channel.close()
+
+        return SSHResult(return_code, ''.join(output))
+
+    #
+    def put(self, addr, user, key, src, dst, timeout=10):
+        sftp = self.session(addr, user, key, timeout).open_sftp()
+
+        try:
+            srcs = sorted(glob.glob(src))
+            if 0 == len(srcs):
+                return SSHResult(1, "No such file or directory: {}".format(src))
+
+            for path in srcs:
+                remote = dst
+                if dst.endswith('/') or 1 < len(srcs):
+                    remote = '{}/{}'.format(dst.rstrip('/'), os.path.basename(path))
+
+                log_debug("Copying '{}' to {}@{}:{}...", path, user, addr, remote)
+                sftp.put(path, remote)
+                sftp.chmod(remote, os.stat(path).st_mode & 0o777)
+
+        finally:
+            sftp.close()
+
+        return SSHResult(0, '')
+
+
+#
+def ssh_echo(output, tag=None):
+    for line in output.splitlines(True):
+        if None is not tag:
+            line = '[{}] {}'.format(tag, line)
+        sys.stdout.write(line)
+    sys.stdout.flush()
+
+
+#
+ssh_pool = SSHConnectionPool()
+atexit.register(ssh_pool.close_all)
+
+
+#
+def ssh_pooled_transport():
+    transport = str(env().get('RANCHER_SSH_TRANSPORT', 'pooled')).rstrip()
+    return None is not paramiko and 'subprocess' != transport
+
+
+#
+def ssh_transport_errors():
+    if None is paramiko:
+        return (socket.error, EOFError)
+    return (socket.error, EOFError, paramiko.SSHException)
+
+
 #
 class SSH(object):
 
     default_ssh_options = None
+    return_code = None
+    stdout = None
 
     #
-    def __cmd(self, key, addr, user, cmd, max_attempts=10):
+    def __cmd(self, key, addr, user, cmd, timeout, max_attempts=10, tag=None):
         sshcmd = "ssh {} {}@{} '{}'".format(self.default_ssh_options, user, addr, cmd)
         result = None
 
         attempts = 0
         while attempts < max_attempts:
             try:
-                log_debug("Running ssh cmd  '{}'...".format(sshcmd))
                 attempts += 1
-                result = run(sshcmd, echo=True)
+                if ssh_pooled_transport():
+                    log_debug("Running pooled ssh cmd '{}' on {}@{}...", cmd, user, addr)
+                    result = ssh_pool.run(addr, user, key, cmd, timeout, tag)
+                elif None is not tag:
+                    log_debug("Running ssh cmd  '{}'...", sshcmd)
+                    result = run(sshcmd, hide=True)
+                    ssh_echo(result.stdout, tag)
+                else:
+                    log_debug("Running ssh cmd  '{}'...", sshcmd)
+                    result = run(sshcmd, echo=True)
+
                 if result.ok:
-                    log_debug('ssh cmd output: {}'.format(result.stdout))
+                    log_debug('ssh cmd output: {}', result.stdout)
                     break
+                else:
+                    msg = "ssh command failed!: {}".format(result.return_code)
+                    log_info(msg)
+                    result = None
+                    time.sleep(30)
 
             except Failure as e:
                 msg = "ssh command failed!: {} :: {}".format(e.result.return_code, e.result.stderr)
                 log_info(msg)
                 time.sleep(30)
 
+            except ssh_transport_errors() as e:
+                msg = "ssh session to {}@{} failed!: {}".format(user, addr, str(e))
+                log_info(msg)
+                ssh_pool.discard(addr, user, key)
+                time.sleep(30)
+
         if attempts >= max_attempts and not result:
             msg = "SSH command exceeded max attempts!"
             log_debug(msg)
             raise SSHError(msg)
 
+        self.stdout = result.stdout
         return result.return_code
 
     #
-    def __init__(self, key, addr, user, cmd, timeout=10, max_attempts=10):
+    def __init__(self, key, addr, user, cmd, timeout=10, max_attempts=10, tag=None):
         self.default_ssh_options = '-o StrictHostKeyChecking=no -o ConnectTimeout={} -tt -i .ssh/{}'.format(timeout, key)
-        self.__cmd(key, addr, user, cmd, max_attempts)
+        self.return_code = self.__cmd(key, addr, user, cmd, timeout, max_attempts, tag)
 
 
 #
 class SCP(object):
 
     default_ssh_options = None
+    return_code = None
 
     #
     def __cp(self, key, addr, user, src, dst, timeout, max_attempts):
@@ -65,17 +281,33 @@ class SCP(object):
         attempts = 0
         while attempts < max_attempts:
             try:
-                log_debug("Running scp cmd  '{}'...".format(scpcmd))
                 attempts += 1
-                result = run(scpcmd, echo=True)
+                if ssh_pooled_transport():
+                    log_debug("Copying '{}' to {}@{}:{} over pooled ssh session...", src, user, addr, dst)
+                    result = ssh_pool.put(addr, user, key, src, dst, timeout)
+                else:
+                    log_debug("Running scp cmd  '{}'...", scpcmd)
+                    result = run(scpcmd, echo=True)
+
                 if result.ok:
                     break
+                else:
+                    msg = "scp command failed!: {} :: {}".format(result.return_code, result.stdout)
+                    log_debug(msg)
+                    result = None
+                    time.sleep(30)
 
             except Failure as e:
                 msg = "scp command failed!: {} :: {}".format(e.result.return_code, e.result.stderr)
                 log_debug(msg)
                 time.sleep(30)
 
+            except (IOError, OSError) + ssh_transport_errors() as e:
+                msg = "scp to {}@{} failed!: {}".format(user, addr, str(e))
+                log_debug(msg)
+                ssh_pool.discard(addr, user, key)
+                time.sleep(30)
+
         if attempts >= max_attempts and not result:
             msg = "SCP command exceeded max attempts!"
             log_info(msg)
@@ -87,4 +319,136 @@ class SCP(object):
     #
     def __init__(self, key, addr, user, src, dest, timeout=10, max_attempts=10):
         self.default_ssh_options = '-o StrictHostKeyChecking=no -o ConnectTimeout={} -i .ssh/{}'.format(timeout, key)
-        self.__cp(key, addr, user, src, dest, timeout, max_attempts)
+        self.return_code = self.__cp(key, addr, user, src, dest, timeout, max_attempts)
+
+
+#
+class FanOutResult(object):
+
+    name = None
+    addr = None
+    return_code = None
+    elapsed = None
+    error = None
+
+    #
+    def __init__(self, name, addr, return_code=None, elapsed=None, error=None):
+        self.name = name
+        self.addr = addr
+        self.return_code = return_code
+        self.elapsed = elapsed
+        self.error = error
+
+    #
+    @property
+    def ok(self):
+        return None is self.error and 0 == self.return_code
+
+    #
+    def __repr__(self):
+        return "FanOutResult(name={}, addr={}, return_code={}, elapsed={:.1f}, error={})".format(
+            self.name, self.addr, self.return_code, self.elapsed or 0.0, self.error)
+
+
+#
+def fan_out_parallelism():
+    return int(str(env().get('RANCHER_SSH_PARALLELISM', '10')).rstrip())
+
+
+#
+def fan_out_fail_fast():
+    return 'false' != str(env().get('RANCHER_SSH_FAIL_FAST', 'true')).rstrip()
+
+
+#
+def fan_out(nodes, action, parallelism=None, fail_fast=None, label='fan_out.node'):
+    """
+    Run an action against many nodes with bounded concurrency.
+
+    Args:
+      nodes (list): (name, addr, user) tuples; name is also the ssh key name
+      action (callable): called with (name, addr, user), returns an exit code; a RuntimeError fails the node
+      parallelism (int): max nodes worked on at once, defaults to RANCHER_SSH_PARALLELISM
+      fail_fast (bool): stop scheduling nodes after the first failure, defaults to RANCHER_SSH_FAIL_FAST
+      label (str): name of the trace span recorded per node
+
+    Returns:
+      list: FanOutResult per node, in the order of nodes
+    """
+    if None is parallelism:
+        parallelism = fan_out_parallelism()
+    if None is fail_fast:
+        fail_fast = fan_out_fail_fast()
+
+    results = {}
+    futures = {}
+
+    #
+    def timed(name, addr, user):
+        start = time.time()
+        try:
+            with trace_span(label, node=name, addr=addr):
+                return_code = action(name, addr, user)
+            return FanOutResult(name, addr, return_code, time.time() - start)
+        except (SSHError, RuntimeError) as e:
+            return FanOutResult(name, addr, None, time.time() - start, str(e))
+
+    if 0 == len(nodes):
+        return []
+
+    with EnvThreadPoolExecutor(max_workers=max(1, min(parallelism, len(nodes)))) as pool:
+        for name, addr, user in nodes:
+            futures[pool.submit(timed, name, addr, user)] = name
+
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+
+            result = future.result()
+            results[result.name] = result
+            log_debug("fan out result: {}", result)
+
+            if not result.ok and fail_fast:
+                log_warn("Node '{}' failed. Cancelling nodes which have not started yet...", result.name)
+                for pending in futures:
+                    pending.cancel()
+
+    return [results[name] for name, addr, user in nodes if name in results]
+
+
+#
+def fan_out_check(results, nodes, what):
+    failed = [result.name for result in results if not result.ok]
+    skipped = [name for name, addr, user in nodes if name not in [result.name for result in results]]
+
+    if 0 != len(failed) or 0 != len(skipped):
+        problems = []
+        if 0 != len(failed):
+            problems.append("failed on node(s) '{}'".format(', '.join(failed)))
+        if 0 != len(skipped):
+            problems.append("skipped node(s) '{}'".format(', '.join(skipped)))
+        msg = "Failed while {}: {}!".format(what, ' and '.join(problems))
+        log_debug(msg)
+        raise SSHError(msg)
+
+    return results
+
+
+#
+def ssh_fan_out(nodes, cmd, parallelism=None, fail_fast=None, max_attempts=10):
+
+    #
+    def action(name, addr, user):
+        return SSH(name, addr, user, cmd, max_attempts=max_attempts, tag=name).return_code
+
+    return fan_out_check(fan_out(nodes, action, parallelism, fail_fast, 'ssh.node'), nodes, "running '{}'".format(cmd))
+
+
+#
+def scp_fan_out(nodes, src, dst, parallelism=None, fail_fast=None, max_attempts=10):
+
+    #
+    def action(name, addr, user):
+        return SCP(name, addr, user, src, dst, max_attempts=max_attempts).return_code
+
+    return fan_out_check(fan_out(nodes, action, parallelism, fail_fast, 'scp.node'), nodes, "copying '{}'".format(src))
@@ -0,0 +1,159 @@
+import os, json, time, fcntl, atexit, functools, threading
+from contextlib import contextmanager
+
+from .. import log_debug, log_info, env
+
+
+#
+class TraceError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(TraceError, self).__init__(self.message)
+
+
+#
+def trace_enabled():
+    return 'true' == str(env().get('RANCHER_TRACE', 'false')).rstrip()
+
+
+#
+def trace_path():
+    workspace = str(env().get('WORKSPACE_DIR', os.getcwd())).rstrip()
+    if env().get('BUILD_NUMBER'):
+        return "{}/trace.{}.json".format(workspace, str(env()['BUILD_NUMBER']).rstrip())
+    return "{}/trace.json".format(workspace)
+
+
+#
+class Tracer(object):
+    """
+    Collect nested, per-thread spans and write them in Chrome trace-event format.
+
+    Each invoke process appends its spans to the trace file for the build so
+    one file covers every stage of a pipeline run. Open it in chrome://tracing
+    or https://ui.perfetto.dev. A span goes to the trace file of the build it
+    was recorded for, so matrix cells each get their own.
+    """
+
+    #
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__events = {}
+        self.__threads = {}
+        self.__registered = False
+
+    #
+    def record(self, name, start, end, args):
+        thread = threading.current_thread()
+
+        event = {
+            'name': name,
+            'cat': 'phase',
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int((end - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': thread.ident,
+            'args': args
+        }
+
+        path = trace_path()
+        with self.__lock:
+            self.__events.setdefault(path, []).append(event)
+            self.__threads[thread.ident] = thread.name
+
+            if not self.__registered:
+                atexit.register(self.flush)
+                self.__registered = True
+
+    #
+    @contextmanager
+    def span(self, name, **args):
+        if not trace_enabled():
+            yield
+            return
+
+        start = time.time()
+        try:
+            yield
+        except BaseException as e:
+            args['error'] = str(e)
+            raise
+        finally:
+            self.record(name, start, time.time(), args)
+
+    #
+    def flush(self, path=None):
+        with self.__lock:
+            grouped = self.__events
+            threads = self.__threads
+            self.__events = {}
+            self.__threads = {}
+
+        # an explicit path takes every span regardless of the build it was recorded for
+        if None is not path:
+            grouped = {path: [event for events in grouped.values() for event in events]}
+
+        written = False
+        for events_path in sorted(grouped.keys()):
+            if 0 != len(grouped[events_path]):
+                written = self.__write(events_path, grouped[events_path], threads) or written
+
+        return written
+
+    #
+    def __write(self, path, events, threads):
+        pid = os.getpid()
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                       'args': {'name': 'invoke[{}]'.format(pid)}})
+        for tid, thread_name in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}})
+
+        try:
+            # several invoke processes may append to the same build trace
+            with open('{}.lock'.format(path), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+                trace = {'traceEvents': [], 'displayTimeUnit': 'ms'}
+                if os.path.isfile(path):
+                    with open(path, 'r') as f:
+                        trace = json.load(f)
+                trace['traceEvents'].extend(events)
+
+                tmppath = '{}.{}.tmp'.format(path, pid)
+                with open(tmppath, 'w') as f:
+                    json.dump(trace, f)
+                os.replace(tmppath, path)
+
+        except (IOError, OSError, ValueError) as e:
+            msg = "Failed while writing trace file '{}'!: {}".format(path, str(e))
+            log_debug(msg)
+            raise TraceError(msg) from e
+
+        log_info("Wrote {} trace events to '{}'.", len(events), path)
+        return True
+
+
+#
+tracer = Tracer()
+
+
+#
+def trace_span(name, **args):
+    return tracer.span(name, **args)
+
+
+#
+def traced(name):
+
+    #
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    return decorator
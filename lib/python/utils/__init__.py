@@ -1,12 +1,16 @@
-import os, sys, fnmatch, numpy, logging, yaml, inspect, requests, boto3, time
+import os, sys, json, fnmatch, hashlib, logging, yaml, requests, boto3, time, threading, random
 
+from collections import ChainMap
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from plumbum import colors
 from invoke import run, Failure
-from os import walk
-from requests import ConnectionError, HTTPError
+from requests import ConnectionError, HTTPError, Timeout
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
 from time import sleep
 from boto3.exceptions import Boto3Error
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, WaiterError
 
 
 # This might be bad...assuming that wherever this is running its always going to be
@@ -14,14 +18,77 @@ from botocore.exceptions import ClientError
 colors.use_color = 3
 
 
+#
+# Configuration is read through env() rather than straight from os.environ so that a thread can
+# run with its own overlay of settings, e.g. one cell of a matrix run. Without an overlay env()
+# is os.environ itself.
+env_local = threading.local()
+
+
+#
+def env():
+    overlay = getattr(env_local, 'overlay', None)
+    if None is overlay:
+        return os.environ
+    return overlay
+
+
+#
+@contextmanager
+def env_overlay(values):
+    previous = getattr(env_local, 'overlay', None)
+    overlay = ChainMap(dict(values), os.environ if None is previous else previous)
+
+    env_local.overlay = overlay
+    try:
+        yield overlay
+    finally:
+        env_local.overlay = previous
+
+
+#
+def env_bound(fn):
+    """
+    Wrap fn so that it runs under the calling thread's overlay from whichever thread calls it.
+
+    Args:
+      fn (callable): function to wrap
+
+    Returns:
+      callable: fn bound to the current overlay
+    """
+    overlay = getattr(env_local, 'overlay', None)
+
+    def bound(*args, **kwargs):
+        previous = getattr(env_local, 'overlay', None)
+        env_local.overlay = overlay
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            env_local.overlay = previous
+
+    return bound
+
+
+#
+class EnvThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor whose workers see the overlay of the thread which submitted the work.
+    """
+
+    #
+    def submit(self, fn, *args, **kwargs):
+        return super(EnvThreadPoolExecutor, self).submit(env_bound(fn), *args, **kwargs)
+
+
 #
 def ec2_compute_tags(nodename):
     # in addition to AWS_TAGS, include a tag for Docker version which will be
     # referenced by later provisining scripts.
-    docker_version = str(os.environ['RANCHER_DOCKER_VERSION']).rstrip()
-    docker_native = str(os.environ.get('RANCHER_DOCKER_NATIVE', 'false')).rstrip()
-    rhel_selinux = str(os.environ.get('RANCHER_DOCKER_RHEL_SELINUX', 'false')).rstrip()
-    tags = str(os.environ['AWS_TAGS']).rstrip()
+    docker_version = str(env()['RANCHER_DOCKER_VERSION']).rstrip()
+    docker_native = str(env().get('RANCHER_DOCKER_NATIVE', 'false')).rstrip()
+    rhel_selinux = str(env().get('RANCHER_DOCKER_RHEL_SELINUX', 'false')).rstrip()
+    tags = str(env()['AWS_TAGS']).rstrip()
     tags += ',rancher.docker.version,{}'.format(docker_version)
     tags += ',rancher.docker.native,{}'.format(docker_native)
     tags += ',rancher.docker.rhel.selinux,{}'.format(rhel_selinux)
@@ -31,13 +98,90 @@ def ec2_compute_tags(nodename):
 
 #
 def aws_get_region():
-    return str(os.environ['AWS_DEFAULT_REGION']).rstrip()
+    return str(env()['AWS_DEFAULT_REGION']).rstrip()
+
+
+#
+# boto3 Sessions and resources are not thread-safe but clients are once created. So clients are
+# shared by every thread while resources are cached per thread. Creation is always serialized on
+# the one shared Session.
+aws_cache_lock = threading.RLock()
+aws_cache = {'session': None, 'clients': {}, 'generation': 0}
+aws_thread_cache = threading.local()
+
+# callables run against every new shared Session, e.g. to register botocore event handlers
+aws_session_hooks = []
+
+
+#
+def aws_session():
+    with aws_cache_lock:
+        if None is aws_cache['session']:
+            log_debug('Creating shared boto3 session...')
+            aws_cache['session'] = boto3.session.Session()
+            for hook in aws_session_hooks:
+                hook(aws_cache['session'])
+
+        return aws_cache['session']
+
+
+#
+def aws_client(service, region=None):
+    if None is region:
+        region = env().get('AWS_DEFAULT_REGION')
+    if None is not region:
+        region = str(region).rstrip()
+
+    key = (service, region)
+
+    with aws_cache_lock:
+        client = aws_cache['clients'].get(key)
+        if None is client:
+            log_debug("Creating boto3 client for '{}' in region '{}'...", service, region)
+            client = aws_session().client(service, region_name=region)
+            aws_cache['clients'][key] = client
+
+    return client
+
+
+#
+def aws_resource(service, region=None):
+    if None is region:
+        region = env().get('AWS_DEFAULT_REGION')
+    if None is not region:
+        region = str(region).rstrip()
+
+    key = (service, region)
+
+    with aws_cache_lock:
+        generation = aws_cache['generation']
+        if generation != getattr(aws_thread_cache, 'generation', None):
+            aws_thread_cache.resources = {}
+            aws_thread_cache.generation = generation
+
+        resource = aws_thread_cache.resources.get(key)
+        if None is resource:
+            log_debug("Creating boto3 resource for '{}' in region '{}'...", service, region)
+            resource = aws_session().resource(service, region_name=region)
+            aws_thread_cache.resources[key] = resource
+
+    return resource
+
+
+#
+def aws_cache_reset():
+    with aws_cache_lock:
+        aws_cache['session'] = None
+        aws_cache['clients'] = {}
+        aws_cache['generation'] += 1
+
+    return True
 
 
 #
 def sts_decode_auth_msg(codedmsg):
     try:
-        decoded = boto3.client('sts').decode_authorization_message(EncodedMessage=codedmsg)
+        decoded = aws_client('sts').decode_authorization_message(EncodedMessage=codedmsg)
     except Boto3Error as e:
         msg = 'Failed while decoding STS auth msg!: {} :: {}'.format(codedmsg, str(e))
         log_debug(msg)
@@ -48,10 +192,10 @@ def sts_decode_auth_msg(codedmsg):
 
 #
 def nuke_aws_keypair(name):
-    log_debug("Removing AWS key pair '{}'...".format(name))
+    log_debug("Removing AWS key pair '{}'...", name)
 
     try:
-        boto3.resource('ec2', region_name='us-west-2').KeyPair(name).delete()
+        aws_resource('ec2', region='us-west-2').KeyPair(name).delete()
     except Boto3Error as e:
         log_debug(str(e.message))
         raise RuntimeError(e.message) from e
@@ -61,7 +205,7 @@ def nuke_aws_keypair(name):
 
 #
 def is_debug_enabled():
-    if 'DEBUG' in os.environ and 'false' != os.environ.get('DEBUG'):
+    if 'DEBUG' in env() and 'false' != env().get('DEBUG'):
         return True
     else:
         return False
@@ -82,6 +226,8 @@ class FancyFormatter(logging.Formatter):
 log = logging.getLogger(__name__)
 stream = logging.StreamHandler()
 
+log_caller_metadata = is_debug_enabled()
+
 if is_debug_enabled():
     log.setLevel(logging.DEBUG)
     stream.setFormatter(FancyFormatter())
@@ -117,30 +263,88 @@ def run_with_retries(cmd, echo=False, sleep=10, attempts=10):
 
 
 #
-def request_with_retries(method, url, data={}, step=10, attempts=10):
+# One pooled requests.Session per scheme://host:port so repeated calls against the same
+# endpoint reuse their TCP connections.
+http_sessions_lock = threading.Lock()
+http_sessions = {}
 
-    timeout = 5
+
+#
+def http_session(url):
+    parsed = urlparse(url)
+    base = '{}://{}'.format(parsed.scheme, parsed.netloc)
+
+    with http_sessions_lock:
+        session = http_sessions.get(base)
+        if None is session:
+            log_debug("Creating pooled HTTP session for '{}'...", base)
+            session = requests.Session()
+            session.mount(base, HTTPAdapter(pool_connections=1, pool_maxsize=20))
+            http_sessions[base] = session
+
+    return session
+
+
+#
+def http_sessions_reset():
+    with http_sessions_lock:
+        for session in http_sessions.values():
+            session.close()
+        http_sessions.clear()
+
+    return True
+
+
+#
+def request_with_retries(method, url, data={}, step=10, attempts=10, timeout=5, deadline=None):
+    """
+    Send an HTTP request over a pooled session, retrying transient failures.
+
+    Connection errors, timeouts and any non-2xx response are retried with
+    exponential backoff and jitter, each sleep capped at 'step' seconds.
+    Retrying stops at whichever of 'attempts' and 'deadline' runs out first.
+
+    Args:
+      method (str): HTTP method
+      url (str): URL to send the request to
+      data (dict): JSON payload for POST, PUT and PATCH
+      step (int): cap in seconds on a single sleep between attempts
+      attempts (int): max number of attempts
+      timeout (int): per-request connect and read timeout in seconds
+      deadline (int): overall time budget in seconds. Defaults to step * attempts, the longest the
+        old fixed sleeps of 'step' seconds could take, so by default 'attempts' is what ends the retries
+
+    Returns:
+      Response: the first 2xx response
+    """
+    method = str(method).upper()
     response = None
     current_attempts = 0
 
-    log_info("Sending request '{}' '{}'...".format(method, url))
-    log_debug("Payload data: {}".format(data))
+    if method not in ['GET', 'HEAD', 'OPTIONS', 'DELETE', 'POST', 'PUT', 'PATCH']:
+        log_error("Unsupported method \'{}\' specified!", method)
+        return False
+
+    if None is deadline:
+        deadline = step * attempts
+
+    log_info("Sending request '{}' '{}'...", method, url)
+    log_debug("Payload data: {}", data)
+
+    delays = backoff_delays(initial=1, maximum=step)
+    starttime = time.time()
 
     while True:
         try:
             current_attempts += 1
-            if 'PUT' == method:
-                response = requests.put(url, timeout=timeout, json=data)
-            elif 'GET' == method:
-                response = requests.get(url, timeout=timeout)
-            elif 'POST' == method:
-                response = requests.post(url, timeout=timeout, json=data)
+
+            if method in ['POST', 'PUT', 'PATCH']:
+                response = http_session(url).request(method, url, timeout=timeout, json=data)
             else:
-                log_error("Unsupported method \'{}\' specified!".format(method))
-                return False
+                response = http_session(url).request(method, url, timeout=timeout)
 
-            log_info("response code: HTTP {}".format(response.status_code))
-            log_debug("response: Headers:: {}".format(response.headers))
+            log_info("response code: HTTP {}", response.status_code)
+            log_debug("response: Headers:: {}", response.headers)
 
             # we might get a 200, 201, etc
             if not str(response.status_code).startswith('2'):
@@ -148,172 +352,637 @@ def request_with_retries(method, url, data={}, step=10, attempts=10):
             else:
                 return response
 
-        except (ConnectionError, HTTPError) as e:
-            if current_attempts >= attempts:
-                msg = "Exceeded max attempts. Giving up!: {}".format(str(e))
+        except (ConnectionError, Timeout, HTTPError) as e:
+            elapsed = time.time() - starttime
+            if current_attempts >= attempts or elapsed >= deadline:
+                msg = "Exceeded max attempts or deadline. Giving up!: {}".format(str(e))
                 log_debug(msg)
                 raise Failure(msg) from e
             else:
-                log_info("Request did not succeeed. Sleeping and trying again... : {}".format(str(e)))
-                sleep(step)
+                delay = min(next(delays), deadline - elapsed)
+                log_info("Request did not succeeed. Sleeping {:.1f}s and trying again... : {}", delay, str(e))
+                sleep(delay)
 
     return response
 
 
 #
 def get_parent_frame_metadata(frame):
-    parent_frame = inspect.getouterframes(frame, 2)
+    parent_frame = frame.f_back
 
     return {
-        'caller_filename': parent_frame[1].filename,
-        'caller_lineno': parent_frame[1].lineno,
-        'caller_funcName': parent_frame[1].function + "()"
+        'caller_filename': parent_frame.f_code.co_filename,
+        'caller_lineno': parent_frame.f_lineno,
+        'caller_funcName': parent_frame.f_code.co_name + "()"
     }
 
 
+# combining plumbum styles is not free so do it once
+log_styles = {
+    'info': colors.fg.white,
+    'debug': colors.fg.lightblue & colors.dim,
+    'error': colors.fatal,
+    'warn': colors.warn,
+    'success': colors.fg.green & colors.bold,
+    'exit': colors.fg.red & colors.bold
+}
+
+
 #
-def log_info(msg):
-    log.info(colors.fg.white | msg,
-             extra=get_parent_frame_metadata(inspect.currentframe()))
+def log_emit(level, style, msg, args):
+    # check the level first so dropped records cost neither formatting nor a frame lookup
+    if not log.isEnabledFor(level):
+        return False
+
+    if 0 != len(args):
+        msg = str(msg).format(*args)
+
+    # only the FancyFormatter uses caller metadata and walking back two frames is cheap
+    extra = None
+    if log_caller_metadata:
+        extra = get_parent_frame_metadata(sys._getframe(1))
+
+    log.log(level, style | str(msg), extra=extra)
+    return True
+
+
+#
+def log_info(msg, *args):
+    log_emit(logging.INFO, log_styles['info'], msg, args)
 
 
 #
-def log_debug(msg):
-    log.debug(colors.fg.lightblue & colors.dim | msg,
-              extra=get_parent_frame_metadata(inspect.currentframe()))
+def log_debug(msg, *args):
+    log_emit(logging.DEBUG, log_styles['debug'], msg, args)
 
 
 #
-def log_error(msg):
-    log.error(colors.fatal | msg,
-              extra=get_parent_frame_metadata(inspect.currentframe()))
+def log_error(msg, *args):
+    log_emit(logging.ERROR, log_styles['error'], msg, args)
 
 
 #
-def log_warn(msg):
-    log.warn(colors.warn | msg,
-             extra=get_parent_frame_metadata(inspect.currentframe()))
+def log_warn(msg, *args):
+    log_emit(logging.WARNING, log_styles['warn'], msg, args)
 
 
 #
-def claxon_and_exit(msg):
-    log.error(colors.fatal | msg,
-              extra=get_parent_frame_metadata(inspect.currentframe()))
+def claxon_and_exit(msg, *args):
+    log_emit(logging.ERROR, log_styles['error'], msg, args)
     sys.exit(-10)
 
 
 #
-def log_success(msg=''):
-    if '' is msg:
+def log_success(msg='', *args):
+    if '' == msg:
         msg = '[OK]'
-    log.info(colors.fg.green & colors.bold | msg,
-             extra=get_parent_frame_metadata(inspect.currentframe()))
+    log_emit(logging.INFO, log_styles['success'], msg, args)
 
 
 #
-def err_and_exit(msg):
-    log.error(colors.fg.red & colors.bold | msg,
-              extra=get_parent_frame_metadata(inspect.currentframe()))
+def err_and_exit(msg, *args):
+    log_emit(logging.ERROR, log_styles['exit'], msg, args)
     sys.exit(-1)
 
 
+#
+# Baked images are private AMIs with the bootstrap already applied, built by 'invoke ami.bake'.
+# They are found again by tags describing everything the bootstrap depends on. Launches only look
+# for one when RANCHER_BAKED_AMI is 'true', as the lookup costs a describe_images per process.
+ec2_baked_ami_lock = threading.Lock()
+ec2_baked_ami_cache = {}
+
+
+#
+def ec2_baked_ami_enabled():
+    return 'true' == str(env().get('RANCHER_BAKED_AMI', 'false')).rstrip()
+
+
+#
+def ec2_baked_ami_tags(os_name, base_ami):
+    # imported here as the Bootstrap package itself imports from this module
+    from .Bootstrap import bootstrap_bundle
+
+    return [
+        {'Key': 'rancher.ci.baked', 'Value': 'true'},
+        {'Key': 'rancher.ci.os', 'Value': os_name},
+        {'Key': 'rancher.ci.base_ami', 'Value': base_ami},
+        {'Key': 'rancher.ci.bootstrap', 'Value': bootstrap_bundle()['hash']},
+        {'Key': 'rancher.docker.version', 'Value': str(env()['RANCHER_DOCKER_VERSION']).rstrip()},
+        {'Key': 'rancher.docker.native', 'Value': str(env().get('RANCHER_DOCKER_NATIVE', 'false')).rstrip()},
+        {'Key': 'rancher.docker.rhel.selinux', 'Value': str(env().get('RANCHER_DOCKER_RHEL_SELINUX', 'false')).rstrip()}
+    ]
+
+
+#
+def ec2_baked_ami(os_name, base_ami, region=None, refresh=False):
+    """
+    Find the newest baked image matching the OS, base image, bootstrap and Docker settings of this run.
+
+    Args:
+      os_name (str): operating system name as accepted by os_to_settings()
+      base_ami (str): stock image the baked image must have been built from
+      region (str): AWS region, defaults to AWS_DEFAULT_REGION
+      refresh (bool): ignore any cached lookup
+
+    Returns:
+      str: image-id, or None if no matching image has been baked
+    """
+    tags = ec2_baked_ami_tags(os_name, base_ami)
+    key = (region, tuple([tag['Value'] for tag in tags]))
+
+    with ec2_baked_ami_lock:
+        if not refresh and key in ec2_baked_ami_cache:
+            return ec2_baked_ami_cache[key]
+
+        image_filter = [{'Name': 'tag:{}'.format(tag['Key']), 'Values': [tag['Value']]} for tag in tags]
+        image_filter.append({'Name': 'state', 'Values': ['available']})
+
+        try:
+            images = aws_client('ec2', region=region).describe_images(Owners=['self'], Filters=image_filter)['Images']
+        except (Boto3Error, ClientError) as e:
+            # a failed lookup only costs us the bootstrap, so carry on with the stock image
+            log_warn("Failed while looking up baked image for '{}'!: {}", os_name, str(e))
+            return None
+
+        image_id = None
+        if 0 != len(images):
+            image_id = sorted(images, key=lambda image: image['CreationDate'])[-1]['ImageId']
+
+        log_debug("baked image for '{}' from '{}': {}", os_name, base_ami, image_id)
+        ec2_baked_ami_cache[key] = image_id
+        return image_id
+
+
+#
+def ec2_baked_ami_invalidate():
+    with ec2_baked_ami_lock:
+        ec2_baked_ami_cache.clear()
+
+    return True
+
+
+#
+def ec2_node_is_prepared(nodename):
+    # nodes from a baked image or handed over from the node pool already have Docker
+    node = ec2_inventory_lookup(nodename)
+    if None is node:
+        raise RuntimeError("No instance found by name of '{}'!".format(nodename))
+
+    return 'true' in [node['tags'].get('rancher.ci.baked'), node['tags'].get('rancher.pool.reused')]
+
+
+#
+# The platform registry is read once per process from lib/yaml/platforms.yaml, or the file named
+# by RANCHER_PLATFORMS_FILE, and indexed by name. AMIs which have to be looked up are kept in
+# memory and in the workspace's .ci-cache/amis.json for RANCHER_AMI_CACHE_TTL seconds.
+platform_lock = threading.RLock()
+platform_registry = {'platforms': None, 'index': {}, 'matches': {}, 'amis': None}
+
+
+#
+def platform_registry_path():
+    default = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'yaml', 'platforms.yaml')
+    return str(env().get('RANCHER_PLATFORMS_FILE', default)).rstrip()
+
+
+#
+def platform_ami_cache_dir():
+    return str(env().get('WORKSPACE_DIR', os.getcwd())).rstrip()
+
+
+#
+def platform_ami_cache_ttl():
+    return int(str(env().get('RANCHER_AMI_CACHE_TTL', 86400)).rstrip())
+
+
+#
+def platform_load(refresh=False):
+    with platform_lock:
+        if refresh or None is platform_registry['platforms']:
+            path = platform_registry_path()
+            log_debug("Loading platform registry '{}'...", path)
+
+            try:
+                with open(path, 'r') as f:
+                    platforms = yaml.load(f.read(), Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))['platforms']
+                index = dict([(platform['name'], platform) for platform in platforms])
+
+            except (IOError, OSError, yaml.YAMLError, KeyError, TypeError) as e:
+                msg = "Failed while loading platform registry '{}'!: {}".format(path, str(e))
+                log_debug(msg)
+                raise RuntimeError(msg) from e
+
+            platform_registry['platforms'] = platforms
+            platform_registry['index'] = index
+            platform_registry['matches'] = {}
+
+        return platform_registry['platforms']
+
+
+#
+def platform_lookup(os_name):
+    with platform_lock:
+        platforms = platform_load()
+
+        # exact names come straight from the index; anything else is matched once and remembered
+        if os_name not in platform_registry['matches']:
+            platform = platform_registry['index'].get(os_name)
+            if None is platform:
+                platform = next((candidate for candidate in platforms if candidate['name'] in os_name), None)
+            platform_registry['matches'][os_name] = platform
+
+        platform = platform_registry['matches'][os_name]
+
+    if None is platform:
+        raise RuntimeError("Unsupported OS specified '{}'!".format(os_name))
+
+    return platform
+
+
+#
+def platform_ami(platform, region):
+    pinned = platform.get('amis', {}).get(region)
+    if None is not pinned:
+        return pinned
+
+    lookup = platform.get('lookup')
+    if None is lookup:
+        raise RuntimeError("No AMI for '{}' is pinned in region '{}' and there is no lookup for it!".format(platform['name'], region))
+
+    key = '{}/{}'.format(region, platform['name'])
+
+    with platform_lock:
+        if None is platform_registry['amis']:
+            platform_registry['amis'] = ci_cache_load(platform_ami_cache_dir(), 'amis', 'platforms')
+
+        cached = platform_registry['amis'].get(key)
+        if None is not cached and lookup == cached['lookup'] and time.time() - cached['resolved_at'] < platform_ami_cache_ttl():
+            return cached['ami']
+
+        log_info("Looking up newest AMI for '{}' in region '{}'...", platform['name'], region)
+
+        image_filter = [
+            {'Name': 'name', 'Values': [lookup['name']]},
+            {'Name': 'state', 'Values': ['available']},
+            {'Name': 'architecture', 'Values': ['x86_64']}
+        ]
+
+        try:
+            images = aws_client('ec2', region=region).describe_images(Owners=[str(lookup['owner'])], Filters=image_filter)['Images']
+        except (Boto3Error, ClientError) as e:
+            msg = "Failed while looking up AMI for '{}' in region '{}'!: {}".format(platform['name'], region, str(e))
+            log_debug(msg)
+            raise RuntimeError(msg) from e
+
+        if 0 == len(images):
+            raise RuntimeError("No AMI for '{}' in region '{}' matches '{}'!".format(platform['name'], region, lookup['name']))
+
+        ami = sorted(images, key=lambda image: image['CreationDate'])[-1]['ImageId']
+        log_debug("AMI for '{}' in region '{}': {}", platform['name'], region, ami)
+
+        platform_registry['amis'][key] = {'ami': ami, 'lookup': lookup, 'resolved_at': time.time()}
+        ci_cache_save(platform_ami_cache_dir(), 'amis', 'platforms', platform_registry['amis'])
+
+    return ami
+
+
+#
 # Given the OS, return a dictionary of OS-specific setting values
-# FIXME: Have this reference a config file for easy addtl platform support.
-def os_to_settings(os):
-    if 'ubuntu-1604' in os:
-        ami = 'ami-a9d276c9'
-        ssh_username = 'ubuntu'
-
-    elif 'ubuntu-1404' in os:
-        ami = 'ami-01f05461'
-        ssh_username = 'ubuntu'
-
-    elif 'centos-7' in os:
-        ami = 'ami-d2c924b2'
-        ssh_username = 'centos'
-
-    elif 'rhel-7.4' in os:
-        ami = 'ami-9fa343e7'
-        ssh_username = 'ec2-user'
-
-    elif 'rhel-7.2' in os:
-        ami = 'ami-5dd3743d'
-        ssh_username = 'ec2-user'
-    elif 'rhel-7.3' in os:
-        ami = 'ami-6f68cf0f'
-        ssh_username = 'ec2-user'
-
-    elif 'rancheros-v1.1.1' in os:
-        ami = 'ami-57cb6d2f'
-        ssh_username = 'rancher'
-
-    elif 'coreos-stable' in os:
-        ami = 'ami-06af7f66'
-        ssh_username = 'core'
+def os_to_settings(os_name, baked=False, region=None):
+    if None is region:
+        region = env().get('AWS_DEFAULT_REGION', 'us-west-2')
+    region = str(region).rstrip()
 
-    else:
-        raise RuntimeError("Unsupported OS specified '{}'!".format(os))
+    platform = platform_lookup(os_name)
+    ami = platform_ami(platform, region)
+
+    settings = {'ami-id': ami, 'ssh_username': platform['ssh_username'], 'baked': False}
 
-    return {'ami-id': ami, 'ssh_username': ssh_username}
+    # only worth a lookup when a node is about to be launched
+    if baked and ec2_baked_ami_enabled():
+        baked_ami = ec2_baked_ami(os_name, ami, region=region)
+        if None is not baked_ami:
+            log_info("Using baked image '{}' in place of '{}' for '{}'.", baked_ami, ami, os_name)
+            settings['ami-id'] = baked_ami
+            settings['baked'] = True
+
+    return settings
 
 
 #
-def ec2_wait_for_state(instance, desired_state, timeout=300):
-    log_info("Waiting for node '{}' to enter state '{}'...".format(instance, desired_state))
+class EC2WaitTimeout(RuntimeError):
+    message = None
+    stragglers = None
+
+    def __init__(self, message, stragglers):
+        self.message = message
+        self.stragglers = stragglers
+        super(EC2WaitTimeout, self).__init__(self.message)
+
+
+#
+def backoff_delays(initial=1, maximum=30, factor=2):
+    """
+    Generate exponentially growing sleep intervals with jitter.
+
+    Args:
+      initial (float): upper bound of the first interval
+      maximum (float): cap on the upper bound of any interval
+      factor (float): growth of the upper bound per interval
+
+    Returns:
+      generator: endless sequence of intervals in seconds
+    """
+    delay = initial
+    while True:
+        yield random.uniform(delay / 2.0, delay)
+        delay = min(maximum, delay * factor)
+
+
+#
+def ec2_wait_for_states(instance_ids, desired_state, timeout=300, region=None, on_ready=None):
+    """
+    Wait for a set of instances to enter a state, polling all of them with batched calls per tick.
+
+    Instance-ids are sent 200 to a call, the most values EC2 takes in one filter.
+
+    Args:
+      instance_ids (list): instance-ids to wait on
+      desired_state (str): EC2 instance state name, e.g. 'running'
+      timeout (int): seconds to wait before giving up
+      region (str): AWS region, defaults to AWS_DEFAULT_REGION
+      on_ready (callable): called with (instance_id, timestamp) as soon as a node is ready
+
+    Returns:
+      dict: instance-id to the time at which it was seen in the desired state
+    """
+    pending = set(instance_ids)
+    ready = {}
+    delays = backoff_delays(initial=2, maximum=15)
+    ec2 = aws_client('ec2', region=region)
 
-    steptime = 5
-    actual_state = None
-    nodefilter = [{'Name': 'instance-id', 'Values': [instance]}]
-    ec2 = boto3.client('ec2', region_name=aws_get_region())
+    log_info("Waiting for {} node(s) to enter state '{}'...", len(pending), desired_state)
 
     starttime = time.time()
-    while time.time() - starttime < timeout:
+    while 0 != len(pending):
         try:
-            rez = ec2.describe_instances(Filters=nodefilter)['Reservations']
-            log_debug("rez: {}".format(rez))
-
-            if 0 < len(rez):
-                actual_state = rez[0]['Instances'][0]['State']['Name']
-                log_debug("desired state: {} ; actual state: {}".format(desired_state, actual_state))
-
-                if actual_state == desired_state:
-                    log_info("Node '{}' has entered state '{}'.".format(instance, desired_state))
-                    break
-                else:
-                    sleep(steptime)
-            else:
-                log_debug("Not yet able to query instance state...")
-                sleep(steptime)
+            ids = sorted(pending)
+            for i in range(0, len(ids), 200):
+                nodefilter = [{'Name': 'instance-id', 'Values': ids[i:i + 200]}]
+                for page in ec2.get_paginator('describe_instances').paginate(Filters=nodefilter):
+                    for reservation in page['Reservations']:
+                        for instance in reservation['Instances']:
+                            actual_state = instance['State']['Name']
+                            log_debug("node '{}' desired state: {} ; actual state: {}",
+                                      instance['InstanceId'], desired_state, actual_state)
+
+                            if actual_state == desired_state and instance['InstanceId'] in pending:
+                                ready[instance['InstanceId']] = time.time()
+                                pending.discard(instance['InstanceId'])
+                                log_info("Node '{}' has entered state '{}'.", instance['InstanceId'], desired_state)
+                                if None is not on_ready:
+                                    on_ready(instance['InstanceId'], ready[instance['InstanceId']])
+
+        except (ClientError, Boto3Error) as e:
+            msg = "Failed while querying instance state for '{}'!: {}".format(', '.join(sorted(pending)), str(e))
+            log_debug(msg)
+            raise RuntimeError(msg) from e
 
-        except Boto3Error as e:
-            msg = "Failed while querying instance '{}' state!: {}".format(instance, str(e))
+        if 0 == len(pending):
+            break
+
+        remaining = timeout - (time.time() - starttime)
+        if remaining <= 0:
+            msg = "Timed out after {} seconds waiting for node(s) to enter state '{}': {}".format(
+                timeout, desired_state, ', '.join(sorted(pending)))
             log_debug(msg)
-            raise RuntimeError(msg)
+            raise EC2WaitTimeout(msg, sorted(pending))
+
+        sleep(min(next(delays), remaining))
+
+    return ready
 
 
 #
-def ec2_tag_value(nodename, tagname):
-    log_debug("Looking up tag '{}' for instance '{}'...".format(tagname, nodename))
+def ec2_wait_for_state(instance, desired_state, timeout=300):
+    ec2_wait_for_states([instance], desired_state, timeout=timeout, region=aws_get_region())
+    return True
+
+
+#
+# Run-scoped inventory of EC2 instances indexed by 'Name' tag. One paginated describe_instances
+# call covers every node of the run so the lookup helpers don't have to query per node.
+ec2_inventory_lock = threading.RLock()
+ec2_inventory_cache = {}
+
+
+#
+def ec2_inventory_pattern():
+    prefix = env().get('AWS_PREFIX')
+    if None is not prefix:
+        return "{}-*".format(prefix.replace('.', '-').rstrip())
+    return '*'
+
+
+#
+def ec2_inventory_node(instance):
+    tags = {}
+    for tag in instance.get('Tags', []):
+        tags[tag['Key']] = tag['Value']
+
+    return {
+        'name': tags.get('Name'),
+        'instance_id': instance['InstanceId'],
+        'instance_type': instance.get('InstanceType'),
+        'state': instance['State']['Name'],
+        'public_ip': instance.get('PublicIpAddress'),
+        'private_ip': instance.get('PrivateIpAddress'),
+        'tags': tags
+    }
+
+
+#
+def ec2_inventory(region=None, refresh=False):
+    """
+    Fetch (or return the cached) inventory of every instance for the run prefix.
+
+    Args:
+      region (str): AWS region, defaults to AWS_DEFAULT_REGION
+      refresh (bool): ignore any cached inventory
+
+    Returns:
+      dict: node name to dict of instance_id, state, public_ip, private_ip and tags
+    """
+    if None is region:
+        region = aws_get_region()
+
+    pattern = ec2_inventory_pattern()
+    ttl = float(str(env().get('AWS_INVENTORY_TTL', '30')).rstrip())
+    key = (region, pattern)
+
+    with ec2_inventory_lock:
+        cached = ec2_inventory_cache.get(key)
+
+        # an earlier stage of the build may already have listed the nodes
+        if not refresh and None is cached:
+            cached = ec2_inventory_seed(region, pattern, ttl)
+            if None is not cached:
+                ec2_inventory_cache[key] = cached
+
+        if refresh or None is cached or time.time() - cached['fetched'] > ttl:
+            log_debug("Refreshing EC2 inventory for '{}' in region '{}'...", pattern, region)
+
+            inventory_filter = [
+                {'Name': 'tag:Name', 'Values': [pattern]},
+                {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}
+            ]
+
+            nodes = {}
+
+            try:
+                paginator = aws_client('ec2', region=region).get_paginator('describe_instances')
+                for page in paginator.paginate(Filters=inventory_filter):
+                    for reservation in page['Reservations']:
+                        for instance in reservation['Instances']:
+                            node = ec2_inventory_node(instance)
+                            if None is node['name']:
+                                continue
+
+                            # prefer live nodes when a stopped one shares the same name
+                            existing = nodes.get(node['name'])
+                            if None is existing or existing['state'] not in ['pending', 'running']:
+                                nodes[node['name']] = node
+
+            except (ClientError, Boto3Error) as e:
+                msg = "Failed while refreshing EC2 inventory!: {}".format(str(e))
+                log_debug(msg)
+                raise RuntimeError(msg) from e
+
+            cached = {'fetched': time.time(), 'nodes': nodes}
+            ec2_inventory_cache[key] = cached
+            log_debug("EC2 inventory: {}", nodes)
+
+            ec2_inventory_record(region, pattern, cached)
+
+        return cached['nodes']
+
+
+#
+def ec2_inventory_seed(region, pattern, ttl):
+    """
+    Rebuild the inventory from the run manifest, revalidating it with one describe_instances by instance-id.
+
+    A manifest validated less than 'ttl' seconds ago is used as it is. One
+    which was invalidated because nodes were launched or terminated is not
+    revalidated, since the new nodes are not in it yet.
+
+    Args:
+      region (str): AWS region
+      pattern (str): 'Name' tag pattern the manifest inventory must have been listed with
+      ttl (float): seconds for which a validated manifest inventory is trusted
+
+    Returns:
+      dict: inventory cache entry, or None to fall back to a full listing
+    """
+    from .Manifest import run_manifest, ManifestError
+
+    entry = run_manifest.inventory(region, pattern)
+    if None is entry or 0 == len(entry['nodes']):
+        return None
+
+    # invalidated rather than aged out, a full listing picks up the new nodes
+    if 0 == entry['validated']:
+        log_debug("Run manifest inventory was invalidated, listing EC2 nodes.")
+        return None
+
+    if time.time() - entry['validated'] <= ttl:
+        log_debug("Using EC2 inventory from run manifest validated {:.0f}s ago.", time.time() - entry['validated'])
+        return {'fetched': entry['validated'], 'nodes': entry['nodes']}
 
-    tagvalue = None
+    ids = [node['instance_id'] for node in entry['nodes'].values()]
+    nodes = {}
 
     try:
-        ec2_filter = [{'Name': 'tag:Name', 'Values': [nodename]}]
-        log_debug("tag filter: {}".format(ec2_filter))
+        # EC2 takes up to 200 values in one filter
+        paginator = aws_client('ec2', region=region).get_paginator('describe_instances')
+        for i in range(0, len(ids), 200):
+            for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': ids[i:i + 200]}]):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        node = ec2_inventory_node(instance)
+                        if None is not node['name'] and node['state'] in ['pending', 'running', 'stopping', 'stopped']:
+                            nodes[node['name']] = node
 
-        ec2 = boto3.client('ec2')
-        node_metadata = ec2.describe_instances(Filters=ec2_filter)
-        log_debug("node metadata: {}".format(node_metadata))
+    except (ClientError, Boto3Error) as e:
+        log_debug("Failed to revalidate EC2 inventory from run manifest: {}", str(e))
+        return None
 
-        tags = node_metadata['Reservations'][0]['Instances'][0]['Tags']
-        log_debug("tags: {}".format(tags))
+    log_debug("Revalidated {} of {} node(s) from run manifest.", len(nodes), len(ids))
+    cached = {'fetched': time.time(), 'nodes': nodes}
 
-        for tag in tags:
-            if tagname == tag['Key']:
-                tagvalue = tag['Value']
-                break
+    try:
+        ec2_inventory_record(region, pattern, cached)
+    except ManifestError as e:
+        log_debug(e.message)
+
+    return cached
+
+
+#
+def ec2_inventory_record(region, pattern, cached):
+    from .Manifest import run_manifest, ManifestError
+
+    try:
+        run_manifest.record_inventory(region, pattern, cached['nodes'], validated=cached['fetched'])
+    except ManifestError as e:
+        log_warn(e.message)
+
+    return True
+
+
+#
+def ec2_inventory_invalidate():
+    from .Manifest import run_manifest, ManifestError
+
+    with ec2_inventory_lock:
+        ec2_inventory_cache.clear()
+
+        try:
+            run_manifest.invalidate_inventory()
+        except ManifestError as e:
+            log_warn(e.message)
+
+    return True
+
+
+#
+def ec2_inventory_lookup(nodename, region=None, states=None):
+    node = ec2_inventory(region).get(nodename)
+
+    # a miss or a node which is not yet in the wanted state may just be stale
+    if None is node or (None is not states and node['state'] not in states):
+        node = ec2_inventory(region, refresh=True).get(nodename)
+
+    if None is not node and None is not states and node['state'] not in states:
+        node = None
 
-    except (IndexError, KeyError, Boto3Error) as e:
+    return node
+
+
+#
+def ec2_tag_value(nodename, tagname):
+    log_debug("Looking up tag '{}' for instance '{}'...", tagname, nodename)
+
+    try:
+        node = ec2_inventory_lookup(nodename)
+        if None is node:
+            raise RuntimeError("No instance found by name of '{}'!".format(nodename))
+
+        log_debug("tags: {}", node['tags'])
+        tagvalue = node['tags'].get(tagname)
+
+    except RuntimeError as e:
         msg = "Failed while looking up tag '{}'!: {}".format(tagname, str(e))
         log_debug(msg)
         raise RuntimeError(msg) from e
@@ -323,11 +992,11 @@ def ec2_tag_value(nodename, tagname):
 
 #
 def ec2_instance_id_from_name(name):
-    log_debug("Getting metadata for '{}'...".format(name))
+    log_debug("Getting metadata for '{}'...", name)
 
     iid = None
     name_filter = [{'Name': 'tag:Name', 'Values': name}]
-    ec2 = boto3.client('ec2')
+    ec2 = aws_client('ec2')
 
     try:
         iid = ec2.describe_instances(Filters=name_filter)['Reservations'][0]['Instances'][0]['InstanceId']
@@ -341,7 +1010,7 @@ def ec2_instance_id_from_name(name):
 
 #
 def aws_volid_from_tag(name):
-    log_debug("Getting volid for non-root volume on instance '{}'...".format(name))
+    log_debug("Getting volid for non-root volume on instance '{}'...", name)
 
     volid = None
 
@@ -357,19 +1026,19 @@ def aws_volid_from_tag(name):
 
 #
 def ebs_deprovision_volume(name, region='us-west-2', zone='a'):
-    log_info("Removing volume '{}' if  it exists...".format(name))
+    log_info("Removing volume '{}' if  it exists...", name)
 
     try:
         vol_filter = [{'Name': 'tag:Name', 'Values': [name]}]
-        log_debug("vol filter: {}".format(vol_filter))
-        ec2 = boto3.client('ec2')
+        log_debug("vol filter: {}", vol_filter)
+        ec2 = aws_client('ec2')
         vols = ec2.describe_volumes(Filters=vol_filter)
-        log_debug("Volumes to delete: {}".format(vols))
+        log_debug("Volumes to delete: {}", vols)
 
         if 0 != len(vols['Volumes']):
             for vol in range(0, len(vols['Volumes'])):
                 volid = vols['Volumes'][vol]['VolumeId']
-                log_debug("Deleteting vol [{}] : id '{}'...".format(vol, volid))
+                log_debug("Deleteting vol [{}] : id '{}'...", vol, volid)
                 ec2.delete_volume(VolumeId=volid)
 
     except Boto3Error as e:
@@ -382,7 +1051,7 @@ def ebs_deprovision_volume(name, region='us-west-2', zone='a'):
 
 #
 def tag_csv_to_array(tagcsv):
-    log_debug("Converting tag csv to array: {}".format(tagcsv))
+    log_debug("Converting tag csv to array: {}", tagcsv)
 
     tag_dict_list = []
     taglist = tagcsv.split(',')
@@ -405,13 +1074,13 @@ def ebs_provision_volume(name, region='us-west-2', zone='a', size=20, voltype='g
     log_info("Creating EBS volume...")
 
     try:
-        ec2 = boto3.resource('ec2', region_name=region)
-        log_debug("Creating EBS volume '{}'...".format(name))
+        ec2 = aws_resource('ec2', region=region)
+        log_debug("Creating EBS volume '{}'...", name)
         vol = ec2.create_volume(Size=size, VolumeType=voltype, AvailabilityZone="{}{}".format(region, zone))
-        log_info("EBS volume '{}' created...".format(str(vol.id)))
+        log_info("EBS volume '{}' created...", str(vol.id))
 
         tags = tag_csv_to_array(tags)
-        log_info("Tagging volume '{}' : '{}'...".format(str(vol.id), tags))
+        log_info("Tagging volume '{}' : '{}'...", str(vol.id), tags)
         ec2.create_tags(Resources=[vol.id], Tags=tags)
 
     except (RuntimeError, Boto3Error) as e:
@@ -440,7 +1109,66 @@ def aws_to_dm_env():
     os.environ['AMAZONEC2_SECRET_KEY'] = os.environ['AWS_SECRET_ACCESS_KEY']
     os.environ['AMAZONEC2_REGION'] = os.environ['AWS_DEFAULT_REGION']
 
-    log_debug("Docker Machine envvars are: {}".format(run("env | egrep 'AMAZONEC2_'", echo=False, hide=True).stdout))
+    log_debug("Docker Machine envvars are: {}", run("env | egrep 'AMAZONEC2_'", echo=False, hide=True).stdout)
+
+    return True
+
+
+#
+# One walk per (rootdir, excludes) per process, bucketed by file extension, which every
+# syntax_check() and lint_check() call shares.
+file_index_lock = threading.Lock()
+file_index_cache = {}
+
+# never worth descending into, whatever the caller excludes
+FILE_INDEX_PRUNE = ['.git']
+
+
+#
+def file_index(rootdir, excludes=[], refresh=False):
+    """
+    Index the files below rootdir by extension in a single pass.
+
+    Args:
+      rootdir (str): where to start indexing
+      excludes: array of patterns; a directory whose path contains one is not descended into
+      refresh (bool): walk the tree again instead of using the cached index
+
+    Returns:
+      dict: extension (without the dot, '' for none) to sorted list of file paths
+    """
+    key = (os.path.abspath(rootdir), tuple(sorted(excludes)))
+
+    with file_index_lock:
+        if not refresh and key in file_index_cache:
+            return file_index_cache[key]
+
+        log_debug("Indexing files from root of '{}' excluding {}...", rootdir, excludes)
+
+        index = {}
+        pending = [rootdir]
+        while pending:
+            for entry in os.scandir(pending.pop()):
+                if any([exclude in entry.path for exclude in excludes]):
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in FILE_INDEX_PRUNE:
+                        pending.append(entry.path)
+                elif entry.is_file():
+                    index.setdefault(os.path.splitext(entry.name)[1][1:], []).append(entry.path)
+
+        for paths in index.values():
+            paths.sort()
+
+        file_index_cache[key] = index
+        return index
+
+
+#
+def file_index_invalidate():
+    with file_index_lock:
+        file_index_cache.clear()
 
     return True
 
@@ -459,29 +1187,81 @@ def find_files(rootdir, pattern, excludes=[]):
       array: list of matching files
     """
     matches = []
-    DEBUG = False
 
     try:
-        log_debug("Search for pattern \'{}\' from root of '{}\'...".format(pattern, rootdir))
+        log_debug("Search for pattern \'{}\' from root of '{}\'...", pattern, rootdir)
 
-        for root, dirnames, filenames in walk(rootdir):
-            for filename in fnmatch.filter(filenames, pattern):
-                matches.append(os.path.join(root, filename))
+        index = file_index(rootdir, excludes)
 
-        # Oh, lcomp sytnax...
-        for exclude in excludes:
-            matches = numpy.asarray(
-                [match for match in matches if exclude not in match])
+        # '*.ext' is answered straight from its bucket, anything else is matched by name
+        extension = pattern[2:] if pattern.startswith('*.') else None
+        if None is not extension and not any([c in extension for c in '*?[.']):
+            matches = list(index.get(extension, []))
+        else:
+            for paths in index.values():
+                matches.extend([path for path in paths if fnmatch.fnmatch(os.path.basename(path), pattern)])
+            matches.sort()
 
-        log_debug("Matches in find_files is : {}".format(str(matches)))
+        log_debug("Matches in find_files is : {}", matches)
 
     except FileNotFoundError as e:
-        log_error("Failed to chdir to \'{}\': {} :: {}".format(e.errno, e.strerror))
+        log_error("Failed to chdir to \'{}\': {} :: {}", rootdir, e.errno, e.strerror)
         return False
 
     return matches
 
 
+#
+def lint_parallelism():
+    return int(str(env().get('RANCHER_LINT_PARALLELISM', os.cpu_count() or 1)).rstrip())
+
+
+#
+def lint_flake8_version():
+    try:
+        import flake8
+        return flake8.__version__
+    except ImportError:
+        return 'unknown'
+
+
+#
+def lint_flake8(options, paths):
+    result = run("flake8 {} {}".format(options, ' '.join(paths)), hide=True, warn=True)
+
+    # a return code of 1 just means there were findings; anything else is flake8 itself failing
+    if result.return_code not in [0, 1]:
+        raise Failure(result)
+
+    # split the output back up per file; a finding's source and caret lines follow it
+    findings = dict([(path, []) for path in paths])
+    current = None
+    for line in result.stdout.splitlines():
+        for path in paths:
+            if line.startswith(path + ':'):
+                current = path
+                line = line[len(path):]
+                break
+        if None is not current:
+            findings[current].append(line)
+
+    return findings
+
+
+#
+def lint_statistics(findings):
+    counts = {}
+    for lines in findings:
+        for line in lines:
+            # ':row:col: CODE message'
+            parts = line.split(' ', 2)
+            if line.startswith(':') and 3 == len(parts):
+                count, message = counts.get(parts[1], (0, parts[2]))
+                counts[parts[1]] = (count + 1, message)
+
+    return ['{:<5} {} {}'.format(count, code, message) for code, (count, message) in sorted(counts.items())]
+
+
 #
 def lint_check(rootdir, filetypes=[], excludes=[]):
 
@@ -492,102 +1272,230 @@ def lint_check(rootdir, filetypes=[], excludes=[]):
     if not isinstance(filetypes, list):
         filetypes = [filetypes]
 
-    if [] is filetypes:
+    if 0 == len(filetypes):
         filetypes = default_filetypes
 
     else:
         for specified_type in filetypes:
             if specified_type not in default_filetypes:
-                log_error("Sorry, do not provide lint checking for filetype \'{}\'.".format(specified_type))
+                log_error("Sorry, do not provide lint checking for filetype \'{}\'.", specified_type)
                 result = False
 
         if False is result:
             return False
 
+    options = "--show-source --max-line-length=160 --ignore={}".format('E111,E114,E122,E401,E402,E266,F841,E126,E501')
+
+    # findings only change with the file, the options or the flake8 they came from
+    cache_key = 'flake8 {} {}'.format(lint_flake8_version(), options)
+    cache = ci_cache_load(rootdir, 'lint', cache_key)
+
     for filetype in filetypes:
         filetype = '*.' + filetype
 
         found_files = find_files(rootdir, filetype, excludes)
         if False is found_files:
-            log_error("Error during lint check for files matching \'{}\'!")
+            log_error("Error during lint check for files matching \'{}\'!", filetype)
             return False
 
-        else:
-            if len(found_files) > 0:
-
-                # figure out which command we need to run to do a lint check
-                cmd = ''
-                if '*.py' == filetype:
-                    cmd = "flake8 --statistics --show-source --max-line-length=160 --ignore={} {}".format(
-                        'E111,E114,E122,E401,E402,E266,F841,E126,E501',
-                        ' '.join(found_files))
-
-#                cmd = cmd.format(' '.join(found_files))
-                log_debug("Lint checking \'{}\'...".format(' '.join(found_files)))
-                if is_debug_enabled():
-                    run(cmd, echo=True)
-                else:
-                    run(cmd)
+        # only python files have a linter
+        if '*.py' != filetype or 0 == len(found_files):
+            continue
+
+        digests = {}
+        pending = []
+        for found_file in found_files:
+            digests[found_file] = file_digest(found_file)[0]
+            cached = cache.get(os.path.relpath(found_file, rootdir), {})
+            if digests[found_file] != cached.get('digest'):
+                pending.append(found_file)
+
+        log_debug("Lint checking {} of {} '{}' file(s); the rest are unchanged...", len(pending), len(found_files), filetype)
+
+        if 0 != len(pending):
+            # changed files are split into one chunk per worker, each linted by its own flake8
+            workers = max(1, min(lint_parallelism(), len(pending)))
+            chunks = [pending[i::workers] for i in range(workers)]
+
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    for findings in pool.map(lambda chunk: lint_flake8(options, chunk), chunks):
+                        for found_file, lines in findings.items():
+                            cache[os.path.relpath(found_file, rootdir)] = {'digest': digests[found_file], 'findings': lines}
+
+            except Failure as e:
+                err_and_exit("flake8 failed!: {} :: {}".format(e.result.return_code, e.result.stderr))
+
+        ci_cache_save(rootdir, 'lint', cache_key, cache)
+
+        # replay every file's findings, fresh or cached, in the order flake8 would have printed them
+        findings = [cache[os.path.relpath(found_file, rootdir)]['findings'] for found_file in found_files]
+        output = []
+        for found_file, lines in zip(found_files, findings):
+            output.extend([found_file + line if line.startswith(':') else line for line in lines])
+
+        if 0 != len(output):
+            statistics = lint_statistics(findings)
+            print('\n'.join(output + statistics))
+            err_and_exit("Lint check found {} issue(s)!".format(sum([int(line.split()[0]) for line in statistics])))
+
+    return True
+
+
+#
+# Results of the syntax and lint checks are cached under .ci-cache/ in the checked tree, keyed
+# on file content, so a re-run only does the work for files which have changed.
+def ci_cache_path(rootdir, name):
+    return os.path.join(rootdir, '.ci-cache', '{}.json'.format(name))
+
+
+#
+def ci_cache_load(rootdir, name, key):
+    path = ci_cache_path(rootdir, name)
+
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        log_debug("No usable cache at '{}': {}", path, str(e))
+        return {}
+
+    # the whole cache goes stale when the tooling it was built with changes
+    if key != cache.get('key'):
+        log_debug("Discarding cache at '{}' built for '{}'.", path, cache.get('key'))
+        return {}
+
+    return cache.get('entries', {})
+
+
+#
+def ci_cache_save(rootdir, name, key, entries):
+    path = ci_cache_path(rootdir, name)
+    tmppath = '{}.{}.tmp'.format(path, os.getpid())
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmppath, 'w') as f:
+            json.dump({'key': key, 'entries': entries}, f, indent=1, sort_keys=True)
+        os.replace(tmppath, path)
+
+    except (IOError, OSError) as e:
+        log_warn("Failed to write cache '{}': {}", path, str(e))
+        return False
 
     return True
 
 
+#
+def file_digest(path):
+    with open(path, 'rb') as f:
+        content = f.read()
+    return hashlib.sha256(content).hexdigest(), content
+
+
+#
+def syntax_check_py(path, content):
+    try:
+        compile(content, path, 'exec', dont_inherit=True)
+    except (SyntaxError, ValueError) as e:
+        return "{}: {}".format(path, str(e))
+    return None
+
+
+#
+def syntax_check_yaml(path, content):
+    try:
+        # a file may hold several documents; the generator has to be drained to parse them all
+        for document in yaml.load_all(content, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+            pass
+    except yaml.YAMLError as e:
+        return "{}: {}".format(path, str(e))
+    return None
+
+
+#
+def syntax_check_sh(path, content):
+    result = run("bash -n '{}'".format(path), hide=True, warn=True)
+    if not result.ok:
+        return "{}: {}".format(path, result.stderr.strip())
+    return None
+
+
+#
+def syntax_check_parallelism():
+    return int(str(env().get('RANCHER_SYNTAX_PARALLELISM', os.cpu_count() or 1)).rstrip())
+
+
 #
 def syntax_check(rootdir, filetypes=[], excludes=[]):
 
     default_filetypes = ['sh', 'py', 'yaml', 'pp', 'rb']
+    checkers = {'sh': syntax_check_sh, 'py': syntax_check_py, 'yaml': syntax_check_yaml}
     result = True
 
     # if someone passes a non-list then cast it to a list
     if not isinstance(filetypes, list):
         filetypes = [filetypes]
 
-    if [] is filetypes:
+    if 0 == len(filetypes):
         filetypes = default_filetypes
 
     else:
         for specified_type in filetypes:
             if specified_type not in default_filetypes:
-                log_error("Sorry, do not provide syntax checking for filetype \'{}\'.".format(specified_type))
+                log_error("Sorry, do not provide syntax checking for filetype \'{}\'.", specified_type)
                 result = False
 
         if False is result:
             return False
 
-    try:
-        for filetype in filetypes:
-            filetype = '*.' + filetype
+    # files which passed are remembered by content hash for as long as the tooling is the same
+    cache_key = 'python {}, PyYAML {}'.format(sys.version.split()[0], yaml.__version__)
+    cache = ci_cache_load(rootdir, 'syntax', cache_key)
+    errors = []
+
+    for filetype in filetypes:
+        filetype = '*.' + filetype
+
+        found_files = find_files(rootdir, filetype, excludes)
+        if False is found_files:
+            log_error("Error during syntax check for files matching \'{}\'!", filetype)
+            return False
+
+        checker = checkers.get(filetype[2:])
+        if None is checker:
+            log_debug("No syntax checker for '{}'. Skipping {} file(s)...", filetype, len(found_files))
+            continue
 
-            found_files = find_files(rootdir, filetype, excludes)
-            if False is found_files:
-                log_error("Error during syntax check for files matching \'{}\'!")
-                return False
+        pending = []
+        for found_file in found_files:
+            digest, content = file_digest(found_file)
+            if cache.get(os.path.relpath(found_file, rootdir)) != digest:
+                pending.append((found_file, digest, content))
 
+        log_debug("Syntax checking {} of {} '{}' file(s); the rest are unchanged...",
+                  len(pending), len(found_files), filetype)
+
+        # bash -n is a process per file, so those fan out; the in-process checks are cheaper serially
+        if syntax_check_sh is checker and 1 < len(pending):
+            with ThreadPoolExecutor(max_workers=syntax_check_parallelism()) as pool:
+                failures = list(pool.map(lambda args: checker(args[0], args[2]), pending))
+        else:
+            failures = [checker(found_file, content) for found_file, digest, content in pending]
+
+        for (found_file, digest, content), failure in zip(pending, failures):
+            if None is failure:
+                cache[os.path.relpath(found_file, rootdir)] = digest
             else:
-                if len(found_files) > 0:
-                    # figure out which command we need to run to do a syntax check
-                    cmd = ''
-                    if '*.sh' == filetype:
-                        cmd = "bash -n {}"
-
-                    elif '*.py' == filetype:
-                        cmd = "python -m py_compile {}"
-
-                    # do the syntax check
-                    if '*.yaml' == filetype or '*.yaml' == filetype:
-                        for found_file in found_files:
-                            log_debug("Syntax checking \'{}\' via Python yaml.load()...".format(found_file))
-                            yaml.load(found_file)
-                    else:
-                        cmd = cmd.format(' '.join(found_files))
-                        log_debug("Syntax checking \'{}\'...".format(' '.join(found_files)))
-                        if is_debug_enabled():
-                            run(cmd, echo=True)
-                        else:
-                            run(cmd)
-
-    except (yaml.YAMLError, Failure) as e:
-        err_and_exit(str(e))
+                cache.pop(os.path.relpath(found_file, rootdir), None)
+                errors.append(failure)
+
+    ci_cache_save(rootdir, 'syntax', cache_key, cache)
+
+    if 0 != len(errors):
+        for error in errors:
+            log_error(error)
+        err_and_exit("Syntax check failed for {} file(s)!".format(len(errors)))
 
     return True
 
@@ -604,16 +1512,16 @@ def ec2_ensure_ssh_keypair(nodename):
             run("chmod 0600 .ssh/{}".format(nodename), echo=True)
 
         # update the key pair in AWS - Yes, Terraform has a Provider for this and Pupupet does not...
-        log_info("Uploading ssh pub key '{}' to AWS...".format(nodename))
-        ec2 = boto3.client('ec2', region_name=str(os.environ['AWS_DEFAULT_REGION']).rstrip())
+        log_info("Uploading ssh pub key '{}' to AWS...", nodename)
+        ec2 = aws_client('ec2', region=str(env()['AWS_DEFAULT_REGION']).rstrip())
         ec2.delete_key_pair(KeyName=nodename)
 
         pubkey = open('.ssh/{}.pub'.format(nodename), 'r').read()
-        log_debug("pub key: '{}'".format(pubkey))
+        log_debug("pub key: '{}'", pubkey)
 
         #                        WTF??!? Docs say this has to b64 encoded!?!?
         #                        b64pubkey = base64.b64encode(bytes(pubkey, 'utf-8').ascii())
-        #                        log_debug("base64 pub key: '{}'".format(b64pubkey))
+        #                        log_debug("base64 pub key: '{}'", b64pubkey)
 
         ec2.import_key_pair(
             KeyName=nodename,
@@ -628,19 +1536,93 @@ def ec2_ensure_ssh_keypair(nodename):
 
 
 #
-def ec2_node_ensure(nodename, instance_type='m4.large'):
-    log_info("Ensuring node '{}'...".format(nodename))
+def ec2_copy_ssh_keypair(keyname, nodename):
+    log_debug("Sharing ssh key pair '{}' with node '{}'...", keyname, nodename)
 
-    server_os = str(os.environ['RANCHER_SERVER_OPERATINGSYSTEM']).rstrip()
-    os_settings = os_to_settings(server_os)
-    sgids = [str(os.environ['AWS_SECURITY_GROUP_ID']).rstrip()]
-    zone = str(os.environ['AWS_ZONE']).rstrip()
-    region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
+    try:
+        if keyname != nodename:
+            run("cp -f .ssh/{} .ssh/{} && cp -f .ssh/{}.pub .ssh/{}.pub".format(keyname, nodename, keyname, nodename))
+            run("chmod 0600 .ssh/{}".format(nodename))
+
+    except Failure as e:
+        msg = "Failed while sharing ssh key pair '{}' with '{}'!: {}".format(keyname, nodename, str(e))
+        log_debug(msg)
+        raise RuntimeError(msg) from e
+
+    return nodename
+
+
+#
+def ec2_tag_instance_with_retries(ec2, instance_id, tags, attempts=10, step=2):
+    current_attempts = 0
+
+    # run_instances can return before the instance-id is visible to the rest of the EC2 API
+    while True:
+        current_attempts += 1
+        try:
+            ec2.create_tags(Resources=[instance_id], Tags=tags)
+            break
+
+        except ClientError as e:
+            if 'InvalidInstanceID.NotFound' != e.response['Error']['Code'] or current_attempts >= attempts:
+                raise
+            log_debug("Instance '{}' not yet visible for tagging. Sleeping for {}...", instance_id, step)
+            sleep(step)
+
+    return True
+
+
+#
+def ec2_running_node_names(nodenames, region='us-west-2'):
+    running = set()
+
+    for nodename, node in ec2_inventory(region, refresh=True).items():
+        if nodename in nodenames and node['state'] in ['running', 'pending']:
+            running.add(nodename)
+
+    return running
+
+
+#
+def ec2_node_ensure(nodename, instance_type='m4.large', baked=True, operatingsystem=None):
+    ec2_nodes_ensure([nodename], instance_type=instance_type, baked=baked, operatingsystem=operatingsystem)
+    return True
+
+
+#
+def ec2_nodes_ensure(nodenames, instance_type='m4.large', baked=True, operatingsystem=None):
+    """
+    Launch identically configured nodes with a single run_instances call.
+
+    Common tags are applied at launch via TagSpecifications. EC2 applies a
+    TagSpecification to every instance in the request, so when more than one
+    node is launched the per-index 'Name' tag is added right after launch.
+
+    Args:
+      nodenames (list): names of the nodes to launch, in launch index order
+      instance_type (str): EC2 instance type for all of the nodes
+      baked (bool): launch a matching baked image instead of the stock one if there is one
+      operatingsystem (str): OS of the nodes, defaults to RANCHER_SERVER_OPERATINGSYSTEM
+
+    Returns:
+      dict: node name to instance-id
+    """
+    nodenames = list(nodenames)
+    log_info("Ensuring nodes '{}'...", ', '.join(nodenames))
+
+    if None is operatingsystem:
+        operatingsystem = env()['RANCHER_SERVER_OPERATINGSYSTEM']
+    node_os = str(operatingsystem).rstrip()
+    os_settings = os_to_settings(node_os, baked=baked, region=str(env()['AWS_DEFAULT_REGION']).rstrip())
+    sgids = [str(env()['AWS_SECURITY_GROUP_ID']).rstrip()]
+    zone = str(env()['AWS_ZONE']).rstrip()
+    region = str(env()['AWS_DEFAULT_REGION']).rstrip()
     placement = {'AvailabilityZone': '{}{}'.format(region, zone)}
-    subnetid = str(os.environ['AWS_SUBNET_ID']).rstrip()
-    region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
+    subnetid = str(env()['AWS_SUBNET_ID']).rstrip()
 
     custom_vols = None
+    keyname = nodenames[0]
+    instance_ids = {}
 
     network_ifs = [{
         'DeviceIndex': 0,
@@ -651,78 +1633,83 @@ def ec2_node_ensure(nodename, instance_type='m4.large'):
 
     # only intersted in nodes which might have same name and which are running or pending
     node_filter = [
-        {'Name': 'tag:Name', 'Values': [nodename]},
+        {'Name': 'tag:Name', 'Values': nodenames},
         {'Name': 'instance-state-name', 'Values': ['running', 'pending']}
     ]
 
     try:
-        ec2 = boto3.client('ec2', region_name=region)
+        ec2 = aws_client('ec2', region=region)
         instances = ec2.describe_instances(Filters=node_filter)
-        log_debug("instance: {}".format(instances))
+        log_debug("instance: {}", instances)
 
         # first check if server(s) by our specified name already exists
         if 0 != len(instances['Reservations']):
-            msg = "Detected already running instance by name of '{}'...".format(nodename)
+            msg = "Detected already running instance(s) by name of '{}'...".format(', '.join(nodenames))
             log_debug(msg)
             raise RuntimeError(msg)
 
-        # nope, let's go ahead and create one
+        # nope, let's go ahead and create them
         else:
-            keyname = ec2_ensure_ssh_keypair(nodename)
+            # every node in the batch shares one key pair, copied locally under each node's name
+            ec2_ensure_ssh_keypair(keyname)
+            for nodename in nodenames:
+                ec2_copy_ssh_keypair(keyname, nodename)
 
             # yuck
-            iam_profile = boto3.resource('iam').InstanceProfile(str(os.environ['AWS_INSTANCE_PROFILE']))
+            iam_profile = aws_resource('iam').InstanceProfile(str(env()['AWS_INSTANCE_PROFILE']))
             iam_profile = {'Name': iam_profile.name}
 
             # resize the root volume to 30 GB
             custom_vols = [{'DeviceName': '/dev/sda1', 'Ebs': {'VolumeSize': 30}}]
 
             # RHEL osfamily needs a second LVM volume for thinpool config
-            if 'rhel' in server_os or 'centos' in server_os:
+            if 'rhel' in node_os or 'centos' in node_os:
                 custom_vols.append({
                     'DeviceName': '/dev/sdb',
                     'Ebs': {'VolumeSize': 30, 'DeleteOnTermination': True}})
-                log_info("Creating second volume to host thinpool config for RHEL osfamily: {}".format(custom_vols))
+                log_info("Creating second volume to host thinpool config for RHEL osfamily: {}", custom_vols)
 
-            log_info("Creating Rancher Server '{}'...".format(nodename))
+            tags = ec2_compute_tags(keyname)
+            if os_settings['baked']:
+                tags.append({'Key': 'rancher.ci.baked', 'Value': 'true'})
+            if 1 < len(nodenames):
+                tags = [tag for tag in tags if 'Name' != tag['Key']]
+
+            log_info("Creating {} node(s) with tags: {}", len(nodenames), tags)
 
             # have to include block device mapping configs for these OSes and setting
             # the parameter to None makes the boto3 API unhappy. :\
 
-            instance = ec2.run_instances(
+            reservation = ec2.run_instances(
                 ImageId=os_settings['ami-id'],
-                MinCount=1,
-                MaxCount=1,
+                MinCount=len(nodenames),
+                MaxCount=len(nodenames),
                 KeyName=keyname,
                 InstanceType=instance_type,
                 Placement=placement,
                 NetworkInterfaces=network_ifs,
                 IamInstanceProfile=iam_profile,
-                BlockDeviceMappings=custom_vols)
-
-            log_debug("run request response for '{}'...".format(instance))
-            log_debug("instance info: {}".format(instance['Instances']))
+                BlockDeviceMappings=custom_vols,
+                TagSpecifications=[{'ResourceType': 'instance', 'Tags': tags}])
 
-            instance_id = instance['Instances'][0]['InstanceId']
-            log_info("instance-id of Rancher Server node: {}".format(instance_id))
+            log_debug("run request response: {}", reservation)
 
-            # we have to sleep for a bit before we start asking for node metadata
-            time.sleep(20)
+            for instance in sorted(reservation['Instances'], key=lambda i: i['AmiLaunchIndex']):
+                nodename = nodenames[instance['AmiLaunchIndex']]
+                instance_ids[nodename] = instance['InstanceId']
+                log_info("instance-id of node '{}': {}", nodename, instance['InstanceId'])
 
-            tags = ec2_compute_tags(nodename)
-            log_info("Tagging instance '{}' with tags: {}".format(instance_id, tags))
-
-            # give our instance time to enter 'pending' before we try to tag it
-            ec2.create_tags(
-                Resources=[instance_id],
-                Tags=tags)
+                if 1 < len(nodenames):
+                    ec2_tag_instance_with_retries(ec2, instance['InstanceId'], [{'Key': 'Name', 'Value': nodename}])
 
         # waiting for 'running' is the easiest way to eliminate race conditions later
-        log_info("Waiting for node to enter state 'running'...")
-        ec2_wait_for_state(instance_id, 'running')
+        ec2_wait_for_states(list(instance_ids.values()), 'running', region=region)
+
+        ec2_inventory_invalidate()
 
-        public_ip = ec2_node_public_ip(nodename, region)
-        log_info("Node '{}' is available at address '{}'.".format(nodename, public_ip))
+        for nodename in nodenames:
+            public_ip = ec2_node_public_ip(nodename, region)
+            log_info("Node '{}' is available at address '{}'.", nodename, public_ip)
 
     except (ClientError, Boto3Error) as e:
         addtl_msg = str(e)
@@ -732,34 +1719,31 @@ def ec2_node_ensure(nodename, instance_type='m4.large'):
                 codedmsg = errmsg.split(':')[1].replace(' ', '')
                 addtl_msg = sts_decode_auth_msg(codedmsg)
 
-        msg = "Failed while provisioning Rancher Server!: {}".format(addtl_msg)
+        msg = "Failed while provisioning node(s) '{}'!: {}".format(', '.join(nodenames), addtl_msg)
         log_debug(msg)
         raise RuntimeError(msg) from e
 
     nuke_aws_keypair(keyname)
-    return True
+    return instance_ids
 
 
 #
 def ec2_node_public_ip(nodename, region='us-west-2'):
 
-    node_filter = [
-        {'Name': 'tag:Name', 'Values': [nodename]},
-        {'Name': 'instance-state-name', 'Values': ['running', 'pending']}
-    ]
-
     try:
-        ec2 = boto3.client('ec2', region_name=region)
-        instances = ec2.describe_instances(Filters=node_filter)
-        rez = instances['Reservations']
-        log_debug("reservations: {}".format(rez))
+        node = ec2_inventory_lookup(nodename, region=region, states=['running', 'pending'])
+
+        # a pending node is only assigned its public IP address a moment later
+        if None is not node and None is node['public_ip']:
+            node = ec2_inventory(region, refresh=True).get(nodename)
+        log_debug("inventory node: {}", node)
 
-        if len(rez) > 1:
-            raise RuntimeError("Detected more than one reservation matching the filter. That's a problem!")
+        if None is node or None is node['public_ip']:
+            raise RuntimeError("No public IP address found for '{}'!".format(nodename))
         else:
-            pubip = str(rez[0]['Instances'][0]['PublicIpAddress'])
+            pubip = str(node['public_ip'])
 
-    except (ClientError, Boto3Error) as e:
+    except RuntimeError as e:
         msg = "Failed while getting public IP address for node '{}'!: {}".format(nodename, str(e))
         log_debug(msg)
         raise RuntimeError(msg) from e
@@ -769,23 +1753,95 @@ def ec2_node_public_ip(nodename, region='us-west-2'):
 
 #
 def ec2_node_terminate(nodename, region='us-west-2'):
-    log_info("Terminating instance '{}'..".format(nodename))
+    log_info("Terminating instance '{}'..", nodename)
 
-    node_filter = [
-        {'Name': 'tag:Name', 'Values': [nodename]},
-        {'Name': 'instance-state-name', 'Values': ['running', 'pending']}
-    ]
+    ec2_teardown([nodename], region=region, volumes=False, keypairs=False)
+    return True
 
-    try:
-        ec2 = boto3.client('ec2', region_name=region)
-        rez = ec2.describe_instances(Filters=node_filter)['Reservations']
 
-        for node in range(0, len(rez)):
-            instance_id = rez[0]['Instances'][node]['InstanceId']
-            log_info("Terminated instance-id '{}'...".format(instance_id))
-            ec2.terminate_instances(InstanceIds=[instance_id])
+#
+def ec2_teardown(nodenames=None, region=None, volumes=True, keypairs=True, wait=False, timeout=600):
+    """
+    Remove every instance, volume and key pair matching a set of names in a fixed number of calls.
 
-    except Boto3Error as e:
-        msg = "Failed while terminating node '{}'!: {}".format(nodename, str(e))
+    Instances are found with one paginated describe_instances call and terminated
+    in a single batch. Idle pooled nodes are left alone. Volumes still attached go
+    away with their instances; only detached ones are deleted here.
+
+    Args:
+      nodenames (list): 'Name' tags to match, wildcards allowed; defaults to the run prefix
+      region (str): AWS region, defaults to AWS_DEFAULT_REGION
+      volumes (bool): also delete detached EBS volumes matching the names
+      keypairs (bool): also delete EC2 key pairs matching the names
+      wait (bool): wait on all of the instances with one waiter until they are terminated
+      timeout (int): seconds to wait when waiting
+
+    Returns:
+      dict: lists of the 'instances', 'volumes' and 'keypairs' which were removed
+    """
+    if None is region:
+        region = aws_get_region()
+    if None is nodenames:
+        # without a run prefix the pattern would match every instance in the account
+        if None is env().get('AWS_PREFIX'):
+            msg = "Refusing to tear down without AWS_PREFIX set!"
+            log_debug(msg)
+            raise RuntimeError(msg)
+        nodenames = [ec2_inventory_pattern()]
+    nodenames = list(nodenames)
+
+    removed = {'instances': [], 'volumes': [], 'keypairs': []}
+
+    try:
+        ec2 = aws_client('ec2', region=region)
+
+        node_filter = [
+            {'Name': 'tag:Name', 'Values': nodenames},
+            {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}
+        ]
+        for page in ec2.get_paginator('describe_instances').paginate(Filters=node_filter):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    node = ec2_inventory_node(instance)
+                    if 'idle' == node['tags'].get('rancher.pool.state'):
+                        continue
+                    log_info("Terminating instance '{}' ({})...", node['name'], node['instance_id'])
+                    removed['instances'].append(node['instance_id'])
+
+        # terminate_instances takes up to 1000 ids per call
+        for i in range(0, len(removed['instances']), 1000):
+            ec2.terminate_instances(InstanceIds=removed['instances'][i:i + 1000])
+        ec2_inventory_invalidate()
+
+        if volumes:
+            vol_filter = [
+                {'Name': 'tag:Name', 'Values': nodenames},
+                {'Name': 'status', 'Values': ['available']}
+            ]
+            for page in ec2.get_paginator('describe_volumes').paginate(Filters=vol_filter):
+                for vol in page['Volumes']:
+                    log_info("Deleting volume '{}'...", vol['VolumeId'])
+                    ec2.delete_volume(VolumeId=vol['VolumeId'])
+                    removed['volumes'].append(vol['VolumeId'])
+
+        if keypairs:
+            key_filter = [{'Name': 'key-name', 'Values': nodenames}]
+            for keypair in ec2.describe_key_pairs(Filters=key_filter)['KeyPairs']:
+                log_info("Deleting key pair '{}'...", keypair['KeyName'])
+                ec2.delete_key_pair(KeyName=keypair['KeyName'])
+                removed['keypairs'].append(keypair['KeyName'])
+
+        if wait and 0 != len(removed['instances']):
+            log_info("Waiting for {} instance(s) to terminate...", len(removed['instances']))
+            ec2.get_waiter('instance_terminated').wait(
+                InstanceIds=removed['instances'],
+                WaiterConfig={'Delay': 10, 'MaxAttempts': max(1, int(timeout / 10))})
+
+    except (ClientError, Boto3Error, WaiterError) as e:
+        msg = "Failed while tearing down '{}'!: {}".format(', '.join(nodenames), str(e))
         log_debug(msg)
         raise RuntimeError(msg) from e
+
+    log_info("Removed {} instance(s), {} volume(s) and {} key pair(s) matching '{}'.",
+             len(removed['instances']), len(removed['volumes']), len(removed['keypairs']), ', '.join(nodenames))
+    return removed
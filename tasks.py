@@ -1,9 +1,16 @@
 import os
 from invoke import task, Collection, run, Failure
 
-from lib.python.utils import log_info, log_success, syntax_check, lint_check, err_and_exit
+from lib.python.utils import log_info, log_success, syntax_check, lint_check, err_and_exit, ec2_teardown, env
 from lib.python.utils.RancherAgents import RancherAgents, RancherAgentsError
 from lib.python.utils.RancherServer import RancherServer, RancherServerError
+from lib.python.utils.AMI import AMIBaker, AMIError
+from lib.python.utils.NodePool import NodePool, NodePoolError, node_pool_enabled
+from lib.python.utils.Pipeline import Pipeline, PipelineError
+from lib.python.utils.Matrix import Matrix, MatrixError, matrix_load
+
+# counts every AWS API call a task makes and reports them when the task exits
+import lib.python.utils.AWSStats  # noqa: F401
 
 
 @task
@@ -13,15 +20,15 @@ def syntax(ctx):
     """
 
     log_info("Syntax checking of YAML files...")
-    syntax_check(os.path.dirname(__file__), 'yaml')
+    syntax_check(os.path.dirname(__file__), 'yaml', excludes=['validation-tests'])
     log_success()
 
     log_info("Syntax checking of Python files...")
-    syntax_check(os.path.dirname(__file__), 'py')
+    syntax_check(os.path.dirname(__file__), 'py', excludes=['validation-tests'])
     log_success()
 
     log_info("Syntax checking of BASH scripts..")
-    syntax_check(os.path.dirname(__file__), 'sh')
+    syntax_check(os.path.dirname(__file__), 'sh', excludes=['validation-tests'])
     log_success()
 
 
@@ -49,6 +56,14 @@ def lint(ctx):
     log_success()
 
 
+@task
+def test(ctx):
+    """
+    Run the unit tests in lib/python/tests; the EC2 ones need lib/python/requirements-bench.txt.
+    """
+    ctx.run("python -m unittest discover -s lib/python/tests")
+
+
 @task(reset)
 def bootstrap(ctx):
     """
@@ -135,6 +150,18 @@ def rancher_server_configure(ctx):
     log_success("Rancher Server configuration: [OK]")
 
 
+@task
+def rancher_server_wait(ctx, timeout=600):
+    """
+    Wait until the infrastructure stacks of Rancher Server are healthy.
+    """
+    try:
+        RancherServer().wait_for_infrastructure(timeout=int(timeout))
+    except RancherServerError as e:
+        err_and_exit("Failed waiting on Rancher Server infrastructure! : {}".format(e.message))
+    log_success("Rancher Server infrastructure : [OK]")
+
+
 @task
 def rancher_agents_provision(ctx):
     """
@@ -147,6 +174,24 @@ def rancher_agents_provision(ctx):
     log_success("Rancher Agents provisioning : [OK]")
 
 
+@task
+def pipeline(ctx):
+    """
+    Provision and configure Rancher Server while Rancher Agents are launched alongside it.
+    """
+    dag = Pipeline('pipeline')
+    dag.add('server.provision', lambda: RancherServer().provision())
+    dag.add('server.configure', lambda: RancherServer().configure(), ['server.provision'])
+    dag.add('agents.launch', lambda: RancherAgents().launch())
+    dag.add('agents.register', lambda: RancherAgents().register(), ['server.configure', 'agents.launch'])
+
+    try:
+        dag.run()
+    except PipelineError as e:
+        err_and_exit("Failed to provision Rancher Server and Agents! : {}".format(e.message))
+    log_success("Pipeline : [OK]")
+
+
 @task
 def rancher_agents_provision_standalone(ctx):
     """
@@ -159,17 +204,96 @@ def rancher_agents_provision_standalone(ctx):
     log_success("Rancher Agents provisioning : [OK]")
 
 
+@task
+def matrix(ctx, spec='lib/yaml/matrix.yaml', keep=False):
+    """
+    Run the server and agent lifecycle of every combination in a matrix file concurrently.
+    """
+    try:
+        Matrix(matrix_load(spec), keep=keep).run()
+    except MatrixError as e:
+        err_and_exit("Matrix run failed! : {}".format(e.message))
+    log_success("Matrix : [OK]")
+
+
+@task
+def teardown(ctx, wait=False):
+    """
+    Remove every instance, detached volume and key pair of the run prefix, or of this server and its agents without AWS_PREFIX.
+    """
+    try:
+        # pooled nodes go back to the pool; teardown leaves idle pooled nodes alone
+        if node_pool_enabled():
+            RancherAgents().deprovision()
+            RancherServer().deprovision()
+
+        nodenames = None
+        if None is env().get('AWS_PREFIX'):
+            nodenames = [RancherServer().name(), RancherAgents().name_pattern()]
+        ec2_teardown(nodenames, wait=wait)
+    except RuntimeError as e:
+        err_and_exit("Failed to tear down run resources! : {}".format(str(e)))
+    log_success("Teardown : [OK]")
+
+
+@task
+def ami_bake(ctx, force=False):
+    """
+    Bake an AMI with the bootstrap applied for the configured OS and Docker settings. Launches use it when RANCHER_BAKED_AMI=true.
+    """
+    try:
+        AMIBaker().bake(force)
+    except AMIError as e:
+        err_and_exit("Failed to bake AMI! : {}".format(e.message))
+    log_success("AMI bake : [OK]")
+
+
+@task
+def node_pool_evict(ctx):
+    """
+    Terminate pooled nodes which have been idle for longer than RANCHER_NODE_POOL_TTL.
+    """
+    try:
+        NodePool().evict()
+    except NodePoolError as e:
+        err_and_exit("Failed to evict pooled nodes! : {}".format(e.message))
+    log_success("Node pool eviction : [OK]")
+
+
+@task
+def bench_logging(ctx):
+    """
+    Microbenchmark the per-call cost of the logging helpers.
+    """
+    from lib.python.bench import bench_logging
+    bench_logging.main()
+
+
+@task
+def bench_provisioning(ctx, counts='1,5,20,100', output=None):
+    """
+    Benchmark server and agent provisioning offline against moto and a stub Rancher API.
+    """
+    from lib.python.bench import bench_provisioning
+    bench_provisioning.main([int(count) for count in counts.split(',')], output)
+
+
 ns = Collection('')
 ns.add_task(reset, 'reset')
 ns.add_task(syntax, 'syntax')
 ns.add_task(lint, 'lint')
+ns.add_task(test, 'test')
 ns.add_task(ci, 'ci')
+ns.add_task(pipeline, 'pipeline')
+ns.add_task(teardown, 'teardown')
+ns.add_task(matrix, 'matrix')
 
 rs = Collection('rancher_server')
 rs.add_task(rancher_server_provision, 'provision')
 rs.add_task(rancher_server_deprovision, 'deprovision')
 # rs.add_task(rancher_server_validate, 'validate')
 rs.add_task(rancher_server_configure, 'configure')
+rs.add_task(rancher_server_wait, 'wait')
 ns.add_collection(rs)
 
 ra = Collection('rancher_agents')
@@ -177,3 +301,16 @@ ra.add_task(rancher_agents_provision, 'provision')
 ra.add_task(rancher_agents_deprovision, 'deprovision')
 ra.add_task(rancher_agents_provision_standalone, 'provisionstandalone')
 ns.add_collection(ra)
+
+am = Collection('ami')
+am.add_task(ami_bake, 'bake')
+ns.add_collection(am)
+
+np = Collection('node_pool')
+np.add_task(node_pool_evict, 'evict')
+ns.add_collection(np)
+
+bn = Collection('bench')
+bn.add_task(bench_logging, 'logging')
+bn.add_task(bench_provisioning, 'provisioning')
+ns.add_collection(bn)